@@ -0,0 +1,591 @@
+import asyncio
+import codecs
+import multiprocessing
+import socket
+import time
+
+from ChatLog import ChatLog
+from Datagram import MAX_SEND_BUFFER, DatagramRegistry
+from Framing import MAX_FRAME_SIZE, SIZE_HEADER, FrameTooLarge
+from Protocol import (CHAT_HEADER, CODEC_FAMILIES, FRAME_HEADER, MAX_CHAT_TEXT, PROTO_LEGACY, ChatMessage,
+                      ProtocolError, ScreenFrame, check_chat_record_size, hello_reply, negotiate_proto,
+                      pack_history, pack_missed, parse_chat_hello, parse_chat_record, parse_codecs,
+                      parse_frame_header, parse_receiver_control, parse_screen_hello, receiver_control_size)
+from Metrics import LOG_INTERVAL, METRICS_PORT, ServerMetrics
+from Recorder import StreamRecorder, recording_path
+from Relay import MAX_OUTBOX_BYTES, ChatOutbox, ReceiverChannel
+from Rooms import RoomRegistry
+from Sessions import SessionTable
+
+
+async def readexactly(reader, size, pending):
+    # StreamReader.readexactly that first consumes `pending`, the bytes read
+    # ahead of the handshake by a legacy client
+    if size > MAX_FRAME_SIZE:
+        raise FrameTooLarge(f"frame of {size} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    if not pending:
+        return await reader.readexactly(size)
+
+    head = bytes(pending[:size])
+    del pending[:size]
+    if len(head) == size:
+        return head
+    return head + await reader.readexactly(size - len(head))
+
+
+class DatagramHellos(asyncio.DatagramProtocol):
+    # The screen port's UDP side: only hellos of receivers asking for
+    # datagrams come in, and frames go out through its transport
+    def __init__(self, registry):
+        self.registry = registry
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        ack = self.registry.hello(data, addr)
+        if ack:
+            self.transport.sendto(ack, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+class AsyncChatScreenServer:
+    # Same ports and wire protocol as ChatScreenServer, but every chat and
+    # screen connection lives on a single asyncio event loop instead of an
+    # OS thread. With workers > 1 the loop is sharded across processes that
+    # share the listening ports through SO_REUSEPORT.
+    def __init__(self, host='localhost', chat_port=9999, screen_port=9998, workers=1, history_dir=None,
+                 record_dir=None, metrics_port=METRICS_PORT, metrics_interval=LOG_INTERVAL, codecs=None,
+                 datagrams=False):
+        self.host = host
+        self.chat_port = chat_port
+        self.screen_port = screen_port
+        self.workers = workers
+        self.history_dir = history_dir
+        self.chat_log = None
+        self.record_dir = record_dir
+        # Codecs presenters may send in; receivers have to decode them
+        self.codecs = codecs or list(CODEC_FAMILIES)
+        self.rooms = RoomRegistry()
+        self.sessions = SessionTable()
+        self.chat_pending = []
+        self.screen_clients = {}
+        # Receivers that asked for frames as UDP datagrams, sent from the
+        # screen port
+        self.datagrams = DatagramRegistry() if datagrams else None
+        self.datagram_transport = None
+        self.metrics = ServerMetrics()
+        self.metrics.watch(self.rooms, self.get_receiver_stats)
+        self.metrics.gauge('chatscreen_detached_sessions', "Clients waiting to reconnect", self.sessions.detached)
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.running = True
+
+    def start_server(self):
+        if self.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            print("⚠️  SO_REUSEPORT is not available, running a single worker")
+            self.workers = 1
+        if self.workers > 1 and self.history_dir:
+            # Workers would write the same log files
+            print("⚠️  Chat history is only kept in memory with more than one worker")
+            self.history_dir = None
+        if self.workers > 1 and self.datagrams:
+            # A receiver's hello could reach any worker
+            print("⚠️  Screen datagrams need a single worker, sending frames over TCP only")
+            self.datagrams = None
+
+        print(f"🚀 Server started! (asyncio, {self.workers} worker(s))")
+        print(f"📱 Chat server: {self.host}:{self.chat_port}")
+        print(f"🖥️  Screen server: {self.host}:{self.screen_port}")
+        if self.datagrams:
+            print(f"📡 Screen datagrams: {self.host}:{self.screen_port}/udp")
+        print("Press Ctrl+C to stop the server")
+
+        if self.workers == 1:
+            self.run_worker()
+            return
+
+        # Workers get the settings rather than this server, which holds
+        # locks and cannot be pickled for a spawned process
+        config = {
+            'host': self.host, 'chat_port': self.chat_port, 'screen_port': self.screen_port,
+            'workers': self.workers, 'history_dir': self.history_dir, 'record_dir': self.record_dir,
+            'metrics_port': self.metrics_port, 'metrics_interval': self.metrics_interval,
+            'codecs': self.codecs, 'datagrams': False,
+        }
+        processes = []
+        for index in range(self.workers):
+            process = multiprocessing.Process(target=run_worker, args=(config, index))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            print("\n🛑 Shutting down server...")
+            self.running = False
+            for process in processes:
+                process.terminate()
+
+    def run_worker(self, index=0):
+        try:
+            asyncio.run(self.serve(index))
+        except KeyboardInterrupt:
+            if self.workers == 1:
+                print("\n🛑 Shutting down server...")
+            self.running = False
+
+    async def serve(self, index=0):
+        # Each worker binds its own listening sockets; with SO_REUSEPORT the
+        # kernel spreads incoming connections across the workers. Workers do
+        # not share state, so a chat room or a sender and its receivers only
+        # see each other when they land on the same worker.
+        reuse_port = self.workers > 1
+        self.chat_log = ChatLog(self.history_dir)
+
+        # Every worker has its own metrics; worker i serves them on
+        # metrics_port + i. Scrapes and log lines run on their own threads.
+        loop = asyncio.get_running_loop()
+        self.metrics.gauge('chatscreen_tasks', "Live asyncio tasks", lambda: len(asyncio.all_tasks(loop)))
+        self.metrics.start(port=self.metrics_port and self.metrics_port + index,
+                           log_interval=self.metrics_interval)
+        chat_server = await asyncio.start_server(
+            self.handle_chat_client, self.host, self.chat_port,
+            reuse_address=True, reuse_port=reuse_port
+        )
+        screen_server = await asyncio.start_server(
+            self.handle_screen_client, self.host, self.screen_port,
+            reuse_address=True, reuse_port=reuse_port
+        )
+        if self.datagrams:
+            self.datagram_transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramHellos(self.datagrams), local_addr=(self.host, self.screen_port)
+            )
+
+        async with chat_server, screen_server:
+            await asyncio.gather(
+                chat_server.serve_forever(), screen_server.serve_forever(), self.evict_idle_caches()
+            )
+
+    async def evict_idle_caches(self):
+        while self.running:
+            await asyncio.sleep(1)
+            self.rooms.evict_idle_caches()
+            await self.expire_sessions()
+
+    async def expire_sessions(self):
+        # Clients that did not come back in time leave for good
+        for session in self.sessions.expire():
+            print(f"⌛ {session.name} did not reconnect to #{session.room.name}")
+            if session.kind == 'chat':
+                self.leave_chat(session.room, session.name, session.conn)
+            else:
+                await self.end_stream(session.stream, session.recorder)
+
+    async def handle_chat_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"💬 Chat client connected: {addr}")
+        username = None
+        room = None
+        outbox = None
+        session = None
+        resumable = False
+        # Legacy clients send raw text; a character split across two reads
+        # is decoded once the rest of it arrives
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        try:
+            # Get username, the room newer clients ask to join and whether
+            # they speak framed chat records. Their hello is
+            # newline-terminated and may arrive together with the first
+            # message.
+            pending = bytearray(await reader.read(1024))
+            if not pending:
+                return
+            hello = parse_chat_hello(pending)
+            if hello is None:
+                username, options = decoder.decode(pending), {}
+                pending.clear()
+            else:
+                username, options, consumed = hello
+                del pending[:consumed]
+            proto = negotiate_proto(options)
+
+            # A version 2 client coming back with its session token keeps
+            # its name and room
+            outbox = ChatOutbox(writer, proto)
+            resumed = False
+            if proto != PROTO_LEGACY:
+                session, previous = self.sessions.resume(options.get('resume'), 'chat', outbox)
+                resumed = session is not None
+                if previous is not None:
+                    # Ends the handler still reading the old connection
+                    previous.close()
+                    previous.conn.close()
+            if resumed:
+                room, username = session.room, session.name
+            else:
+                room = self.rooms.acquire(options.get('room'))
+                if proto != PROTO_LEGACY:
+                    session = self.sessions.create('chat', room, username, outbox)
+            if 'proto' in options:
+                reply = {'session': session.token, 'resumed': int(resumed)} if session else {}
+                writer.write(hello_reply(proto, **reply))
+            room.add_member(username, outbox)
+
+            if resumed:
+                # Nobody saw this user leave; they only need what they missed
+                await self.send_missed(outbox, room, options.get('since'))
+            else:
+                # Broadcast user joined, and catch the new user up on the room
+                self.broadcast_message(room, ChatMessage('join', username), username)
+                await self.send_history(outbox, room)
+
+            while self.running:
+                if proto == PROTO_LEGACY:
+                    data = bytes(pending) or await reader.read(1024)
+                    pending.clear()
+                    if not data:
+                        break
+                    text = decoder.decode(data)
+                    if not text:
+                        continue
+                    record = {'type': 'message', 'text': text}
+                else:
+                    header = await readexactly(reader, CHAT_HEADER.size, pending)
+                    size = check_chat_record_size(CHAT_HEADER.unpack(header)[0])
+                    record = parse_chat_record(await readexactly(reader, size, pending))
+                if record.get('type') == 'history':
+                    await self.send_history(outbox, room, record.get('before'), always=True)
+                    continue
+                if record.get('type') != 'message' or not record.get('text'):
+                    continue
+
+                message = ChatMessage('message', username, str(record['text'])[:MAX_CHAT_TEXT], time.time())
+                self.metrics.chat_in.inc()
+                self.chat_log.append(room.name, message)
+                print(f"#{room.name} {message.text}")
+                self.broadcast_message(room, message, username)
+
+        except asyncio.IncompleteReadError as e:
+            # A connection that breaks off mid-record can be resumed, unlike
+            # a clean close
+            resumable = bool(e.partial)
+        except Exception as e:
+            resumable = True
+            print(f"Error handling chat client {addr}: {e}")
+        finally:
+            if room is not None and (session is None or self.sessions.detach(session, outbox, resumable)):
+                self.leave_chat(room, username, outbox)
+            if outbox is not None:
+                outbox.close()
+            writer.close()
+
+    def leave_chat(self, room, username, outbox):
+        if room.remove_member(username, outbox):
+            self.broadcast_message(room, ChatMessage('leave', username), username)
+        self.rooms.release(room)
+
+    async def send_history(self, outbox, room, before=None, always=False):
+        # Logged messages older than `before`, or the latest ones on join.
+        # Pages older than the in-memory tail read the disk, so the lookup
+        # runs in the default executor.
+        if before is not None and not isinstance(before, int):
+            records = []
+        else:
+            loop = asyncio.get_running_loop()
+            records = await loop.run_in_executor(None, self.chat_log.history, room.name, before)
+        if records or always:
+            self.queue_chat(outbox, pack_history(records, outbox.proto))
+
+    async def send_missed(self, outbox, room, since):
+        # Messages logged after the last one a resumed client saw
+        try:
+            since = int(since or 0)
+        except ValueError:
+            return
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(None, self.chat_log.after, room.name, since)
+        if records:
+            self.queue_chat(outbox, pack_missed(records))
+
+    def broadcast_message(self, room, message, sender=None):
+        # The message is encoded once per wire format and appended to each
+        # recipient's outbox. Outboxes are written out once the current
+        # callback returns, so a burst of messages handled in the same loop
+        # iteration reaches each client in a single write.
+        recipients = room.chat_recipients(sender)
+        for username, outbox in recipients:
+            self.queue_chat(outbox, message.encode(outbox.proto))
+        self.metrics.chat_out.inc(len(recipients))
+
+    def queue_chat(self, outbox, data):
+        if outbox.append(data):
+            if not self.chat_pending:
+                asyncio.get_running_loop().call_soon(self.flush_chat)
+            self.chat_pending.append(outbox)
+
+    def flush_chat(self):
+        # Writes never wait; a client whose transport buffer keeps growing
+        # past MAX_OUTBOX_BYTES is disconnected instead
+        pending, self.chat_pending = self.chat_pending, []
+        for outbox in pending:
+            writer = outbox.conn
+            data = outbox.take()
+            if writer.is_closing():
+                continue
+            if outbox.closed or writer.transport.get_write_buffer_size() > MAX_OUTBOX_BYTES:
+                outbox.close()
+                writer.close()
+                continue
+            writer.write(data)
+
+    async def handle_screen_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"🖥️  Screen client connected: {addr}")
+        link = None
+
+        try:
+            # Determine if client is sender or receiver, and which framing it
+            # speaks. Legacy clients send a bare role and get no reply.
+            pending = bytearray(await reader.read(1024))
+            while (hello := parse_screen_hello(bytes(pending))) is None:
+                data = await reader.read(1024)
+                if not data or len(pending) >= 1024:
+                    raise ProtocolError("incomplete screen handshake")
+                pending += data
+            role, options, consumed = hello
+            del pending[:consumed]
+            proto = negotiate_proto(options)
+            # Senders are answered once their codec is chosen. Receivers that
+            # ask for datagrams get the token to register their UDP address.
+            if options and role != "SENDER":
+                reply = {}
+                if self.datagrams and proto != PROTO_LEGACY and options.get('transport') == 'udp':
+                    link = self.datagrams.create()
+                    reply['udp'] = link.token
+                writer.write(hello_reply(proto, **reply))
+        except Exception as e:
+            if link is not None:
+                self.datagrams.remove(link)
+            print(f"Error in screen handshake with {addr}: {e}")
+            writer.close()
+            return
+
+        if role == "SENDER":
+            await self.handle_screen_sender(reader, writer, addr, proto, pending, options)
+            return
+
+        # Legacy clients always join the default room
+        room = self.rooms.acquire(options.get('room'))
+        try:
+            await self.handle_screen_receiver(reader, writer, addr, proto, room, options, link)
+        finally:
+            if link is not None:
+                self.datagrams.remove(link)
+            self.rooms.release(room)
+
+    async def handle_screen_sender(self, reader, writer, addr, proto, pending, options):
+        # A version 2 presenter whose connection broke keeps its stream,
+        # receivers and recording for RESUME_TIMEOUT seconds and picks up
+        # where it left off when it reconnects with its session token
+        session, previous = None, None
+        if proto != PROTO_LEGACY:
+            session, previous = self.sessions.resume(options.get('resume'), 'screen', writer)
+        resumed = session is not None
+        if resumed:
+            stream, recorder = session.stream, session.recorder
+            if previous is not None:
+                previous.close()
+            print(f"🖥️  {stream.presenter} resumed presenting in #{stream.room.name}")
+        else:
+            room = self.rooms.acquire(options.get('room'))
+            stream = room.add_stream(options.get('name') or f"{addr[0]}:{addr[1]}")
+            print(f"🖥️  {stream.presenter} is presenting in #{room.name}")
+            # A sender that offers codecs is told which one to send; the
+            # others send JPEG
+            room.choose_codec(stream, parse_codecs(options.get('codecs')), self.codecs)
+            recorder = self.start_recording(stream)
+            if proto != PROTO_LEGACY:
+                session = self.sessions.create('screen', room, stream.presenter, writer)
+                session.stream, session.recorder = stream, recorder
+        if options:
+            reply = {'codec': stream.codec} if 'codecs' in options else {}
+            if session is not None:
+                reply.update(session=session.token, resumed=int(resumed))
+            writer.write(hello_reply(proto, **reply))
+        # Version 2 senders also get feedback reports written to their socket
+        if proto != PROTO_LEGACY:
+            stream.send_report = self.report_sender(writer)
+        resumable = False
+        seq = 0
+        try:
+            while self.running:
+                if proto == PROTO_LEGACY:
+                    # Receive frame size, then frame data
+                    packed_msg_size = await readexactly(reader, SIZE_HEADER.size, pending)
+                    msg_size = SIZE_HEADER.unpack(packed_msg_size)[0]
+                    frame_data = await readexactly(reader, msg_size, pending)
+                    frame = ScreenFrame.from_legacy(frame_data, seq, time.time())
+                else:
+                    header = await readexactly(reader, FRAME_HEADER.size, pending)
+                    codec, width, height, frame_seq, timestamp, flags, length = parse_frame_header(header)
+                    payload = await readexactly(reader, length, pending)
+                    frame = ScreenFrame(codec, width, height, frame_seq, timestamp, flags, payload)
+                seq += 1
+
+                # Broadcast frame to the stream's receivers
+                self.broadcast_screen_frame(frame, stream)
+                if recorder:
+                    recorder.write(frame)
+
+        except asyncio.IncompleteReadError as e:
+            # Broken off mid-frame rather than closed cleanly
+            resumable = bool(e.partial)
+        except Exception as e:
+            resumable = True
+            print(f"Error handling screen sender {addr}: {e}")
+        finally:
+            writer.close()
+            if session is None or self.sessions.detach(session, writer, resumable):
+                await self.end_stream(stream, recorder)
+
+    async def end_stream(self, stream, recorder):
+        stream.room.remove_stream(stream)
+        if recorder:
+            # Waits for the final flush and fsync off the loop
+            await asyncio.get_running_loop().run_in_executor(None, recorder.close)
+        self.rooms.release(stream.room)
+
+    def start_recording(self, stream):
+        if not self.record_dir:
+            return None
+        path = recording_path(self.record_dir, stream.room.name, stream.presenter)
+        try:
+            recorder = StreamRecorder(path)
+        except OSError as e:
+            # The presenter still shares, just without a recording
+            print(f"⚠️  Cannot record {stream.presenter} to {path}: {e}")
+            return None
+        print(f"⏺️  Recording {stream.presenter} to {path}")
+        return recorder
+
+    async def handle_screen_receiver(self, reader, writer, addr, proto, room, options, link=None):
+        # Receivers only send occasional feedback after the handshake; waiting
+        # for it parks the connection on the loop without any polling wakeups
+        # while a separate task drains the receiver's frame queue. Without a
+        # presenter option the receiver follows whoever is presenting.
+        presenter = options.get('presenter') or None
+        ready = asyncio.Event()
+        channel = ReceiverChannel(addr, proto, on_ready=ready.set, on_drop=self.metrics.frames_dropped.inc,
+                                  codecs=parse_codecs(options.get('codecs')))
+        self.screen_clients[writer] = channel
+        room.subscribe(channel, presenter)
+        sender_task = asyncio.create_task(self.send_screen_frames(writer, channel, ready, link))
+        try:
+            while self.running:
+                magic = await reader.readexactly(4)
+                data = magic + await reader.readexactly(receiver_control_size(magic) - len(magic))
+                kind, feedback = parse_receiver_control(data)
+                if kind == 'datagrams':
+                    # Datagrams start from a full picture
+                    if link is not None and link.activate():
+                        room.resync(channel, presenter)
+                    continue
+                if kind == 'keyframe':
+                    room.resync(channel, presenter)
+                    continue
+                dropped = channel.take_drops()
+                stream = room.stream_for(presenter)
+                if stream is None:
+                    continue
+                report = stream.feedback.add(channel, feedback, dropped)
+                if report and stream.send_report:
+                    stream.send_report(report)
+        except Exception:
+            pass
+        finally:
+            room.unsubscribe(channel, presenter)
+            self.screen_clients.pop(writer, None)
+            channel.close()
+            sender_task.cancel()
+            writer.close()
+            print(f"🖥️  Screen receiver disconnected: {addr} ({channel.dropped} frames dropped)")
+
+    async def send_screen_frames(self, writer, channel, ready, link):
+        # drain() only waits while this receiver's socket is backed up; frames
+        # that arrive meanwhile replace the oldest ones in its queue.
+        # Datagrams never wait: with the UDP buffer full the frame is dropped.
+        try:
+            while not channel.closed:
+                ready.clear()
+                frame = channel.get_nowait()
+                if frame is None:
+                    await ready.wait()
+                    continue
+                if link is not None and link.active:
+                    self.send_datagrams(link, frame, channel)
+                    continue
+                buffers = frame.buffers(channel.proto)
+                start = time.perf_counter()
+                writer.writelines(buffers)
+                await writer.drain()
+                self.metrics.frame_sent(buffers, time.perf_counter() - start)
+                channel.sent += 1
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            # Closing the connection ends the receiver's handler, which
+            # unsubscribes it
+            print(f"Error sending screen frames to {channel.addr}: {e}")
+            channel.close()
+            writer.close()
+
+    def send_datagrams(self, link, frame, channel):
+        transport = self.datagram_transport
+        if transport.get_write_buffer_size() > MAX_SEND_BUFFER:
+            channel.drop(frame)
+            return
+        start = time.perf_counter()
+        packets = link.packets(frame)
+        for packet in packets:
+            transport.sendto(packet, link.addr)
+        self.metrics.frame_sent(packets, time.perf_counter() - start)
+        channel.sent += 1
+
+    def report_sender(self, writer):
+        def send_report(report):
+            if not writer.is_closing():
+                writer.write(report)
+
+        return send_report
+
+    def broadcast_screen_frame(self, frame, stream):
+        # Every receiver queues the same frame object, so the fan-out costs
+        # one queue append per receiver and no frame copies.
+        start = time.perf_counter()
+        for channel in stream.room.publish(stream, frame):
+            if not channel.put(frame) and channel.awaiting_keyframe:
+                stream.request_keyframe()
+        self.metrics.fanout.observe(time.perf_counter() - start)
+        self.metrics.frame_received(frame)
+
+    def get_receiver_stats(self):
+        # Also called from the metrics threads; list() copies the channels
+        # without releasing the GIL
+        return [channel.stats() for channel in list(self.screen_clients.values())]
+
+
+def run_worker(config, index):
+    # Entry point of a worker process: builds its own server from the
+    # parent's settings
+    AsyncChatScreenServer(**config).run_worker(index)
+
+
+if __name__ == "__main__":
+    server = AsyncChatScreenServer()
+    server.start_server()
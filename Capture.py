@@ -0,0 +1,333 @@
+import ctypes
+import ctypes.util
+import os
+
+import cv2
+import numpy as np
+
+# Captured frames are scaled down to fit inside this box, keeping their
+# aspect ratio; None keeps the native resolution.
+DEFAULT_OUTPUT_SIZE = (800, 600)
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+def fit_size(width, height, max_size):
+    # Largest size that fits inside max_size with the same aspect ratio;
+    # frames are never scaled up
+    if max_size is None:
+        return width, height
+    max_width, max_height = max_size
+    scale = min(max_width / width, max_height / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class CaptureBackend:
+    # Interface for screen grabbers: grab() returns a BGR uint8 frame of
+    # output_size, or of the captured area scaled to fit inside it. Each call
+    # returns a new array, since pipeline stages may still hold earlier ones.
+    name = None
+
+    def __init__(self, region=None, output_size=DEFAULT_OUTPUT_SIZE):
+        # region is (left, top, width, height) in screen coordinates
+        self.region = region
+        self.output_size = output_size
+
+    def grab(self):
+        raise NotImplementedError
+
+    def scale(self, frame, conversion=None):
+        # Scales (with INTER_AREA) and converts to BGR in at most two passes.
+        # Without a conversion, frame must be an array the caller owns.
+        height, width = frame.shape[:2]
+        size = fit_size(width, height, self.output_size)
+        if size != (width, height):
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if conversion is not None:
+            frame = cv2.cvtColor(frame, conversion)
+        return frame
+
+    def close(self):
+        pass
+
+
+class PyAutoGuiBackend(CaptureBackend):
+    # Portable fallback through pyautogui/PIL; works wherever pyautogui does
+    name = 'pyautogui'
+
+    def __init__(self, region=None, output_size=DEFAULT_OUTPUT_SIZE):
+        super().__init__(region, output_size)
+        import pyautogui
+        self.pyautogui = pyautogui
+
+    def grab(self):
+        screenshot = self.pyautogui.screenshot(region=self.region)
+        return self.scale(np.asarray(screenshot), cv2.COLOR_RGB2BGR)
+
+
+class _XImage(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+        ('red_mask', ctypes.c_ulong),
+        ('green_mask', ctypes.c_ulong),
+        ('blue_mask', ctypes.c_ulong),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+class _XWindowAttributes(ctypes.Structure):
+    # Only the leading geometry fields are read; the padding covers the rest
+    _fields_ = [
+        ('x', ctypes.c_int),
+        ('y', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('border_width', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('_rest', ctypes.c_char * 256),
+    ]
+
+
+def _load_library(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise CaptureError(f"lib{name} not found")
+    return ctypes.CDLL(path)
+
+
+class XShmBackend(CaptureBackend):
+    # X11 grabber using the MIT-SHM extension: the X server copies pixels
+    # straight into a shared memory segment that is mapped once as a NumPy
+    # array and reused for every frame, so a grab costs one server-side copy
+    # plus the scale/convert pass that produces the returned BGR frame.
+    # window captures that window's current area (it must be visible).
+    name = 'xshm'
+
+    ZPIXMAP = 2
+    ALL_PLANES = 0xFFFFFFFF
+    IPC_PRIVATE = 0
+    IPC_CREAT = 0o1000
+    IPC_RMID = 0
+
+    def __init__(self, region=None, output_size=DEFAULT_OUTPUT_SIZE, window=None, display=None):
+        super().__init__(region, output_size)
+        self.window = window
+        self.display = None
+        self.image = None
+        self.shminfo = None
+
+        if not (display or os.environ.get('DISPLAY')):
+            raise CaptureError("no X display")
+
+        xlib = self.xlib = _load_library('X11')
+        xext = self.xext = _load_library('Xext')
+        libc = self.libc = ctypes.CDLL(None, use_errno=True)
+
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XGetWindowAttributes.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XWindowAttributes)]
+        xlib.XTranslateCoordinates.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong)
+        ]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDestroyImage.argtypes = [ctypes.POINTER(_XImage)]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+            ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint
+        ]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong
+        ]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        self.display = xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise CaptureError("cannot open X display")
+        if not xext.XShmQueryExtension(self.display):
+            self.close()
+            raise CaptureError("X server does not support MIT-SHM")
+
+        self.root = xlib.XDefaultRootWindow(self.display)
+        self.screen = xlib.XDefaultScreen(self.display)
+        self.width = self.height = 0
+
+    def geometry(self):
+        # Area to capture in root window coordinates, clipped to the screen
+        # (X reports an error for requests outside the drawable)
+        root = _XWindowAttributes()
+        self.xlib.XGetWindowAttributes(self.display, self.root, ctypes.byref(root))
+
+        if self.window is not None:
+            attributes = _XWindowAttributes()
+            self.xlib.XGetWindowAttributes(self.display, self.window, ctypes.byref(attributes))
+            x, y, child = ctypes.c_int(), ctypes.c_int(), ctypes.c_ulong()
+            self.xlib.XTranslateCoordinates(
+                self.display, self.window, self.root, 0, 0, ctypes.byref(x), ctypes.byref(y), ctypes.byref(child)
+            )
+            left, top, width, height = x.value, y.value, attributes.width, attributes.height
+        elif self.region is not None:
+            left, top, width, height = self.region
+        else:
+            left, top, width, height = 0, 0, root.width, root.height
+
+        right = min(left + width, root.width)
+        bottom = min(top + height, root.height)
+        left, top = max(left, 0), max(top, 0)
+        if right <= left or bottom <= top:
+            raise CaptureError("capture area is off screen")
+        return left, top, right - left, bottom - top
+
+    def allocate(self, width, height):
+        self.release()
+        self.shminfo = _XShmSegmentInfo()
+        visual = self.xlib.XDefaultVisual(self.display, self.screen)
+        depth = self.xlib.XDefaultDepth(self.display, self.screen)
+        image = self.xext.XShmCreateImage(
+            self.display, visual, depth, self.ZPIXMAP, None, ctypes.byref(self.shminfo), width, height
+        )
+        if not image:
+            raise CaptureError("XShmCreateImage failed")
+        if image.contents.bits_per_pixel != 32:
+            self.xlib.XDestroyImage(image)
+            raise CaptureError(f"unsupported pixel format: {image.contents.bits_per_pixel} bpp")
+
+        stride = image.contents.bytes_per_line
+        self.shminfo.shmid = self.libc.shmget(self.IPC_PRIVATE, stride * height, self.IPC_CREAT | 0o600)
+        if self.shminfo.shmid < 0:
+            self.xlib.XDestroyImage(image)
+            raise CaptureError(f"shmget failed: {os.strerror(ctypes.get_errno())}")
+        self.shminfo.shmaddr = self.libc.shmat(self.shminfo.shmid, None, 0)
+        if self.shminfo.shmaddr in (None, ctypes.c_void_p(-1).value):
+            self.libc.shmctl(self.shminfo.shmid, self.IPC_RMID, None)
+            self.xlib.XDestroyImage(image)
+            raise CaptureError(f"shmat failed: {os.strerror(ctypes.get_errno())}")
+        self.shminfo.readOnly = 0
+        image.contents.data = self.shminfo.shmaddr
+        self.image = image
+
+        self.xext.XShmAttach(self.display, ctypes.byref(self.shminfo))
+        self.xlib.XSync(self.display, 0)
+        # The segment is freed automatically once both sides detach
+        self.libc.shmctl(self.shminfo.shmid, self.IPC_RMID, None)
+
+        pixels = ctypes.cast(self.shminfo.shmaddr, ctypes.POINTER(ctypes.c_ubyte))
+        buffer = np.ctypeslib.as_array(pixels, shape=(height, stride))
+        self.buffer = buffer[:, :width * 4].reshape(height, width, 4)
+        self.width, self.height = width, height
+
+    def grab(self):
+        left, top, width, height = self.geometry()
+        if (width, height) != (self.width, self.height):
+            self.allocate(width, height)
+
+        self.xext.XShmGetImage(self.display, self.root, self.image, left, top, self.ALL_PLANES)
+        # 32 bpp ZPixmaps on little-endian servers are laid out as BGRA
+        return self.scale(self.buffer, cv2.COLOR_BGRA2BGR)
+
+    def release(self):
+        if self.image:
+            self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+            self.xlib.XDestroyImage(self.image)
+            self.libc.shmdt(self.shminfo.shmaddr)
+            self.image = None
+            self.buffer = None
+            self.width = self.height = 0
+
+    def close(self):
+        if self.display:
+            self.release()
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+
+class SyntheticBackend(CaptureBackend):
+    # Deterministic frames for headless tests and benchmarks: a fixed
+    # textured desktop with a box that moves a little every frame, so
+    # consecutive frames differ in a few tiles like a real screen
+    name = 'synthetic'
+
+    def __init__(self, region=None, output_size=DEFAULT_OUTPUT_SIZE, size=(1920, 1080), seed=0):
+        super().__init__(region, output_size)
+        width, height = size
+        rng = np.random.default_rng(seed)
+        gradient = np.linspace(0, 255, width, dtype=np.float32)
+        background = np.empty((height, width, 3), dtype=np.uint8)
+        background[:] = gradient[None, :, None].astype(np.uint8)
+        noise = rng.integers(0, 32, size=(height, width, 1), dtype=np.uint8)
+        self.background = background + noise
+        self.frame_index = 0
+
+    def grab(self):
+        frame = self.background
+        if self.region is not None:
+            left, top, width, height = self.region
+            frame = frame[top:top + height, left:left + width]
+        frame = frame.copy()
+
+        height, width = frame.shape[:2]
+        box = max(8, min(width, height) // 10)
+        x = (self.frame_index * 7) % max(1, width - box)
+        y = (self.frame_index * 3) % max(1, height - box)
+        frame[y:y + box, x:x + box] = (0, 0, 255)
+        self.frame_index += 1
+        return self.scale(frame)
+
+
+BACKENDS = {
+    backend.name: backend for backend in (XShmBackend, PyAutoGuiBackend, SyntheticBackend)
+}
+
+
+def create_backend(name='auto', window=None, **options):
+    # 'auto' prefers the shared-memory grabber and falls back to pyautogui.
+    # Capturing a window by id needs the X11 grabber.
+    if window is not None and name not in ('auto', XShmBackend.name):
+        raise CaptureError(f"window capture is not supported by the {name} backend")
+    if name == XShmBackend.name:
+        return XShmBackend(window=window, **options)
+    if name != 'auto':
+        return BACKENDS[name](**options)
+
+    try:
+        return XShmBackend(window=window, **options)
+    except CaptureError:
+        if window is not None:
+            raise
+        return PyAutoGuiBackend(**options)
@@ -0,0 +1,258 @@
+import bisect
+import os
+import struct
+import threading
+from collections import OrderedDict, deque
+
+from Protocol import CHAT_HEADER, file_name_part
+
+# Messages per room kept in memory, newest last, so joins and the first
+# history pages never touch the disk
+TAIL_SIZE = 200
+
+# Messages replayed to a client when it joins, and per history page
+REPLAY_SIZE = 50
+
+# Room logs kept open at most. Opening one more closes the least recently
+# used log that has nothing left to write; without a history directory its
+# messages are forgotten.
+MAX_OPEN_ROOMS = 1024
+
+# A room's log starts a new segment once the current one reaches this size
+SEGMENT_BYTES = 4 * 1024 * 1024
+
+# One entry per message in a segment's .idx file: sequence number, time
+# and offset of the record in the segment's .log file. Sequence numbers
+# within a segment are contiguous, so the entry for a message is found by
+# position without searching.
+INDEX_ENTRY = struct.Struct("!QdQ")
+
+
+class RoomLog:
+    # The log of one room: a directory of segments named after the first
+    # sequence number they hold. Each .log file holds the chat records
+    # exactly as sent to version 2 clients (length-prefixed JSON). Without
+    # a directory only the tail is kept, in memory.
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, tail_size=TAIL_SIZE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segments = []
+        self.next_seq = 1
+        # Messages queued for the writer thread, guarded by ChatLog.lock
+        self.unwritten = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx'))
+        if self.segments:
+            # Drop a partly written index entry left by a crash
+            first = self.segments[-1]
+            path = self.path(first, '.idx')
+            count = os.path.getsize(path) // INDEX_ENTRY.size
+            os.truncate(path, count * INDEX_ENTRY.size)
+            self.next_seq = first + count
+
+        self.tail = deque(self.read(max(1, self.next_seq - tail_size), self.next_seq), maxlen=tail_size)
+
+    def path(self, first, suffix):
+        return os.path.join(self.directory, f"{first:020d}{suffix}")
+
+    def write(self, records):
+        # Appends (seq, timestamp, data) records and fsyncs them; called from
+        # the ChatLog writer thread only
+        records = deque(records)
+        while records:
+            # Start a new segment when the current one is full, or when
+            # messages went missing after a failed write so sequence numbers
+            # stay contiguous within every segment
+            first = self.segments[-1] if self.segments else None
+            if (first is None
+                    or os.path.getsize(self.path(first, '.log')) >= self.segment_bytes
+                    or os.path.getsize(self.path(first, '.idx')) // INDEX_ENTRY.size != records[0][0] - first):
+                first = records[0][0]
+                with self.lock:
+                    self.segments.append(first)
+
+            with open(self.path(first, '.log'), 'ab') as log_file, \
+                    open(self.path(first, '.idx'), 'ab') as index_file:
+                offset = log_file.tell()
+                entries = []
+                while records and offset < self.segment_bytes:
+                    seq, timestamp, data = records.popleft()
+                    log_file.write(CHAT_HEADER.pack(len(data)))
+                    log_file.write(data)
+                    entries.append(INDEX_ENTRY.pack(seq, timestamp, offset))
+                    offset += CHAT_HEADER.size + len(data)
+
+                # The index only ever points at records already on disk
+                log_file.flush()
+                os.fsync(log_file.fileno())
+                index_file.write(b"".join(entries))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+    def read(self, start, stop):
+        # Returns (seq, data) for the logged messages start <= seq < stop
+        with self.lock:
+            segments = list(self.segments)
+
+        records = []
+        i = max(bisect.bisect_right(segments, start) - 1, 0)
+        for first in segments[i:]:
+            if first >= stop:
+                break
+            records.extend(self.read_segment(first, max(start, first), stop))
+        return records
+
+    def read_segment(self, first, start, stop):
+        with open(self.path(first, '.idx'), 'rb') as index_file:
+            count = os.fstat(index_file.fileno()).st_size // INDEX_ENTRY.size
+            stop = min(stop, first + count)
+            if start >= stop:
+                return []
+            index_file.seek((start - first) * INDEX_ENTRY.size)
+            entries = index_file.read((stop - start) * INDEX_ENTRY.size)
+
+        records = []
+        with open(self.path(first, '.log'), 'rb') as log_file:
+            for seq, _, offset in INDEX_ENTRY.iter_unpack(entries):
+                log_file.seek(offset)
+                size = CHAT_HEADER.unpack(log_file.read(CHAT_HEADER.size))[0]
+                records.append((seq, log_file.read(size)))
+        return records
+
+
+class ChatLog:
+    # Append-only chat history for every room. append() only numbers the
+    # message and queues it, so logging never slows down a broadcast; a
+    # writer thread commits everything queued since its previous fsync as
+    # one group. With directory None nothing is written: messages are still
+    # numbered and the latest TAIL_SIZE per room kept for joins and
+    # resumed sessions.
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, tail_size=TAIL_SIZE, max_rooms=MAX_OPEN_ROOMS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.tail_size = tail_size
+        self.max_rooms = max_rooms
+        self.lock = threading.Lock()
+        self.open_lock = threading.Lock()
+        self.rooms = OrderedDict()
+        self.pending = []
+        self.condition = threading.Condition()
+        if directory is not None:
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def room_log(self, room, writing=False):
+        # The room's log, opened if needed. With writing=True it stays open
+        # until the writer thread has written the message about to be
+        # queued, so a log is never read back from disk while messages for
+        # it are in flight.
+        log = self.open_log(room, writing)
+        if log is not None:
+            return log
+        # Opening reads the room's directory: only other opens wait for
+        # it, not messages to rooms already open
+        with self.open_lock:
+            log = self.open_log(room, writing)
+            if log is None:
+                path = None
+                if self.directory is not None:
+                    path = os.path.join(self.directory, file_name_part(room))
+                log = RoomLog(path, self.segment_bytes, self.tail_size)
+                with self.lock:
+                    self.rooms[room] = log
+                    if writing:
+                        log.unwritten += 1
+                    self.close_idle()
+            return log
+
+    def open_log(self, room, writing):
+        with self.lock:
+            log = self.rooms.get(room)
+            if log is not None:
+                self.rooms.move_to_end(room)
+                if writing:
+                    log.unwritten += 1
+            return log
+
+    def close_idle(self):
+        # Called with the lock held; drops the least recently used logs
+        # beyond max_rooms, skipping those with messages still to write
+        excess = len(self.rooms) - self.max_rooms
+        if excess <= 0:
+            return
+        for room, log in list(self.rooms.items()):
+            if excess <= 0:
+                break
+            if not log.unwritten:
+                del self.rooms[room]
+                excess -= 1
+
+    def append(self, room, message):
+        # Gives the message its sequence number in the room; must be called
+        # before the message is encoded
+        log = self.room_log(room, writing=self.directory is not None)
+        with log.lock:
+            seq = log.next_seq
+            log.next_seq += 1
+            message.record['seq'] = seq
+            log.tail.append((seq, message.data))
+            if self.directory is None:
+                return seq
+            with self.condition:
+                self.pending.append((log, seq, message.record.get('time', 0.0), message.data))
+                self.condition.notify()
+        return seq
+
+    def history(self, room, before=None, limit=REPLAY_SIZE):
+        # JSON of up to `limit` messages older than `before` (the newest
+        # ones if None), oldest first. Only pages older than the in-memory
+        # tail read the disk, straight from the index.
+        log = self.room_log(room)
+        with log.lock:
+            if before is None:
+                before = log.next_seq
+            records = [item for item in log.tail if item[0] < before][-limit:]
+            tail_start = log.tail[0][0] if log.tail else log.next_seq
+
+        stop = min(before, tail_start)
+        missing = limit - len(records)
+        if missing > 0 and stop > 1:
+            records = log.read(max(1, stop - missing), stop) + records
+        return [data for _, data in records]
+
+    def after(self, room, since, limit=TAIL_SIZE):
+        # JSON of the messages newer than `since`, oldest first, for a
+        # client resuming its session; only the newest `limit` if it missed
+        # more
+        log = self.room_log(room)
+        with log.lock:
+            start = max(since + 1, log.next_seq - limit)
+            records = [item for item in log.tail if item[0] >= start]
+            tail_start = log.tail[0][0] if log.tail else log.next_seq
+
+        if start < tail_start:
+            records = log.read(start, tail_start) + records
+        return [data for _, data in records]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch, self.pending = self.pending, []
+
+            rooms = {}
+            for log, *record in batch:
+                rooms.setdefault(log, []).append(record)
+            for log, records in rooms.items():
+                try:
+                    log.write(records)
+                except OSError as e:
+                    print(f"Error writing chat history to {log.directory}: {e}")
+                with self.lock:
+                    log.unwritten -= len(records)
+                    self.close_idle()
@@ -1,330 +1,394 @@
-import socket
-import threading
-import cv2
-import pickle
-import struct
-import pyautogui
-import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
-import time
-from PIL import Image, ImageTk
-import numpy as np
-
-class ChatScreenClient:
-    def __init__(self):
-        self.host = 'localhost'
-        self.chat_port = 9999
-        self.screen_port = 9998
-        self.username = ""
-        self.chat_socket = None
-        self.screen_socket = None
-        self.sharing_screen = False
-        self.receiving_screen = False
-        self.running = True
-        
-        # GUI Setup
-        self.setup_gui()
-        
-    def setup_gui(self):
-        self.root = tk.Tk()
-        self.root.title("Chat & Screen Share")
-        self.root.geometry("800x600")
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
-        
-        # Create notebook for tabs
-        self.notebook = ttk.Notebook(self.root)
-        self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
-        
-        # Chat Tab
-        self.setup_chat_tab()
-        
-        # Screen Share Tab
-        self.setup_screen_tab()
-        
-        # Connection Tab
-        self.setup_connection_tab()
-        
-    def setup_connection_tab(self):
-        self.conn_frame = ttk.Frame(self.notebook)
-        self.notebook.add(self.conn_frame, text="Connection")
-        
-        # Connection controls
-        conn_control = ttk.LabelFrame(self.conn_frame, text="Server Connection")
-        conn_control.pack(fill='x', padx=10, pady=10)
-        
-        ttk.Label(conn_control, text="Username:").grid(row=0, column=0, sticky='w', padx=5, pady=5)
-        self.username_entry = ttk.Entry(conn_control, width=20)
-        self.username_entry.grid(row=0, column=1, padx=5, pady=5)
-        
-        ttk.Label(conn_control, text="Server IP:").grid(row=1, column=0, sticky='w', padx=5, pady=5)
-        self.host_entry = ttk.Entry(conn_control, width=20)
-        self.host_entry.insert(0, "localhost")
-        self.host_entry.grid(row=1, column=1, padx=5, pady=5)
-        
-        self.connect_btn = ttk.Button(conn_control, text="Connect", command=self.connect_to_server)
-        self.connect_btn.grid(row=2, column=0, columnspan=2, pady=10)
-        
-        self.status_label = ttk.Label(conn_control, text="Status: Disconnected", foreground="red")
-        self.status_label.grid(row=3, column=0, columnspan=2, pady=5)
-        
-    def setup_chat_tab(self):
-        self.chat_frame = ttk.Frame(self.notebook)
-        self.notebook.add(self.chat_frame, text="Chat")
-        
-        # Chat display
-        self.chat_display = scrolledtext.ScrolledText(
-            self.chat_frame, 
-            height=20, 
-            state='disabled',
-            wrap='word'
-        )
-        self.chat_display.pack(fill='both', expand=True, padx=10, pady=10)
-        
-        # Message input
-        input_frame = ttk.Frame(self.chat_frame)
-        input_frame.pack(fill='x', padx=10, pady=(0, 10))
-        
-        self.message_entry = ttk.Entry(input_frame)
-        self.message_entry.pack(side='left', fill='x', expand=True, padx=(0, 5))
-        self.message_entry.bind('<Return>', self.send_message)
-        
-        self.send_btn = ttk.Button(input_frame, text="Send", command=self.send_message)
-        self.send_btn.pack(side='right')
-        
-    def setup_screen_tab(self):
-        self.screen_frame = ttk.Frame(self.notebook)
-        self.notebook.add(self.screen_frame, text="Screen Share")
-        
-        # Control buttons
-        control_frame = ttk.Frame(self.screen_frame)
-        control_frame.pack(fill='x', padx=10, pady=10)
-        
-        self.share_btn = ttk.Button(
-            control_frame, 
-            text="Start Sharing Screen", 
-            command=self.toggle_screen_share
-        )
-        self.share_btn.pack(side='left', padx=(0, 5))
-        
-        self.receive_btn = ttk.Button(
-            control_frame, 
-            text="Start Receiving Screen", 
-            command=self.toggle_screen_receive
-        )
-        self.receive_btn.pack(side='left')
-        
-        # Screen display
-        self.screen_label = ttk.Label(self.screen_frame, text="Screen sharing not active")
-        self.screen_label.pack(fill='both', expand=True, padx=10, pady=10)
-        
-    def connect_to_server(self):
-        self.username = self.username_entry.get().strip()
-        self.host = self.host_entry.get().strip()
-        
-        if not self.username:
-            messagebox.showerror("Error", "Please enter a username")
-            return
-            
-        try:
-            # Connect to chat server
-            self.chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.chat_socket.connect((self.host, self.chat_port))
-            self.chat_socket.send(self.username.encode('utf-8'))
-            
-            # Start receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
-            self.status_label.config(text="Status: Connected", foreground="green")
-            self.connect_btn.config(text="Disconnect", command=self.disconnect_from_server)
-            
-            self.display_message("🟢 Connected to server!")
-            
-        except Exception as e:
-            messagebox.showerror("Connection Error", f"Failed to connect: {e}")
-            
-    def disconnect_from_server(self):
-        self.running = False
-        
-        if self.chat_socket:
-            self.chat_socket.close()
-            
-        if self.screen_socket:
-            self.screen_socket.close()
-            
-        self.sharing_screen = False
-        self.receiving_screen = False
-        
-        self.status_label.config(text="Status: Disconnected", foreground="red")
-        self.connect_btn.config(text="Connect", command=self.connect_to_server)
-        self.share_btn.config(text="Start Sharing Screen")
-        self.receive_btn.config(text="Start Receiving Screen")
-        
-        self.display_message("🔴 Disconnected from server!")
-        
-    def receive_messages(self):
-        while self.running:
-            try:
-                message = self.chat_socket.recv(1024).decode('utf-8')
-                if message:
-                    self.display_message(message)
-            except:
-                break
-                
-    def display_message(self, message):
-        self.chat_display.config(state='normal')
-        self.chat_display.insert('end', message + '\n')
-        self.chat_display.config(state='disabled')
-        self.chat_display.see('end')
-        
-    def send_message(self, event=None):
-        message = self.message_entry.get().strip()
-        if message and self.chat_socket:
-            try:
-                self.chat_socket.send(message.encode('utf-8'))
-                self.message_entry.delete(0, 'end')
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send message: {e}")
-                
-    def toggle_screen_share(self):
-        if not self.sharing_screen:
-            self.start_screen_share()
-        else:
-            self.stop_screen_share()
-            
-    def start_screen_share(self):
-        try:
-            self.screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.screen_socket.connect((self.host, self.screen_port))
-            self.screen_socket.send("SENDER".encode('utf-8'))
-            
-            self.sharing_screen = True
-            self.share_btn.config(text="Stop Sharing Screen")
-            
-            # Start screen capture thread
-            share_thread = threading.Thread(target=self.capture_and_send_screen)
-            share_thread.daemon = True
-            share_thread.start()
-            
-            self.display_message("🖥️ Started sharing screen")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to start screen sharing: {e}")
-            
-    def stop_screen_share(self):
-        self.sharing_screen = False
-        if self.screen_socket:
-            self.screen_socket.close()
-        self.share_btn.config(text="Start Sharing Screen")
-        self.display_message("🛑 Stopped sharing screen")
-        
-    def capture_and_send_screen(self):
-        while self.sharing_screen and self.running:
-            try:
-                # Capture screen
-                screenshot = pyautogui.screenshot()
-                frame = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-                
-                # Resize frame for better performance
-                frame = cv2.resize(frame, (800, 600))
-                
-                # Encode frame
-                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 50]
-                result, frame_encoded = cv2.imencode('.jpg', frame, encode_param)
-                data = pickle.dumps(frame_encoded)
-                
-                # Send frame size then frame data
-                message_size = struct.pack("Q", len(data))
-                self.screen_socket.sendall(message_size + data)
-                
-                time.sleep(0.1)  # Control frame rate
-                
-            except Exception as e:
-                print(f"Error capturing screen: {e}")
-                break
-                
-    def toggle_screen_receive(self):
-        if not self.receiving_screen:
-            self.start_screen_receive()
-        else:
-            self.stop_screen_receive()
-            
-    def start_screen_receive(self):
-        try:
-            self.screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.screen_socket.connect((self.host, self.screen_port))
-            self.screen_socket.send("RECEIVER".encode('utf-8'))
-            
-            self.receiving_screen = True
-            self.receive_btn.config(text="Stop Receiving Screen")
-            
-            # Start screen receive thread
-            receive_thread = threading.Thread(target=self.receive_and_display_screen)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
-            self.display_message("📺 Started receiving screen")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to start screen receiving: {e}")
-            
-    def stop_screen_receive(self):
-        self.receiving_screen = False
-        if self.screen_socket:
-            self.screen_socket.close()
-        self.receive_btn.config(text="Start Receiving Screen")
-        self.screen_label.config(image='', text="Screen sharing not active")
-        self.display_message("🛑 Stopped receiving screen")
-        
-    def receive_and_display_screen(self):
-        while self.receiving_screen and self.running:
-            try:
-                # Receive frame size
-                data = b""
-                payload_size = struct.calcsize("Q")
-                
-                while len(data) < payload_size:
-                    packet = self.screen_socket.recv(4*1024)
-                    if not packet:
-                        return
-                    data += packet
-                
-                packed_msg_size = data[:payload_size]
-                data = data[payload_size:]
-                msg_size = struct.unpack("Q", packed_msg_size)[0]
-                
-                # Receive frame data
-                while len(data) < msg_size:
-                    data += self.screen_socket.recv(4*1024)
-                
-                frame_data = data[:msg_size]
-                
-                # Decode and display frame
-                frame_encoded = pickle.loads(frame_data)
-                frame = cv2.imdecode(frame_encoded, cv2.IMREAD_COLOR)
-                
-                # Convert to display format
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame_pil = Image.fromarray(frame_rgb)
-                frame_tk = ImageTk.PhotoImage(frame_pil)
-                
-                # Update display
-                self.screen_label.config(image=frame_tk, text="")
-                self.screen_label.image = frame_tk  # Keep reference
-                
-            except Exception as e:
-                print(f"Error receiving screen: {e}")
-                break
-                
-    def on_closing(self):
-        self.running = False
-        self.disconnect_from_server()
-        self.root.destroy()
-        
-    def run(self):
-        self.root.mainloop()
-
-if __name__ == "__main__":
-    client = ChatScreenClient()
+import argparse
+import queue
+import tkinter as tk
+from tkinter import ttk, scrolledtext, messagebox
+
+from ClientCore import (CHAT_PORT, CONNECTION_STATUS, DEFAULT_HOST, SCREEN_PORT, ChatSession, ScreenReceiver,
+                        ScreenSender)
+from Protocol import CODEC_FAMILIES, DEFAULT_CODEC, DEFAULT_ROOM, format_chat_record
+
+# How often the Tk main loop checks for queued updates and a new picture,
+# in milliseconds
+POLL_INTERVAL = 10
+
+class ChatScreenClient:
+    # Tkinter view over the headless client in ClientCore.py. Connections,
+    # capture and decoding live there; this class only turns widget events
+    # into calls on the chat session and screen sender/receiver, and their
+    # events back into widget updates. PIL is imported when the first
+    # picture is painted. impairment holds LossInjector arguments to test
+    # received datagrams under simulated loss and delay.
+    def __init__(self, capture_backend='auto', capture_region=None, capture_window=None,
+                 output_size=None, codec=DEFAULT_CODEC, transport='tcp', impairment=None):
+        self.host = DEFAULT_HOST
+        self.chat_port = CHAT_PORT
+        self.screen_port = SCREEN_PORT
+        self.username = ""
+        self.room = DEFAULT_ROOM
+        self.chat = None
+        self.sender = None
+        self.receiver = None
+        self.target_fps = None
+        self.capture_backend = capture_backend
+        self.capture_region = capture_region
+        self.capture_window = capture_window
+        self.output_size = output_size
+        self.codec = codec
+        self.transport = transport
+        self.impairment = impairment
+        self.screen_photo = None
+        
+        # Widgets are only touched from the Tk thread; other threads queue
+        # (function, args) calls here for poll_ui to run
+        self.ui_calls = queue.SimpleQueue()
+        
+        # GUI Setup
+        self.setup_gui()
+        
+    def setup_gui(self):
+        self.root = tk.Tk()
+        self.root.title("Chat & Screen Share")
+        self.root.geometry("800x600")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        
+        # Create notebook for tabs
+        self.notebook = ttk.Notebook(self.root)
+        self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        # Chat Tab
+        self.setup_chat_tab()
+        
+        # Screen Share Tab
+        self.setup_screen_tab()
+        
+        # Connection Tab
+        self.setup_connection_tab()
+        
+        self.root.after(POLL_INTERVAL, self.poll_ui)
+        
+    def setup_connection_tab(self):
+        self.conn_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.conn_frame, text="Connection")
+        
+        # Connection controls
+        conn_control = ttk.LabelFrame(self.conn_frame, text="Server Connection")
+        conn_control.pack(fill='x', padx=10, pady=10)
+        
+        ttk.Label(conn_control, text="Username:").grid(row=0, column=0, sticky='w', padx=5, pady=5)
+        self.username_entry = ttk.Entry(conn_control, width=20)
+        self.username_entry.grid(row=0, column=1, padx=5, pady=5)
+        
+        ttk.Label(conn_control, text="Server IP:").grid(row=1, column=0, sticky='w', padx=5, pady=5)
+        self.host_entry = ttk.Entry(conn_control, width=20)
+        self.host_entry.insert(0, "localhost")
+        self.host_entry.grid(row=1, column=1, padx=5, pady=5)
+        
+        ttk.Label(conn_control, text="Room:").grid(row=2, column=0, sticky='w', padx=5, pady=5)
+        self.room_entry = ttk.Entry(conn_control, width=20)
+        self.room_entry.insert(0, DEFAULT_ROOM)
+        self.room_entry.grid(row=2, column=1, padx=5, pady=5)
+        
+        self.connect_btn = ttk.Button(conn_control, text="Connect", command=self.connect_to_server)
+        self.connect_btn.grid(row=3, column=0, columnspan=2, pady=10)
+        
+        self.status_label = ttk.Label(conn_control, text="Status: Disconnected", foreground="red")
+        self.status_label.grid(row=4, column=0, columnspan=2, pady=5)
+        
+    def setup_chat_tab(self):
+        self.chat_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.chat_frame, text="Chat")
+        
+        # Chat display
+        self.chat_display = scrolledtext.ScrolledText(
+            self.chat_frame, 
+            height=20, 
+            state='disabled',
+            wrap='word'
+        )
+        self.chat_display.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        # Message input
+        input_frame = ttk.Frame(self.chat_frame)
+        input_frame.pack(fill='x', padx=10, pady=(0, 10))
+        
+        self.message_entry = ttk.Entry(input_frame)
+        self.message_entry.pack(side='left', fill='x', expand=True, padx=(0, 5))
+        self.message_entry.bind('<Return>', self.send_message)
+        
+        self.send_btn = ttk.Button(input_frame, text="Send", command=self.send_message)
+        self.send_btn.pack(side='right')
+        
+        self.history_btn = ttk.Button(input_frame, text="Load Older", command=self.request_history)
+        self.history_btn.pack(side='right', padx=(0, 5))
+        
+    def setup_screen_tab(self):
+        self.screen_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.screen_frame, text="Screen Share")
+        
+        # Control buttons
+        control_frame = ttk.Frame(self.screen_frame)
+        control_frame.pack(fill='x', padx=10, pady=10)
+        
+        self.share_btn = ttk.Button(
+            control_frame, 
+            text="Start Sharing Screen", 
+            command=self.toggle_screen_share
+        )
+        self.share_btn.pack(side='left', padx=(0, 5))
+        
+        self.receive_btn = ttk.Button(
+            control_frame, 
+            text="Start Receiving Screen", 
+            command=self.toggle_screen_receive
+        )
+        self.receive_btn.pack(side='left')
+        
+        # Leave empty to watch whoever is presenting in the room
+        self.presenter_entry = ttk.Entry(control_frame, width=15)
+        self.presenter_entry.pack(side='right')
+        ttk.Label(control_frame, text="Presenter:").pack(side='right', padx=(0, 5))
+        
+        # Display frame rate and capture-to-screen latency while receiving
+        self.screen_stats_label = ttk.Label(control_frame, text="")
+        self.screen_stats_label.pack(side='left', padx=(10, 0))
+        
+        # Screen display
+        self.screen_label = ttk.Label(self.screen_frame, text="Screen sharing not active")
+        self.screen_label.pack(fill='both', expand=True, padx=10, pady=10)
+        
+    def connect_to_server(self):
+        self.username = self.username_entry.get().strip()
+        self.host = self.host_entry.get().strip()
+        self.room = self.room_entry.get().strip() or DEFAULT_ROOM
+        
+        if not self.username:
+            messagebox.showerror("Error", "Please enter a username")
+            return
+            
+        try:
+            # Connect to chat server; records arrive on the session's thread
+            chat = ChatSession(self.username, self.room, self.host, self.chat_port)
+            chat.records.subscribe(self.on_chat_record)
+            chat.status.subscribe(self.on_connection_status)
+            self.chat = chat.connect()
+            
+            self.status_label.config(text=f"Status: Connected to #{self.room}", foreground="green")
+            self.connect_btn.config(text="Disconnect", command=self.disconnect_from_server)
+            
+            self.display_message(f"🟢 Connected to server! (room #{self.room})")
+            
+        except Exception as e:
+            messagebox.showerror("Connection Error", f"Failed to connect: {e}")
+            
+    def disconnect_from_server(self):
+        if self.chat:
+            self.chat.close()
+            self.chat = None
+            
+        if self.sender:
+            self.stop_screen_share()
+            
+        if self.receiver:
+            self.stop_screen_receive()
+        
+        self.status_label.config(text="Status: Disconnected", foreground="red")
+        self.connect_btn.config(text="Connect", command=self.connect_to_server)
+        
+        self.display_message("🔴 Disconnected from server!")
+        
+    def on_chat_record(self, record):
+        # Chat session thread; None once the connection closed
+        if record is None:
+            return
+        if record.get('type') == 'history':
+            self.display_history(record.get('messages', []))
+        else:
+            self.display_message(format_chat_record(record))
+                
+    def on_connection_status(self, status):
+        # Any connection's thread, while it reconnects on its own
+        if status is not None:
+            self.display_message(CONNECTION_STATUS[status])
+                
+    def poll_ui(self):
+        # Runs on the Tk thread: applies queued widget updates and paints the
+        # newest decoded screen frame, if any
+        while True:
+            try:
+                function, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            function(*args)
+        
+        if self.receiver and self.receiver.viewer:
+            self.show_screen(self.receiver.viewer)
+        self.root.after(POLL_INTERVAL, self.poll_ui)
+        
+    def display_message(self, message):
+        # Safe to call from any thread
+        self.ui_calls.put((self.append_message, (message,)))
+        
+    def append_message(self, message):
+        self.chat_display.config(state='normal')
+        self.chat_display.insert('end', message + '\n')
+        self.chat_display.config(state='disabled')
+        self.chat_display.see('end')
+        
+    def display_history(self, messages):
+        self.ui_calls.put((self.prepend_history, (messages,)))
+        
+    def prepend_history(self, messages):
+        # Older messages go above everything shown so far
+        if not messages:
+            self.display_message("📜 No older messages")
+            return
+        lines = "".join(format_chat_record(message) + '\n' for message in messages)
+        self.chat_display.config(state='normal')
+        self.chat_display.insert('1.0', lines)
+        self.chat_display.config(state='disabled')
+        
+    def request_history(self):
+        if self.chat:
+            try:
+                self.chat.request_history()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load history: {e}")
+                
+    def send_message(self, event=None):
+        message = self.message_entry.get().strip()
+        if message and self.chat:
+            try:
+                self.chat.send(message)
+                self.message_entry.delete(0, 'end')
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to send message: {e}")
+                
+    def toggle_screen_share(self):
+        if not self.sender:
+            self.start_screen_share()
+        else:
+            self.stop_screen_share()
+            
+    def start_screen_share(self):
+        try:
+            # Capture, encode and send run as pipelined stages in the
+            # sender; quality, resolution and frame rate follow the server's
+            # reports on how the receivers are keeping up
+            sender = ScreenSender(
+                self.username, self.room, self.host, self.screen_port,
+                self.capture_backend, self.capture_region, self.capture_window,
+                self.output_size, self.target_fps, self.codec
+            )
+            sender.status.subscribe(self.on_connection_status)
+            self.sender = sender.start()
+            
+            self.share_btn.config(text="Stop Sharing Screen")
+            self.display_message(f"🖥️ Started sharing screen ({self.sender.codec})")
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start screen sharing: {e}")
+            
+    def stop_screen_share(self):
+        self.sender.stop()
+        self.sender = None
+        self.share_btn.config(text="Start Sharing Screen")
+        self.display_message("🛑 Stopped sharing screen")
+        
+    def toggle_screen_receive(self):
+        if not self.receiver:
+            self.start_screen_receive()
+        else:
+            self.stop_screen_receive()
+            
+    def start_screen_receive(self):
+        try:
+            # The receiver's thread reads frames and sends feedback, its
+            # viewer decodes them, and poll_ui paints the newest picture
+            injector = None
+            if self.impairment:
+                from Datagram import LossInjector
+                injector = LossInjector(**self.impairment)
+            receiver = ScreenReceiver(
+                self.room, self.host, self.screen_port, self.presenter_entry.get().strip(),
+                transport=self.transport, injector=injector
+            )
+            receiver.status.subscribe(self.on_connection_status)
+            self.receiver = receiver.start()
+            
+            self.receive_btn.config(text="Stop Receiving Screen")
+            self.display_message(f"📺 Started receiving screen ({self.receiver.transport})")
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start screen receiving: {e}")
+            
+    def stop_screen_receive(self):
+        self.receiver.stop()
+        self.receiver = None
+        self.receive_btn.config(text="Start Receiving Screen")
+        self.screen_label.config(image='', text="Screen sharing not active")
+        self.screen_stats_label.config(text="")
+        self.screen_photo = None
+        self.display_message("🛑 Stopped receiving screen")
+        
+    def show_screen(self, viewer):
+        # Paints into the existing PhotoImage unless the frame size changed
+        from PIL import Image, ImageTk
+        
+        item = viewer.take()
+        if item is None:
+            return
+        rgb, timestamp = item
+        height, width = rgb.shape[:2]
+        image = Image.frombuffer('RGB', (width, height), rgb, 'raw', 'RGB', 0, 1)
+        if self.screen_photo is None or (self.screen_photo.width(), self.screen_photo.height()) != (width, height):
+            self.screen_photo = ImageTk.PhotoImage(image)
+            self.screen_label.config(image=self.screen_photo, text="")
+        else:
+            self.screen_photo.paste(image)
+        
+        if viewer.shown(rgb, timestamp):
+            self.screen_stats_label.config(
+                text=f"{viewer.fps:.1f} fps, {viewer.latency * 1000:.0f} ms latency"
+            )
+        
+    def on_closing(self):
+        self.disconnect_from_server()
+        self.root.destroy()
+        
+    def run(self):
+        self.root.mainloop()
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat & screen sharing client")
+    parser.add_argument('--capture', default='auto', choices=['auto', 'xshm', 'pyautogui', 'synthetic'],
+                        help="screen capture backend")
+    parser.add_argument('--region', type=lambda value: tuple(int(v) for v in value.split(',')),
+                        help="share only LEFT,TOP,WIDTH,HEIGHT of the screen")
+    parser.add_argument('--window', type=lambda value: int(value, 0), help="share only this X11 window id")
+    parser.add_argument('--max-size', type=parse_size,
+                        help="scale shared frames to fit WIDTHxHEIGHT, keeping the aspect ratio "
+                             "(default 800x600)")
+    parser.add_argument('--codec', default=DEFAULT_CODEC, choices=['auto', *CODEC_FAMILIES],
+                        help="codec for the shared screen; h264 and vp8 need PyAV, and the server falls back "
+                             "to jpeg if a viewer cannot decode them (auto: best available)")
+    parser.add_argument('--transport', default='tcp', choices=['tcp', 'udp'],
+                        help="receive screens as UDP datagrams if the server offers them (server --udp)")
+    parser.add_argument('--simulate-loss', type=float, default=0.0, metavar='PERCENT',
+                        help="drop this share of received screen datagrams, for testing")
+    parser.add_argument('--simulate-delay', type=float, default=0.0, metavar='MS',
+                        help="delay received screen datagrams, for testing")
+    parser.add_argument('--simulate-jitter', type=float, default=0.0, metavar='MS',
+                        help="add up to this much random delay to received screen datagrams, for testing")
+    args = parser.parse_args()
+    
+    impairment = None
+    if args.simulate_loss or args.simulate_delay or args.simulate_jitter:
+        impairment = {'loss': args.simulate_loss / 100, 'delay': args.simulate_delay / 1000,
+                      'jitter': args.simulate_jitter / 1000}
+    client = ChatScreenClient(args.capture, args.region, args.window, args.max_size, args.codec,
+                              args.transport, impairment)
     client.run()
\ No newline at end of file
@@ -0,0 +1,632 @@
+import argparse
+import random
+import socket
+import sys
+import threading
+import time
+
+from Framing import FrameReader, send_buffers
+from Protocol import (CODEC_FAMILIES, DEFAULT_CODEC, DEFAULT_ROOM, FRAME_HEADER, VIDEO_CODECS, ProtocolError,
+                      chat_hello, format_chat_record, format_codecs, pack_chat_record, pack_datagram_ready,
+                      pack_feedback, pack_keyframe_request, read_chat_record, read_control, read_hello_reply,
+                      read_screen_frame, screen_hello)
+
+# Headless client: a chat session, a screen sender and a screen receiver,
+# each with its own connection and threads and no GUI. Bots, recorders and
+# load tests use them directly and Client.py is a Tkinter view on top.
+# Only the standard library is imported up front; capture, encoding and
+# decoding (cv2, numpy, pyautogui, PyAV) are imported when screen sharing
+# or receiving starts, so a chat-only client never loads them.
+
+DEFAULT_HOST = 'localhost'
+CHAT_PORT = 9999
+SCREEN_PORT = 9998
+
+# Reconnect attempts back off exponentially between these delays, in
+# seconds
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 10.0
+
+# A receiver losing frames sent as datagrams asks the server for the
+# current picture at most this often, in seconds
+RESYNC_INTERVAL = 0.5
+
+# Message sequence numbers a chat session remembers to drop duplicates
+SEEN_MESSAGES = 1000
+
+# What a front end shows for each `status` event of a connection
+CONNECTION_STATUS = {
+    'reconnecting': "🟡 Connection lost, reconnecting...",
+    'resumed': "🟢 Reconnected, session resumed",
+    'reconnected': "🟢 Reconnected",
+}
+
+
+class Events:
+    # Delivers events from a client's network thread. Callbacks run on that
+    # thread and get None once the connection closes; `async for event in
+    # events` receives them on the caller's event loop instead and ends
+    # there.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.closed = False
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def emit(self, event):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Error in event callback: {e}")
+
+    def close(self):
+        # Async iterators see None and stop
+        with self.lock:
+            self.closed = True
+        self.emit(None)
+
+    async def __aiter__(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def forward(event):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        with self.lock:
+            if self.closed:
+                return
+            self.callbacks.append(forward)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.unsubscribe(forward)
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def close_socket(sock):
+    # Shutting down first wakes a thread blocked reading the socket, which
+    # close() alone does not
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def reconnect(connect, should_continue, status):
+    # Calls connect() until it succeeds, waiting RECONNECT_DELAY seconds
+    # after the first failure and twice as long after each further one, up
+    # to MAX_RECONNECT_DELAY. The jitter keeps clients dropped by the same
+    # outage from all coming back at once. False if should_continue()
+    # turned False first.
+    status.emit('reconnecting')
+    delay = RECONNECT_DELAY
+    while should_continue():
+        try:
+            connect()
+            return True
+        except (OSError, ProtocolError):
+            pass
+        time.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+    return False
+
+
+class ChatSession:
+    # One user in one room. Every chat record from the server is emitted on
+    # `records` as a dict ('join', 'leave', 'message', or 'history' with
+    # the logged 'messages'); format_chat_record() turns one into the line
+    # a chat window shows. When the connection breaks the session
+    # reconnects and resumes with its token: nobody sees the user leave,
+    # and the messages it missed arrive as if nothing happened. Messages
+    # sent meanwhile go out once it is back. `status` emits 'reconnecting'
+    # and then 'resumed', or 'reconnected' when the server had already
+    # given the session up and the user joined afresh.
+    def __init__(self, username, room=DEFAULT_ROOM, host=DEFAULT_HOST, port=CHAT_PORT):
+        self.username = username
+        self.room = room or DEFAULT_ROOM
+        self.host = host
+        self.port = port
+        self.records = Events()
+        self.status = Events()
+        self.sock = None
+        self.reader = None
+        self.proto = None
+        self.token = None
+        self.resumed = False
+        self.closed = False
+        self.oldest_seq = None
+        self.last_seq = 0
+        self.seen = {}
+        self.unsent = []
+        self.send_lock = threading.Lock()
+
+    def connect(self):
+        self.open()
+        start_thread(self.run)
+        return self
+
+    def open(self):
+        options = {'room': self.room}
+        if self.token:
+            options.update(resume=self.token, since=self.last_seq)
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(chat_hello(self.username, **options))
+            reader = FrameReader(sock)
+            reply = read_hello_reply(reader)
+        except:
+            sock.close()
+            raise
+        self.proto = int(reply['proto'])
+        self.token = reply.get('session')
+        self.resumed = reply.get('resumed') == '1'
+        with self.send_lock:
+            self.sock, self.reader = sock, reader
+            unsent, self.unsent = self.unsent, []
+        for data in unsent:
+            self.write(data)
+
+    def run(self):
+        while True:
+            self.receive()
+            if self.closed or not reconnect(self.open, lambda: not self.closed, self.status):
+                break
+            self.status.emit('resumed' if self.resumed else 'reconnected')
+        self.records.close()
+        self.status.close()
+
+    def receive(self):
+        try:
+            while True:
+                record = read_chat_record(self.reader, self.proto)
+                if record is None:
+                    break
+                if self.track(record):
+                    self.records.emit(record)
+        except Exception as e:
+            if not self.closed:
+                print(f"Error receiving chat: {e}")
+
+    def track(self, record):
+        # Keeps the sequence numbers that history paging and resuming rely
+        # on; False for a message already received, which a resume can
+        # deliver twice
+        if record.get('type') == 'history':
+            messages = record.get('messages', [])
+            if messages:
+                self.oldest_seq = messages[0].get('seq', self.oldest_seq)
+                self.last_seq = max(self.last_seq, messages[-1].get('seq') or 0)
+            return True
+
+        seq = record.get('seq')
+        if seq is None:
+            return True
+        if seq in self.seen:
+            return False
+        self.seen[seq] = None
+        if len(self.seen) > SEEN_MESSAGES:
+            del self.seen[next(iter(self.seen))]
+        self.last_seq = max(self.last_seq, seq)
+        if self.oldest_seq is None:
+            self.oldest_seq = seq
+        return True
+
+    def send(self, text):
+        self.write(pack_chat_record({'type': 'message', 'text': text}))
+
+    def request_history(self):
+        # Asks for the page of messages before the oldest one seen; False
+        # if there is nothing older to ask for
+        if not self.oldest_seq:
+            return False
+        self.write(pack_chat_record({'type': 'history', 'before': self.oldest_seq}))
+        return True
+
+    def write(self, data):
+        # Kept for after the reconnect if the connection is down; the
+        # receiving thread notices and reconnects
+        with self.send_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                if self.closed:
+                    raise
+                self.unsent.append(data)
+                close_socket(self.sock)
+
+    def close(self):
+        self.closed = True
+        close_socket(self.sock)
+
+
+class ScreenConnection:
+    # A screen connection in a room, with binary framing negotiated.
+    # `reply` holds the options of the server's handshake reply. A broken
+    # connection is reestablished with reconnect(); `status` emits as for
+    # ChatSession.
+    def __init__(self, room=DEFAULT_ROOM, host=DEFAULT_HOST, port=SCREEN_PORT):
+        self.room = room or DEFAULT_ROOM
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.reader = None
+        self.proto = None
+        self.reply = {}
+        self.token = None
+        self.status = Events()
+        self.running = False
+
+    def connect(self, role, **options):
+        # Presenters come back with the session token of their stream
+        if self.token:
+            options['resume'] = self.token
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(screen_hello(role, room=self.room, **options))
+            reader = FrameReader(sock)
+            reply = read_hello_reply(reader)
+        except:
+            sock.close()
+            raise
+        self.sock, self.reader, self.reply = sock, reader, reply
+        self.proto = int(reply['proto'])
+        self.token = reply.get('session')
+        self.running = True
+
+    def reconnect(self, role, **options):
+        if not reconnect(lambda: self.connect(role, **options), lambda: self.running, self.status):
+            return False
+        self.status.emit('resumed' if self.reply.get('resumed') == '1' else 'reconnected')
+        return True
+
+    def stop(self):
+        self.running = False
+        close_socket(self.sock)
+
+
+class ScreenSender(ScreenConnection):
+    # Presents a screen in a room: capture, tile encoding and sending run
+    # as a ScreenSharePipeline, and quality, resolution and frame rate
+    # follow the server's reports. `settings` emits (quality, scale, fps)
+    # whenever they change. Without an output_size frames are scaled to fit
+    # DEFAULT_OUTPUT_SIZE. codec is 'jpeg', a video codec ('h264', 'vp8')
+    # or 'auto' for the best one available; the server may still settle on
+    # JPEG, and `codec` holds its choice once connected. Capture carries on
+    # while the connection is down; a resumed presenter keeps its place in
+    # the room and continues with a keyframe.
+    def __init__(self, name, room=DEFAULT_ROOM, host=DEFAULT_HOST, port=SCREEN_PORT, capture_backend='auto',
+                 capture_region=None, capture_window=None, output_size=None, target_fps=None,
+                 codec=DEFAULT_CODEC):
+        super().__init__(room, host, port)
+        self.name = name
+        self.codec = codec
+        self.capture_backend = capture_backend
+        self.capture_region = capture_region
+        self.capture_window = capture_window
+        self.output_size = output_size
+        self.target_fps = target_fps
+        self.settings = Events()
+        self.rate_controller = None
+
+    def start(self):
+        from Capture import DEFAULT_OUTPUT_SIZE, create_backend
+        from Pipeline import DEFAULT_FPS
+
+        # The capture backend is opened first, so a missing display fails
+        # here rather than after the server announced a presenter
+        if self.output_size is None:
+            self.output_size = DEFAULT_OUTPUT_SIZE
+        if self.target_fps is None:
+            self.target_fps = DEFAULT_FPS
+        grabber = create_backend(
+            self.capture_backend, region=self.capture_region,
+            window=self.capture_window, output_size=self.output_size
+        )
+        try:
+            self.present()
+        except:
+            grabber.close()
+            raise
+        start_thread(self.capture_and_send, grabber)
+        return self
+
+    def present(self, reconnecting=False):
+        # Offers the codecs to choose from: at first those asked for, after
+        # a reconnect only the one in use (or JPEG), so an encoder switch
+        # is never more than a fallback
+        from Codecs import encodable_codecs
+
+        options = {'name': self.name, 'codecs': format_codecs(encodable_codecs(self.codec))}
+        if not reconnecting:
+            self.connect("SENDER", **options)
+        elif not self.reconnect("SENDER", **options):
+            return False
+        self.codec = self.reply.get('codec', DEFAULT_CODEC)
+        return True
+
+    def capture_and_send(self, grabber):
+        from Codecs import create_encoder
+        from Pipeline import ScreenSharePipeline
+        from RateControl import AdaptiveController
+
+        encoder = create_encoder(self.codec, quality=50, target_fps=self.target_fps)
+        pipeline = ScreenSharePipeline(grabber.grab, self.send_frame, encoder, target_fps=self.target_fps)
+
+        def apply_settings(quality, scale, fps):
+            pipeline.encoder.quality = quality
+            pipeline.scheduler.target_fps = fps
+            if self.output_size is not None:
+                width, height = self.output_size
+                grabber.output_size = (int(width * scale), int(height * scale))
+            self.settings.emit((quality, scale, fps))
+
+        self.rate_controller = AdaptiveController(self.target_fps, on_change=apply_settings)
+        apply_settings(*self.rate_controller.settings)
+        start_thread(self.receive_reports, self.rate_controller, pipeline)
+
+        try:
+            pipeline.run(lambda: self.running)
+        except Exception as e:
+            if self.running:
+                print(f"Error capturing screen: {e}")
+        finally:
+            grabber.close()
+            self.settings.close()
+
+    def send_frame(self, screen_frame):
+        # Frames captured while the connection is down are dropped
+        sock = self.sock
+        try:
+            send_buffers(sock, screen_frame.buffers(self.proto))
+        except OSError:
+            # Wakes receive_reports, which reconnects
+            close_socket(sock)
+            return
+        self.rate_controller.on_frame_sent(screen_frame.seq)
+
+    def receive_reports(self, controller, pipeline):
+        # Feedback reports, and keyframe requests when a video receiver
+        # joined or lost frames. When the connection breaks this thread
+        # reconnects.
+        from Codecs import create_encoder
+
+        while self.running:
+            try:
+                while True:
+                    control = read_control(self.reader)
+                    if control is None:
+                        break
+                    kind, report = control
+                    if kind == 'keyframe':
+                        pipeline.encoder.request_keyframe()
+                    else:
+                        controller.on_report(report)
+            except:
+                pass
+
+            codec = self.codec
+            if not self.running or not self.present(reconnecting=True):
+                break
+            if self.codec != codec:
+                pipeline.encoder = create_encoder(self.codec, pipeline.encoder.quality, self.target_fps)
+            pipeline.encoder.request_keyframe()
+        self.status.close()
+
+
+class ScreenReceiver(ScreenConnection):
+    # Watches a presenter in a room (the active one if presenter is empty).
+    # Every ScreenFrame is emitted on `frames` from the network thread; with
+    # decode=True frames also go to a ScreenViewer whose take() returns the
+    # newest decoded RGB picture. After a reconnect the server brings the
+    # picture up to date again. With transport='udp' frames come as
+    # datagrams (Datagram.py) if the server offers them and they get
+    # through, else over TCP as usual; `transport` tells which is in use.
+    # injector impairs the datagrams received, for tests (LossInjector).
+    def __init__(self, room=DEFAULT_ROOM, host=DEFAULT_HOST, port=SCREEN_PORT, presenter=None, decode=True,
+                 transport='tcp', injector=None):
+        super().__init__(room, host, port)
+        self.presenter = presenter or ""
+        self.decode = decode
+        self.codecs = None
+        self.requested_transport = transport
+        self.transport = 'tcp'
+        self.injector = injector
+        self.datagrams = None
+        self.frames = Events()
+        self.viewer = None
+        self.send_lock = threading.Lock()
+        self.feedback = None
+
+    def start(self):
+        # Without decoding every frame is wanted as it is
+        codecs = list(CODEC_FAMILIES)
+        if self.decode:
+            from Codecs import decodable_codecs
+            codecs = decodable_codecs()
+        self.codecs = format_codecs(codecs)
+        self.connect("RECEIVER", **self.options())
+        if self.decode:
+            from Viewer import ScreenViewer
+            self.viewer = ScreenViewer()
+        self.open_datagrams()
+        start_thread(self.receive)
+        return self
+
+    def options(self):
+        options = {'presenter': self.presenter, 'codecs': self.codecs}
+        if self.requested_transport == 'udp':
+            options['transport'] = 'udp'
+        return options
+
+    def open_datagrams(self):
+        # Switches to datagrams once the server acknowledged the hello of
+        # the UDP socket, and tells it so over TCP
+        from Datagram import DatagramReceiver
+
+        self.transport = 'tcp'
+        self.feedback = [0, 0, time.monotonic()]
+        token = self.reply.get('udp')
+        if not token:
+            return
+        datagrams = DatagramReceiver(self.host, self.port, token, self.injector)
+        if not datagrams.register():
+            print("⚠️  Screen datagrams do not get through, receiving over TCP")
+            datagrams.close()
+            return
+        self.datagrams = datagrams
+        self.transport = 'udp'
+        self.write(pack_datagram_ready())
+        start_thread(self.receive_datagrams, datagrams)
+
+    def close_datagrams(self):
+        datagrams, self.datagrams = self.datagrams, None
+        if datagrams is not None:
+            datagrams.close()
+
+    def receive(self):
+        try:
+            while self.running:
+                self.receive_frames()
+                self.close_datagrams()
+                if not self.running or not self.reconnect("RECEIVER", **self.options()):
+                    break
+                self.open_datagrams()
+        finally:
+            self.close_datagrams()
+            if self.viewer:
+                self.viewer.stop()
+            self.frames.close()
+            self.status.close()
+
+    def receive_frames(self):
+        # This thread only reads frames and sends feedback; decoding runs on
+        # the viewer's worker, so it never holds back socket reads. With
+        # datagrams in use it only waits for the connection to end.
+        try:
+            while self.running:
+                screen_frame = read_screen_frame(self.reader)
+                if screen_frame is None:
+                    break
+                self.handle_frame(screen_frame)
+        except Exception as e:
+            if self.running:
+                print(f"Error receiving screen: {e}")
+
+    def receive_datagrams(self, datagrams):
+        # Frames lost beyond what FEC repairs make the server send the
+        # current picture again, at most every RESYNC_INTERVAL seconds.
+        # Video deltas after a lost frame cannot be decoded and are skipped
+        # until that keyframe.
+        assembler = datagrams.assembler
+        seen_lost = resync_lost = last_resync = 0
+        awaiting_keyframe = False
+        try:
+            while self.running and not datagrams.closed:
+                frames = datagrams.poll()
+                if assembler.lost > seen_lost:
+                    seen_lost = assembler.lost
+                    awaiting_keyframe = True
+                for screen_frame in frames:
+                    if awaiting_keyframe and screen_frame.codec in VIDEO_CODECS and not screen_frame.is_keyframe:
+                        continue
+                    awaiting_keyframe = False
+                    self.handle_frame(screen_frame)
+                now = time.monotonic()
+                if assembler.lost > resync_lost and now - last_resync >= RESYNC_INTERVAL:
+                    resync_lost, last_resync = assembler.lost, now
+                    self.write(pack_keyframe_request())
+        except Exception as e:
+            if self.running and not datagrams.closed:
+                print(f"Error receiving screen datagrams: {e}")
+                close_socket(self.sock)
+
+    def handle_frame(self, screen_frame):
+        # Tell the server how this receiver is keeping up
+        from RateControl import FEEDBACK_INTERVAL
+
+        feedback = self.feedback
+        feedback[0] += 1
+        feedback[1] += FRAME_HEADER.size + len(screen_frame.payload)
+        now = time.monotonic()
+        if now - feedback[2] >= FEEDBACK_INTERVAL:
+            frames, received_bytes, last_feedback = feedback
+            self.feedback = [0, 0, now]
+            self.write(pack_feedback(screen_frame.seq, frames, received_bytes, now - last_feedback, 0.0))
+
+        if self.viewer:
+            self.viewer.receive(screen_frame)
+        self.frames.emit(screen_frame)
+
+    def write(self, data):
+        # Feedback and requests from the TCP and datagram threads
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def stop(self):
+        super().stop()
+        self.close_datagrams()
+
+
+if __name__ == "__main__":
+    # Terminal chat client: lines typed on stdin are sent, the room is
+    # printed as it happens
+    parser = argparse.ArgumentParser(description="Headless chat client")
+    parser.add_argument('username')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--chat-port', type=int, default=CHAT_PORT)
+    parser.add_argument('--room', default=DEFAULT_ROOM)
+    args = parser.parse_args()
+
+    def show(record):
+        if record is None:
+            print("🔴 Disconnected from server!")
+        elif record.get('type') == 'history':
+            for message in record.get('messages', []):
+                print(format_chat_record(message))
+        else:
+            print(format_chat_record(record))
+
+    def show_status(status):
+        if status is not None:
+            print(CONNECTION_STATUS[status])
+
+    session = ChatSession(args.username, args.room, args.host, args.chat_port)
+    session.records.subscribe(show)
+    session.status.subscribe(show_status)
+    session.connect()
+    print(f"🟢 Connected to server! (room #{session.room})")
+    try:
+        for line in sys.stdin:
+            if line.strip():
+                session.send(line.strip())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
@@ -0,0 +1,199 @@
+import time
+from fractions import Fraction
+
+from Protocol import CODEC_H264, CODEC_VP8, DEFAULT_CODEC, FLAG_KEYFRAME, VIDEO_CODECS
+from TileCodec import TileDecoder, TileEncoder
+
+# Inter-frame video next to the JPEG keyframes and tile deltas of
+# TileCodec.py. Video needs PyAV (pip install av), which is imported on
+# first use; without it only 'jpeg' is offered in the handshake. The server
+# never decodes anything, so it does not need PyAV either.
+
+# Handshake name -> (codec id, encoder names to try, decoder name)
+VIDEO = {
+    'h264': (CODEC_H264, ('libx264', 'h264'), 'h264'),
+    'vp8': (CODEC_VP8, ('libvpx', 'vp8'), 'vp8'),
+}
+
+# Offered in this order when the sender leaves the choice to the server
+PREFERENCE = ('h264', 'vp8', DEFAULT_CODEC)
+
+# Keyframes are only needed for viewers that join or lose frames, and the
+# server asks for those, so the regular interval is long
+VIDEO_KEYFRAME_INTERVAL = 300
+
+# Low-latency settings: one packet out per frame in, no B-frames or
+# lookahead, and streams a decoder can pick up at any keyframe
+ENCODER_OPTIONS = {
+    'libx264': {'preset': 'veryfast', 'tune': 'zerolatency', 'repeat-headers': '1'},
+    'libvpx': {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0', 'error-resilient': '1'},
+}
+
+_av = None
+_encoders = {}
+
+
+def load_av():
+    # The PyAV module, or None when it is not installed
+    global _av
+    if _av is None:
+        try:
+            import av
+        except ImportError:
+            _av = False
+        else:
+            _av = av
+    return _av or None
+
+
+def find_encoder(name):
+    # The first FFmpeg encoder available for a video codec, or None
+    if name not in _encoders:
+        _encoders[name] = None
+        av = load_av()
+        for encoder in VIDEO[name][1] if av else ():
+            try:
+                av.codec.Codec(encoder, 'w')
+            except Exception:
+                continue
+            _encoders[name] = encoder
+            break
+    return _encoders[name]
+
+
+def can_decode(name):
+    av = load_av()
+    if av is None:
+        return False
+    try:
+        av.codec.Codec(VIDEO[name][2], 'r')
+        return True
+    except Exception:
+        return False
+
+
+def encodable_codecs(choice='auto'):
+    # The codecs a sender offers: every available one for 'auto', else the
+    # chosen one if available. JPEG always comes last as the fallback.
+    names = PREFERENCE if choice == 'auto' else (choice, DEFAULT_CODEC)
+    offered = [name for name in names if name == DEFAULT_CODEC or find_encoder(name)]
+    return list(dict.fromkeys(offered))
+
+
+def decodable_codecs():
+    return [name for name in PREFERENCE if name == DEFAULT_CODEC or can_decode(name)]
+
+
+def create_encoder(name, quality=50, target_fps=15):
+    if name == DEFAULT_CODEC:
+        return TileEncoder(quality=quality)
+    return VideoEncoder(name, quality, target_fps)
+
+
+class VideoEncoder:
+    # Same interface as TileEncoder, so ScreenSharePipeline drives either.
+    # Inter-frame encoding has to run in frame order, so prepare() encodes
+    # the whole frame itself and leaves no images for the JPEG pool. The
+    # FFmpeg encoder is reopened, starting with a keyframe, when quality or
+    # frame size change.
+    def __init__(self, name, quality=50, target_fps=15, keyframe_interval=VIDEO_KEYFRAME_INTERVAL):
+        self.av = load_av()
+        self.name = name
+        self.codec = VIDEO[name][0]
+        self.encoder = find_encoder(name)
+        if self.encoder is None:
+            raise ValueError(f"no {name} encoder available (is PyAV installed?)")
+        self.quality = quality
+        self.target_fps = target_fps
+        self.keyframe_interval = keyframe_interval
+        self.context = None
+        self.settings = None
+        self.pts = 0
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def open(self, width, height):
+        context = self.av.CodecContext.create(self.encoder, 'w')
+        context.width = width
+        context.height = height
+        context.pix_fmt = 'yuv420p'
+        context.time_base = Fraction(1, 1000)
+        context.framerate = Fraction(round(self.target_fps), 1)
+        context.gop_size = self.keyframe_interval
+        options = dict(ENCODER_OPTIONS.get(self.encoder, {}))
+        if self.codec == CODEC_H264:
+            # Constant quality: a still screen costs almost nothing
+            options['crf'] = str(max(18, min(45, round(45 - self.quality * 0.25))))
+        else:
+            context.bit_rate = int(width * height * self.target_fps * self.quality / 1000)
+        context.options = options
+        context.open()
+        self.context = context
+        self.settings = (self.quality, width, height)
+        self.started = time.monotonic()
+
+    def prepare(self, frame):
+        # 4:2:0 chroma needs even dimensions
+        height, width = frame.shape[:2]
+        frame = frame[:height & ~1, :width & ~1]
+        height, width = frame.shape[:2]
+        if self.context is None or self.settings != (self.quality, width, height):
+            self.open(width, height)
+
+        video_frame = self.av.VideoFrame.from_ndarray(frame, format='bgr24')
+        # Timestamps in ms drive the VP8 rate control; they must increase
+        self.pts = max(self.pts + 1, int((time.monotonic() - self.started) * 1000))
+        video_frame.pts = self.pts
+        if self.keyframe_requested:
+            self.keyframe_requested = False
+            video_frame.pict_type = self.av.video.frame.PictureType.I
+
+        packets = self.context.encode(video_frame)
+        payload = b"".join(bytes(packet) for packet in packets)
+        flags = FLAG_KEYFRAME if any(packet.is_keyframe for packet in packets) else 0
+        return self.codec, flags, [], lambda encoded: payload
+
+    def encode(self, frame):
+        codec, flags, _, assemble = self.prepare(frame)
+        return codec, flags, assemble([])
+
+
+class VideoDecoder:
+    def __init__(self, name):
+        self.av = load_av()
+        self.context = self.av.CodecContext.create(VIDEO[name][2], 'r')
+        self.image = None
+
+    def decode(self, frame):
+        # Returns the current picture, or None until one has been decoded.
+        # An empty packet would flush the decoder for good.
+        if not frame.payload:
+            return self.image
+        try:
+            for decoded in self.context.decode(self.av.Packet(bytes(frame.payload))):
+                self.image = decoded.to_ndarray(format='bgr24')
+        except self.av.FFmpegError as e:
+            print(f"Error decoding video frame {frame.seq}: {e}")
+        return self.image
+
+
+class FrameDecoder:
+    # Decodes frames of every codec into BGR pictures: JPEG keyframes and
+    # tiles through TileDecoder, video through PyAV. A stream may switch
+    # codec at a keyframe, e.g. when its presenter restarts.
+    def __init__(self):
+        self.tiles = TileDecoder()
+        self.video = {}
+
+    def decode(self, frame):
+        if frame.codec not in VIDEO_CODECS:
+            return self.tiles.decode(frame)
+        decoder = self.video.get(frame.codec)
+        if decoder is None:
+            name = next(name for name, (codec, _, _) in VIDEO.items() if codec == frame.codec)
+            if not can_decode(name):
+                return None
+            decoder = self.video[frame.codec] = VideoDecoder(name)
+        return decoder.decode(frame)
@@ -0,0 +1,396 @@
+import heapq
+import random
+import secrets
+import socket
+import struct
+import threading
+import time
+
+from Framing import MAX_FRAME_SIZE
+from Protocol import FRAME_HEADER, PROTO_BINARY, ProtocolError, ScreenFrame, parse_frame_header
+
+# Optional UDP transport for frames from the server to version 2 receivers.
+# Over TCP one lost packet holds back every frame behind it until it is
+# retransmitted; as datagrams, a frame that cannot be completed is skipped
+# and the viewer carries on with the next one. Each frame (version 2 header
+# and payload) is split into packets of at most DATAGRAM_SIZE bytes, with
+# one XOR parity packet per FEC_GROUP packets, so any single loss in a group
+# is repaired without a round trip. The handshake, feedback and everything
+# else stay on the TCP connection, which keeps carrying the frames when
+# datagrams do not get through.
+
+# Payload bytes per packet; with the headers this stays below the usual
+# 1500-byte Ethernet MTU and common tunnel overheads
+DATAGRAM_SIZE = 1200
+
+# Data packets covered by one parity packet. Smaller groups repair more
+# losses at the cost of more parity traffic (1/FEC_GROUP extra).
+FEC_GROUP = 8
+
+# How long a receiver holds a newer complete frame while an older one may
+# still be completed by late packets, in seconds, and how many frames it
+# keeps in reassembly at most. Older incomplete frames are discarded after
+# that, as is an incomplete frame no packet of which came for JITTER_DELAY.
+JITTER_DELAY = 0.05
+MAX_PENDING_FRAMES = 8
+
+# A receiver repeats its hello this often until the server acknowledges it,
+# and stays on TCP if that takes longer than HELLO_TIMEOUT, in seconds
+HELLO_INTERVAL = 0.2
+HELLO_TIMEOUT = 2.0
+
+# Socket receive buffer asked for by receivers: a keyframe arrives as a
+# burst of a hundred packets or more
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+# Datagrams the asyncio server may have queued for sending before frames
+# are dropped, in bytes
+MAX_SEND_BUFFER = 1024 * 1024
+
+# magic, frame number, frame length, packet index, data packets. Packet
+# indexes past the data packets are parity packets, one per group.
+PACKET_HEADER = struct.Struct("!4sIIHH")
+PACKET_MAGIC = b"CSDP"
+
+# A receiver's hello carries the token the server gave it in the TCP
+# handshake reply (udp=...); the server answers each with an ack
+HELLO_MAGIC = b"CSDH"
+ACK_MAGIC = b"CSDA"
+
+
+def pack_hello(token):
+    return HELLO_MAGIC + token.encode('ascii')
+
+
+def xor_parity(chunks, size):
+    # XOR of the chunks, each zero-padded to `size` bytes, the length of the
+    # first and longest one
+    parity = 0
+    for chunk in chunks:
+        parity ^= int.from_bytes(chunk, 'little')
+    return parity.to_bytes(size, 'little')
+
+
+def packetize(number, buffers, size=DATAGRAM_SIZE, group=FEC_GROUP):
+    # The datagrams of frame `number`: its data packets, each group followed
+    # by its parity packet. group=0 sends no parity.
+    data = memoryview(b"".join(buffers))
+    length = len(data)
+    count = max(1, -(-length // size))
+    if count + (-(-count // group) if group else 0) > 0xFFFF:
+        raise ProtocolError(f"frame of {length} bytes is too large for datagrams")
+
+    datagrams = []
+    step = group or count
+    for first in range(0, count, step):
+        chunks = [data[index * size:(index + 1) * size] for index in range(first, min(first + step, count))]
+        for index, chunk in enumerate(chunks, first):
+            datagrams.append(PACKET_HEADER.pack(PACKET_MAGIC, number, length, index, count) + chunk)
+        if group:
+            header = PACKET_HEADER.pack(PACKET_MAGIC, number, length, count + first // group, count)
+            datagrams.append(header + xor_parity(chunks, len(chunks[0])))
+    return datagrams
+
+
+class PartialFrame:
+    # Packets received so far of one frame, and when the last one came
+    def __init__(self, length, count, now):
+        self.length = length
+        self.count = count
+        self.updated = now
+        self.chunks = {}
+        self.parity = {}
+        self.recovered = 0
+
+    def chunk_size(self, index, size):
+        return min(size, self.length - index * size)
+
+    def add(self, index, chunk, size, group):
+        # True once every data packet is there, after repairing the group
+        # of this packet if only one of its packets is missing
+        if index < self.count:
+            if len(chunk) != self.chunk_size(index, size):
+                return False
+            self.chunks.setdefault(index, chunk)
+            first = index - index % group
+        else:
+            first = (index - self.count) * group
+            if first >= self.count or len(chunk) != self.chunk_size(first, size):
+                return False
+            self.parity.setdefault(first, chunk)
+        self.repair(first, size, group)
+        return len(self.chunks) == self.count
+
+    def repair(self, first, size, group):
+        indexes = range(first, min(first + group, self.count))
+        missing = [index for index in indexes if index not in self.chunks]
+        if len(missing) != 1 or first not in self.parity:
+            return False
+        present = [self.chunks[index] for index in indexes if index in self.chunks]
+        chunk = xor_parity(present + [self.parity[first]], len(self.parity[first]))
+        self.chunks[missing[0]] = chunk[:self.chunk_size(missing[0], size)]
+        self.recovered += 1
+        return True
+
+    def frame(self):
+        data = b"".join(self.chunks[index] for index in range(self.count))
+        codec, width, height, seq, timestamp, flags, length = parse_frame_header(data[:FRAME_HEADER.size])
+        if FRAME_HEADER.size + length != len(data):
+            raise ProtocolError("datagram frame length does not match its header")
+        payload = memoryview(data)[FRAME_HEADER.size:]
+        return ScreenFrame(codec, width, height, seq, timestamp, flags, payload)
+
+
+class FrameAssembler:
+    # Reassembles frames from datagrams and hands them out in order. A frame
+    # that completes while an older one is still missing packets waits up to
+    # `delay` seconds for it, and an incomplete frame is given up after
+    # `delay` seconds without a packet of it. As soon as more than
+    # max_pending frames are in reassembly the oldest are given up too, so
+    # every frame that cannot be completed ends up counted in `lost`.
+    def __init__(self, size=DATAGRAM_SIZE, group=FEC_GROUP, delay=JITTER_DELAY, max_pending=MAX_PENDING_FRAMES):
+        self.size = size
+        self.group = group
+        self.delay = delay
+        self.max_pending = max_pending
+        self.next = None
+        self.partial = {}
+        self.complete = {}
+        self.delivered = 0
+        self.recovered = 0
+        self.lost = 0
+
+    def add(self, datagram, now):
+        # Returns the frames ready to be shown, oldest first
+        if len(datagram) < PACKET_HEADER.size or not datagram.startswith(PACKET_MAGIC):
+            return []
+        _, number, length, index, count = PACKET_HEADER.unpack_from(datagram)
+        if self.next is None:
+            self.next = number
+        if number < self.next or number in self.complete:
+            # Packets of frames already complete, handed out or given up
+            return self.flush(now)
+        if not 0 < length <= MAX_FRAME_SIZE + FRAME_HEADER.size or count != -(-length // self.size):
+            return self.flush(now)
+
+        partial = self.partial.get(number)
+        if partial is None:
+            partial = self.partial[number] = PartialFrame(length, count, now)
+        elif (partial.length, partial.count) != (length, count):
+            return self.flush(now)
+        partial.updated = now
+        chunk = memoryview(datagram)[PACKET_HEADER.size:]
+        if partial.add(index, chunk, self.size, self.group):
+            del self.partial[number]
+            self.recovered += partial.recovered
+            try:
+                self.complete[number] = (partial.frame(), now)
+            except ProtocolError:
+                self.lost += 1
+        return self.flush(now)
+
+    def flush(self, now):
+        # Frames that are ready, giving up on older ones that kept them
+        # waiting too long
+        frames = []
+        while self.complete or self.partial:
+            if self.next in self.complete:
+                frame, _ = self.complete.pop(self.next)
+                frames.append(frame)
+                self.delivered += 1
+                self.next += 1
+                continue
+            crowded = len(self.partial) + len(self.complete) > self.max_pending
+            oldest = min(self.complete, default=None)
+            if oldest is not None and (crowded or now - self.complete[oldest][1] >= self.delay):
+                self.skip(oldest)
+                continue
+            # With no newer frame complete, an incomplete frame is given up
+            # once no packet of it came for `delay` seconds
+            first = min(self.partial, default=None)
+            if first is not None and (oldest is None or first < oldest):
+                if crowded or now - self.partial[first].updated >= self.delay:
+                    self.skip(first + 1)
+                    continue
+            break
+        return frames
+
+    def skip(self, number):
+        # Gives up on the frames before `number`
+        for missing in range(self.next, number):
+            self.partial.pop(missing, None)
+        self.lost += number - self.next
+        self.next = number
+
+    def timeout(self, now):
+        # Seconds until flush() may give up on a frame, or None
+        deadlines = [arrived for _, arrived in self.complete.values()]
+        deadlines.extend(partial.updated for partial in self.partial.values())
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) + self.delay - now)
+
+
+class LossInjector:
+    # Simulated network impairment for testing on loopback: drops datagrams
+    # with probability `loss` (in bursts averaging `burst` packets) and
+    # holds the others back for `delay` seconds plus up to `jitter` more,
+    # which also reorders them
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, burst=1.0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.burst = max(1.0, burst)
+        self.random = random.Random(seed)
+        self.losing = False
+        self.queue = []
+        self.count = 0
+        self.dropped = 0
+
+    def push(self, datagram, now):
+        # Two-state model: inside a burst every packet is lost until the
+        # burst ends with probability 1 / burst; the start probability keeps
+        # the overall loss rate at `loss`
+        if self.losing:
+            self.losing = self.random.random() >= 1 / self.burst
+        elif self.loss > 0:
+            start = self.loss / (self.burst * (1 - self.loss)) if self.loss < 1 else 1.0
+            self.losing = self.random.random() < start
+        if self.losing:
+            self.dropped += 1
+            return
+        due = now + self.delay + self.random.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (due, self.count, datagram))
+        self.count += 1
+
+    def pop(self, now):
+        # Datagrams whose delay is over
+        datagrams = []
+        while self.queue and self.queue[0][0] <= now:
+            datagrams.append(heapq.heappop(self.queue)[2])
+        return datagrams
+
+    def timeout(self, now):
+        if not self.queue:
+            return None
+        return max(0.0, self.queue[0][0] - now)
+
+
+class DatagramLink:
+    # The server's datagram path to one receiver: the address its hello came
+    # from, and whether the receiver confirmed over TCP that acks reach it.
+    # Frames are numbered per link.
+    def __init__(self):
+        self.token = secrets.token_urlsafe(12)
+        self.addr = None
+        self.active = False
+        self.number = 0
+
+    def activate(self):
+        # False if no hello has arrived, so frames stay on TCP
+        self.active = self.addr is not None
+        return self.active
+
+    def packets(self, frame):
+        datagrams = packetize(self.number & 0xFFFFFFFF, frame.buffers(PROTO_BINARY))
+        self.number += 1
+        return datagrams
+
+
+class DatagramRegistry:
+    # Token -> DatagramLink of the receivers that asked for datagrams. The
+    # server engine owns the UDP socket and passes every datagram to hello().
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.links = {}
+
+    def create(self):
+        link = DatagramLink()
+        with self.lock:
+            self.links[link.token] = link
+        return link
+
+    def remove(self, link):
+        with self.lock:
+            self.links.pop(link.token, None)
+
+    def hello(self, data, addr):
+        # The ack to send back, or None for anything but a known receiver's
+        # hello. The address is fixed once the link is in use.
+        if not data.startswith(HELLO_MAGIC):
+            return None
+        token = data[len(HELLO_MAGIC):].decode('ascii', errors='replace')
+        with self.lock:
+            link = self.links.get(token)
+        if link is None:
+            return None
+        if not link.active:
+            link.addr = addr
+        return ACK_MAGIC + data[len(HELLO_MAGIC):]
+
+
+class DatagramReceiver:
+    # The receiver's end: a UDP socket connected to the server's screen
+    # port, registered with the token from the TCP handshake. An injector
+    # (LossInjector) impairs everything received, for tests.
+    def __init__(self, host, port, token, injector=None, assembler=None):
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        self.sock.connect(address)
+        self.token = token
+        self.injector = injector
+        self.assembler = assembler or FrameAssembler()
+        self.closed = False
+
+    def register(self, timeout=HELLO_TIMEOUT):
+        # True once the server acknowledged the hello; False if nothing came
+        # back in time, e.g. because a firewall drops UDP
+        ack = ACK_MAGIC + self.token.encode('ascii')
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.sock.send(pack_hello(self.token))
+            wait_until = min(deadline, time.monotonic() + HELLO_INTERVAL)
+            while (wait := wait_until - time.monotonic()) > 0:
+                self.sock.settimeout(wait)
+                try:
+                    if self.sock.recv(2048) == ack:
+                        return True
+                except socket.timeout:
+                    break
+                except OSError:
+                    # ICMP port unreachable from a server without UDP
+                    time.sleep(wait)
+                    break
+        return False
+
+    def poll(self, max_wait=0.1):
+        # Waits up to max_wait seconds for datagrams; returns the frames
+        # that became ready, oldest first
+        now = time.monotonic()
+        waits = [max_wait, self.assembler.timeout(now)]
+        if self.injector:
+            waits.append(self.injector.timeout(now))
+        self.sock.settimeout(min(wait for wait in waits if wait is not None))
+        try:
+            datagrams = [self.sock.recv(65536)]
+        except (socket.timeout, BlockingIOError):
+            datagrams = []
+        now = time.monotonic()
+        if self.injector:
+            for datagram in datagrams:
+                self.injector.push(datagram, now)
+            datagrams = self.injector.pop(now)
+
+        frames = []
+        for datagram in datagrams:
+            frames.extend(self.assembler.add(datagram, now))
+        frames.extend(self.assembler.flush(now))
+        return frames
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
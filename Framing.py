@@ -0,0 +1,143 @@
+import codecs
+import struct
+
+SIZE_HEADER = struct.Struct("Q")
+
+# Largest frame a peer may announce; a raw 4K BGR frame is ~25 MB.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Size of the reusable receive buffer. Reads smaller than this are served
+# from it; larger frames are received straight into their own buffer.
+BUFFER_SIZE = 256 * 1024
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameReader:
+    # Buffered reader for a stream socket. Data is received with recv_into
+    # into a preallocated bytearray, so building a frame costs O(n) instead of
+    # the O(n^2) of repeated `data += sock.recv()`, and bytes read past the
+    # end of one frame are kept for the next one instead of being discarded.
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def buffered(self):
+        return self._end - self._start
+
+    def _fill(self):
+        # Receive more data into the free tail of the buffer, moving unread
+        # bytes to the front first if the tail is full. Returns 0 on EOF.
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        received = self.sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def read_exact(self, size):
+        # Returns exactly `size` bytes as a read-only memoryview that stays
+        # valid after later reads, or raises ConnectionError on EOF.
+        if size > self.max_frame_size:
+            raise FrameTooLarge(f"frame of {size} bytes exceeds limit of {self.max_frame_size}")
+
+        if size <= len(self._buf):
+            if self._start + size > len(self._buf):
+                pending = self._end - self._start
+                self._view[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+            while self._end - self._start < size:
+                if not self._fill():
+                    raise ConnectionError("connection closed mid-frame")
+            data = bytes(self._view[self._start:self._start + size])
+            self._start += size
+            return memoryview(data)
+
+        # Large frame: hand over what is buffered, then receive the rest
+        # directly into the frame's own buffer without an intermediate copy.
+        frame = bytearray(size)
+        view = memoryview(frame)
+        pos = self._end - self._start
+        view[:pos] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while pos < size:
+            received = self.sock.recv_into(view[pos:])
+            if not received:
+                raise ConnectionError("connection closed mid-frame")
+            pos += received
+        return view.toreadonly()
+
+    def read_frame(self):
+        # Reads one size-prefixed frame; returns None on a clean EOF between
+        # frames.
+        if self._start == self._end and not self._fill():
+            return None
+        msg_size = SIZE_HEADER.unpack(self.read_exact(SIZE_HEADER.size))[0]
+        return self.read_exact(msg_size)
+
+    def peek(self, size=1):
+        # Returns everything buffered, receiving until at least `size` bytes
+        # are available or the peer closes the connection.
+        while self._end - self._start < size:
+            if self._end == len(self._buf) and self._start == 0:
+                break
+            if not self._fill():
+                break
+        return bytes(self._view[self._start:self._end])
+
+    def skip(self, size):
+        self._start += min(size, self._end - self._start)
+
+    def read_line(self, max_bytes=1024):
+        # Reads one newline-terminated line, without the newline
+        while True:
+            end = self._buf.find(b"\n", self._start, self._end)
+            if end >= 0:
+                line = bytes(self._view[self._start:end])
+                self._start = end + 1
+                return line.decode('utf-8')
+            if self._end - self._start >= max_bytes:
+                raise FrameTooLarge(f"line exceeds {max_bytes} bytes")
+            if not self._fill():
+                raise ConnectionError("connection closed mid-line")
+
+    def read_text(self, max_bytes=1024):
+        # Returns whatever text is available (at most max_bytes worth), never
+        # splitting a multi-byte UTF-8 character. Returns '' on EOF.
+        while True:
+            if self._start == self._end and not self._fill():
+                return ''
+            end = min(self._end, self._start + max_bytes)
+            text = self._decoder.decode(self._view[self._start:end])
+            self._start = end
+            if text:
+                return text
+
+
+def send_buffers(sock, buffers):
+    # Scatter-gather send of several buffers in as few syscalls as possible,
+    # without joining them into one temporary bytes object first.
+    if not hasattr(sock, 'sendmsg'):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
@@ -0,0 +1,404 @@
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0)
+
+# Default port of the local metrics endpoint
+METRICS_PORT = 9997
+
+# Seconds between the periodic metrics log lines
+LOG_INTERVAL = 60.0
+
+# Seconds between stack samples while the profiler runs
+PROFILE_INTERVAL = 0.005
+
+# Functions listed in a profile report
+PROFILE_TOP = 30
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def receiver_labels(stats):
+    return {'receiver': f"{stats['addr'][0]}:{stats['addr'][1]}"}
+
+
+class Counter:
+    # Monotonic total. inc() is one uncontended lock round trip, well under
+    # a microsecond, so counters sit directly on the frame and chat paths.
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Gauge:
+    # Current value read from the server only when scraped or logged, so
+    # gauges cost nothing on the hot paths. fn returns a number, or a list
+    # of (labels, value) pairs for one sample per label set.
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    @property
+    def value(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            return value
+        return sum(sample for _, sample in value)
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            yield self.name, {}, value
+            return
+        for labels, sample in value:
+            yield self.name, labels, sample
+
+
+class Histogram:
+    # Fixed buckets; observe() is a binary search over a dozen bounds plus
+    # one locked update
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def quantile(self, q, counts):
+        # Upper bound of the bucket holding the q-quantile of `counts`
+        # (bucket counts, e.g. the difference of two snapshots); None if
+        # empty, inf if it lies beyond the last bucket
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        counts, total = self.snapshot()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield self.name + '_bucket', {'le': '+Inf' if bound == float('inf') else repr(bound)}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, fn):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            except Exception as e:
+                lines.append(f"# error reading {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(MetricsRegistry):
+    # Everything either server engine reports. The engines count frames and
+    # chat messages as they pass and register gauges for their connections;
+    # rates and latency percentiles for the log line are computed from the
+    # change since the previous line.
+    def __init__(self):
+        super().__init__()
+        self.frames_in = self.counter('chatscreen_frames_received_total', "Screen frames received from presenters")
+        self.frame_bytes_in = self.counter('chatscreen_frame_bytes_received_total',
+                                           "Screen frame payload bytes received from presenters")
+        self.frames_out = self.counter('chatscreen_frames_sent_total', "Screen frames sent to receivers")
+        self.frame_bytes_out = self.counter('chatscreen_frame_bytes_sent_total',
+                                            "Screen frame bytes sent to receivers")
+        self.frames_dropped = self.counter('chatscreen_frames_dropped_total',
+                                           "Screen frames dropped from the queues of slow receivers")
+        self.chat_in = self.counter('chatscreen_chat_messages_received_total', "Chat messages received")
+        self.chat_out = self.counter('chatscreen_chat_messages_sent_total',
+                                     "Chat messages queued for recipients")
+        self.fanout = self.histogram('chatscreen_fanout_seconds',
+                                     "Time to cache a frame and queue it for all of its receivers")
+        self.send_time = self.histogram('chatscreen_frame_send_seconds',
+                                        "Time to write one frame to one receiver")
+        self.profiler = SamplingProfiler()
+        self.previous = None
+
+    def watch(self, rooms, receiver_stats):
+        # Gauges over the room registry and the screen receivers
+        # (get_receiver_stats() of the engine)
+        self.gauge('chatscreen_rooms', "Open rooms", lambda: rooms.stats()['rooms'])
+        self.gauge('chatscreen_chat_users', "Connected chat users", lambda: rooms.stats()['chat_users'])
+        self.gauge('chatscreen_presenters', "Presenters sharing their screen", lambda: rooms.stats()['presenters'])
+        self.gauge('chatscreen_receivers', "Connected screen receivers", lambda: len(receiver_stats()))
+        self.gauge('chatscreen_receiver_queued_frames', "Frames waiting in each receiver's queue",
+                   lambda: [(receiver_labels(stats), stats['queued']) for stats in receiver_stats()])
+        self.gauge('chatscreen_receiver_dropped_frames', "Frames dropped from each receiver's queue since it joined",
+                   lambda: [(receiver_labels(stats), stats['dropped']) for stats in receiver_stats()])
+        self.gauge('chatscreen_threads', "Live threads", threading.active_count)
+
+    def frame_received(self, frame):
+        self.frames_in.inc()
+        self.frame_bytes_in.inc(frame.size)
+
+    def frame_sent(self, buffers, seconds):
+        self.frames_out.inc()
+        self.frame_bytes_out.inc(sum(map(len, buffers)))
+        self.send_time.observe(seconds)
+
+    def value(self, name):
+        metric = self.metrics.get(name)
+        return None if metric is None else metric.value
+
+    def log_line(self):
+        now = time.monotonic()
+        current = {
+            'frames_in': self.frames_in.value,
+            'bytes_in': self.frame_bytes_in.value,
+            'frames_out': self.frames_out.value,
+            'bytes_out': self.frame_bytes_out.value,
+            'dropped': self.frames_dropped.value,
+            'chat': self.chat_in.value,
+            'fanout': self.fanout.snapshot()[0],
+        }
+        previous, self.previous = self.previous, (now, current)
+        if previous is None:
+            elapsed, previous = 0.0, {key: 0 if key != 'fanout' else [0] * len(value)
+                                      for key, value in current.items()}
+        else:
+            elapsed, previous = now - previous[0], previous[1]
+        elapsed = max(elapsed, 1e-9)
+
+        def rate(key):
+            return (current[key] - previous[key]) / elapsed
+
+        fanout = [a - b for a, b in zip(current['fanout'], previous['fanout'])]
+        p50 = self.fanout.quantile(0.5, fanout)
+        p99 = self.fanout.quantile(0.99, fanout)
+        queues = self.metrics['chatscreen_receiver_queued_frames'].fn()
+        line = (f"📊 frames {rate('frames_in'):.1f}/s in ({rate('bytes_in') / 1e6:.2f} MB/s), "
+                f"{rate('frames_out'):.1f}/s out ({rate('bytes_out') / 1e6:.2f} MB/s), "
+                f"{current['dropped'] - previous['dropped']} dropped | chat {rate('chat'):.1f} msg/s | "
+                f"{self.value('chatscreen_chat_users')} users, {self.value('chatscreen_presenters')} presenters, "
+                f"{len(queues)} receivers (max queue {max((depth for _, depth in queues), default=0)})")
+        if p50 is not None:
+            line += f" | fan-out p50 ≤{p50 * 1000:g} ms, p99 ≤{p99 * 1000:g} ms"
+        line += f" | {self.value('chatscreen_threads')} threads"
+        tasks = self.value('chatscreen_tasks')
+        if tasks is not None:
+            line += f", {tasks} tasks"
+        return line
+
+    def start(self, host='localhost', port=METRICS_PORT, log_interval=LOG_INTERVAL):
+        # Serves the endpoint and prints the log line from daemon threads;
+        # a port or interval of 0 leaves that part off
+        if port:
+            try:
+                server = ThreadingHTTPServer((host, port), metrics_handler(self))
+            except OSError as e:
+                # A busy port only costs the endpoint, not the server
+                print(f"⚠️  Metrics endpoint not available on {host}:{port}: {e}")
+            else:
+                server.daemon_threads = True
+                thread = threading.Thread(target=server.serve_forever)
+                thread.daemon = True
+                thread.start()
+                print(f"📊 Metrics: http://{host}:{port}/metrics")
+        if log_interval:
+            thread = threading.Thread(target=self.log_periodically, args=(log_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def log_periodically(self, interval):
+        self.log_line()
+        while True:
+            time.sleep(interval)
+            try:
+                print(self.log_line())
+            except Exception as e:
+                print(f"Error logging metrics: {e}")
+
+
+def metrics_handler(metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        # GET /metrics             Prometheus text
+        # GET /profile/start       start sampling (?interval=seconds)
+        # GET /profile             report of the samples so far
+        # GET /profile/stop        stop sampling and return the report
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/metrics':
+                self.reply(200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            elif url.path == '/profile/start':
+                try:
+                    interval = float(parse_qs(url.query).get('interval', [PROFILE_INTERVAL])[0])
+                except ValueError:
+                    self.reply(400, "interval must be a number of seconds\n")
+                    return
+                started = metrics.profiler.start(interval)
+                self.reply(200, "profiler started\n" if started else "profiler already running\n")
+            elif url.path == '/profile':
+                self.reply(200, metrics.profiler.report())
+            elif url.path == '/profile/stop':
+                metrics.profiler.stop()
+                self.reply(200, metrics.profiler.report())
+            else:
+                self.reply(404, "not found\n")
+
+        def reply(self, status, text, content_type='text/plain; charset=utf-8'):
+            body = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the console
+            pass
+
+    return MetricsHandler
+
+
+class SamplingProfiler:
+    # Statistical profiler that can be switched on while the server runs.
+    # A thread wakes every `interval` seconds and records the Python stack
+    # of every other thread from sys._current_frames(), so the server code
+    # is not traced and runs at full speed between samples. Threads blocked
+    # in a socket call or a wait show up under the function that made it.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.own = Tally()
+        self.total = Tally()
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=PROFILE_INTERVAL):
+        # Clears the previous profile; False if already running
+        with self.lock:
+            if self.running:
+                return False
+            self.samples = 0
+            self.own = Tally()
+            self.total = Tally()
+            self.started = time.monotonic()
+            self.stopped = None
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, args=(max(interval, 0.0005),))
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            self.stopping.set()
+        if thread is not None:
+            thread.join()
+
+    def run(self, interval):
+        me = threading.get_ident()
+        while not self.stopping.wait(interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stacks.append(stack)
+            with self.lock:
+                for stack in stacks:
+                    self.own[stack[0]] += 1
+                    self.total.update(set(stack))
+                    self.samples += 1
+        self.stopped = time.monotonic()
+
+    def report(self, top=PROFILE_TOP):
+        with self.lock:
+            if self.started is None:
+                return "profiler has not run; start it with /profile/start\n"
+            elapsed = (self.stopped or time.monotonic()) - self.started
+            state = "running" if self.running else "stopped"
+            count, own, total = self.samples, self.own.most_common(top), dict(self.total)
+
+        samples = max(count, 1)
+        lines = [f"{count} thread samples over {elapsed:.1f} s ({state})",
+                 f"{'self %':>7} {'total %':>7}  function"]
+        for site, hits in own:
+            name, filename, line = site
+            lines.append(f"{100 * hits / samples:7.1f} {100 * total[site] / samples:7.1f}  "
+                         f"{name} ({filename}:{line})")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,172 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Protocol import ScreenFrame
+
+DEFAULT_FPS = 15
+
+# Weight of the newest sample in the per-stage moving averages
+SMOOTHING = 0.2
+
+
+class FrameScheduler:
+    # Paces capture at the target frame rate, slowed down to the measured
+    # throughput of the slowest stage so queues between stages stay short
+    # instead of filling with stale frames.
+    def __init__(self, target_fps=DEFAULT_FPS):
+        self.target_fps = target_fps
+        self.stage_times = {}
+        self.next_deadline = None
+
+    def record(self, stage, seconds, parallelism=1):
+        sample = seconds / parallelism
+        previous = self.stage_times.get(stage)
+        if previous is None:
+            self.stage_times[stage] = sample
+        else:
+            self.stage_times[stage] = previous + SMOOTHING * (sample - previous)
+
+    @property
+    def interval(self):
+        return max([1.0 / self.target_fps, *self.stage_times.values()])
+
+    @property
+    def fps(self):
+        return 1.0 / self.interval
+
+    def wait(self):
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+
+        delay = self.next_deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -self.interval:
+            # Fell behind: start over from now rather than bursting to catch up
+            self.next_deadline = now
+        self.next_deadline += self.interval
+
+
+class ScreenSharePipeline:
+    # Capture -> encode -> send, each stage on its own thread with bounded
+    # queues in between. JPEG encoding of keyframes and changed tiles runs
+    # in a thread pool (cv2 releases the GIL), so several frames can be in
+    # flight while the send thread delivers them in order.
+    def __init__(self, grab, send, encoder, target_fps=DEFAULT_FPS, workers=None):
+        self.grab = grab
+        self.send = send
+        self.encoder = encoder
+        self.scheduler = FrameScheduler(target_fps)
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.captured = queue.Queue(maxsize=2)
+        self.encoding = queue.Queue(maxsize=self.workers + 1)
+        self.executor = None
+        self.running = False
+        self.error = None
+        self.frames_sent = 0
+
+    def run(self, should_continue=lambda: True):
+        # Runs the capture stage on the calling thread until should_continue
+        # returns False or a stage fails; a stage's exception is re-raised.
+        self.running = True
+        stages = [
+            threading.Thread(target=self.stage, args=(self.encode_loop,)),
+            threading.Thread(target=self.stage, args=(self.send_loop,)),
+        ]
+        with ThreadPoolExecutor(self.workers) as self.executor:
+            for thread in stages:
+                thread.daemon = True
+                thread.start()
+            try:
+                self.stage(self.capture_loop, should_continue)
+            finally:
+                self.running = False
+                for thread in stages:
+                    thread.join()
+
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        self.running = False
+
+    def stage(self, loop, *args):
+        try:
+            loop(*args)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            self.running = False
+
+    def put(self, stage_queue, item):
+        while self.running:
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue):
+        while self.running:
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def capture_loop(self, should_continue):
+        while self.running and should_continue():
+            self.scheduler.wait()
+            start = time.perf_counter()
+            timestamp = time.time()
+            frame = self.grab()
+            self.scheduler.record('capture', time.perf_counter() - start)
+            if not self.put(self.captured, (timestamp, frame)):
+                break
+
+    def encode_loop(self):
+        seq = 0
+        while self.running:
+            item = self.get(self.captured)
+            if item is None:
+                break
+            timestamp, frame = item
+
+            # Diffing against the previous frame must happen in order; the
+            # JPEG encodes it produces are independent and go to the pool
+            start = time.perf_counter()
+            codec, flags, images, assemble = self.encoder.prepare(frame)
+            self.scheduler.record('prepare', time.perf_counter() - start)
+            jobs = [self.executor.submit(self.encode_image, image) for image in images]
+
+            height, width = frame.shape[:2]
+            header = (codec, width, height, seq, timestamp, flags)
+            if not self.put(self.encoding, (header, jobs, assemble)):
+                break
+            seq += 1
+
+    def encode_image(self, image):
+        start = time.perf_counter()
+        encoded = self.encoder.encode_jpeg(image)
+        return encoded, time.perf_counter() - start
+
+    def send_loop(self):
+        while self.running:
+            item = self.get(self.encoding)
+            if item is None:
+                break
+            header, jobs, assemble = item
+
+            results = [job.result() for job in jobs]
+            self.scheduler.record('encode', sum(seconds for _, seconds in results), self.workers)
+            payload = assemble([encoded for encoded, _ in results])
+
+            start = time.perf_counter()
+            self.send(ScreenFrame(*header, payload))
+            self.scheduler.record('send', time.perf_counter() - start)
+            self.frames_sent += 1
@@ -0,0 +1,536 @@
+import hashlib
+import io
+import json
+import pickle
+import struct
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+from Framing import SIZE_HEADER, FrameTooLarge
+
+# Protocol versions, negotiated in the chat and SENDER/RECEIVER handshakes.
+# Version 1 is the original framing: an 8-byte size followed by a pickled
+# numpy array of JPEG bytes for screens, raw unframed UTF-8 for chat.
+# Version 2 sends a fixed binary header followed by the encoded image bytes
+# as-is, so nothing is ever unpickled, and length-prefixed JSON chat records.
+PROTO_LEGACY = 1
+PROTO_BINARY = 2
+PROTOCOL_VERSION = PROTO_BINARY
+
+ROLES = ("SENDER", "RECEIVER")
+
+# Room of clients that do not ask for one, including every legacy client
+DEFAULT_ROOM = 'lobby'
+
+# Longest file name most file systems allow, in bytes. Room and presenter
+# names end up in the names of chat history directories and recordings.
+MAX_FILE_NAME = 255
+
+# magic, version, codec, width, height, sequence number, capture timestamp
+# (seconds since the epoch), flags, payload length
+FRAME_HEADER = struct.Struct("!4sBBHHIdHI")
+FRAME_MAGIC = b"CSSF"
+
+CODEC_JPEG = 1
+# Delta frame carrying only the JPEG tiles that changed (see TileCodec.py)
+CODEC_JPEG_TILES = 2
+# Inter-frame video (see Codecs.py): each payload is one compressed frame,
+# and a delta depends on every frame since the previous keyframe
+CODEC_H264 = 3
+CODEC_VP8 = 4
+VIDEO_CODECS = (CODEC_H264, CODEC_VP8)
+
+# Codec names negotiated in the screen handshake. Senders offer those they
+# can encode, most preferred first ("codecs=h264,jpeg"), and the server
+# replies with the one to use ("codec=h264"); receivers list those they
+# can decode. Peers that send no list only know JPEG.
+CODEC_FAMILIES = {
+    'jpeg': (CODEC_JPEG, CODEC_JPEG_TILES),
+    'h264': (CODEC_H264,),
+    'vp8': (CODEC_VP8,),
+}
+DEFAULT_CODEC = 'jpeg'
+
+FLAG_KEYFRAME = 0x1
+
+# Payload of a CODEC_JPEG_TILES frame: frame width, height and tile count,
+# then for every tile its x, y and JPEG length followed by the JPEG bytes.
+# The relay merges tiles without decoding them, so these live here rather
+# than with the codec.
+TILES_HEADER = struct.Struct("!HHH")
+TILE_HEADER = struct.Struct("!HHI")
+
+# Version 2 receivers periodically report what they received: last
+# sequence number, frames and bytes since the previous report, the length
+# of that interval and how long ago the last frame arrived, in seconds.
+FEEDBACK = struct.Struct("!4sIIQff")
+FEEDBACK_MAGIC = b"CSFB"
+
+# The server folds receiver feedback into one report per interval for the
+# sender: the lowest sequence number any receiver has reached and how long
+# that receiver has held it, how many receivers reported, the fewest
+# frames any of them got, the frames the server dropped for slow
+# receivers, and the slowest receive rate in bytes per second.
+REPORT = struct.Struct("!4sIfHIIQ")
+REPORT_MAGIC = b"CSRP"
+
+# Sent to a sender of inter-frame video in between reports when one of its
+# receivers needs a keyframe to decode from: it joined mid-stream or frames
+# were dropped for it
+KEYFRAME_REQUEST = struct.Struct("!4s")
+KEYFRAME_REQUEST_MAGIC = b"CSKR"
+
+# Besides feedback, a receiver that asked for datagrams (transport=udp, see
+# Datagram.py) sends DATAGRAM_READY once the server's acks reach it, and
+# the same keyframe request when it lost frames; the server then brings it
+# up to date as on joining
+DATAGRAM_READY = struct.Struct("!4s")
+DATAGRAM_READY_MAGIC = b"CSDR"
+
+# Version 2 chat records: a 4-byte length followed by a UTF-8 JSON object
+# such as {"type": "message", "user": "alice", "text": "hi", "time": ...}
+CHAT_HEADER = struct.Struct("!I")
+MAX_CHAT_RECORD = 64 * 1024
+
+# Longest message text the server relays, in characters; even fully
+# escaped it leaves the record well under MAX_CHAT_RECORD
+MAX_CHAT_TEXT = 8000
+
+# Globals a pickled numpy array of JPEG bytes may reference. Frames from
+# legacy senders are unpickled with nothing else allowed, so a peer cannot
+# get code executed on the server.
+_LEGACY_PICKLE_GLOBALS = {
+    ("numpy.core.multiarray", "_reconstruct"),
+    ("numpy._core.multiarray", "_reconstruct"),
+    ("numpy", "ndarray"),
+    ("numpy", "dtype"),
+}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class _LegacyFrameUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) not in _LEGACY_PICKLE_GLOBALS:
+            raise ProtocolError(f"legacy frame references forbidden global {module}.{name}")
+        return super().find_class(module, name)
+
+
+class ScreenFrame:
+    # One encoded screen frame. Wire encodings are built lazily and cached,
+    # so each one is produced at most once per frame however many receivers
+    # ask for it.
+    def __init__(self, codec, width, height, seq, timestamp, flags, payload, legacy_data=None):
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.seq = seq
+        self.timestamp = timestamp
+        self.flags = flags
+        self._payload = payload
+        self._legacy_data = legacy_data
+        self._header = None
+
+    @classmethod
+    def from_legacy(cls, data, seq, timestamp):
+        # Wraps a version 1 frame; its bytes are relayed to legacy receivers
+        # untouched and only unpickled if a version 2 receiver needs them.
+        return cls(CODEC_JPEG, 0, 0, seq, timestamp, FLAG_KEYFRAME, None, legacy_data=data)
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            array = _LegacyFrameUnpickler(io.BytesIO(self._legacy_data)).load()
+            if getattr(array, 'dtype', None) != 'uint8':
+                raise ProtocolError("legacy frame is not a uint8 array")
+            self._payload = array.tobytes()
+        return self._payload
+
+    @property
+    def size(self):
+        # Bytes held by this frame, without unpickling a legacy frame
+        if self._payload is None:
+            return len(self._legacy_data)
+        return memoryview(self._payload).nbytes
+
+    @property
+    def is_keyframe(self):
+        return bool(self.flags & FLAG_KEYFRAME)
+
+    def header(self):
+        if self._header is None:
+            self._header = FRAME_HEADER.pack(
+                FRAME_MAGIC, PROTO_BINARY, self.codec, self.width, self.height,
+                self.seq & 0xFFFFFFFF, self.timestamp, self.flags, memoryview(self.payload).nbytes
+            )
+        return self._header
+
+    def buffers(self, proto):
+        # Buffers to send this frame to a peer speaking `proto`
+        if proto >= PROTO_BINARY:
+            return (self.header(), self.payload)
+
+        if self._legacy_data is None:
+            import numpy as np
+            self._legacy_data = pickle.dumps(np.frombuffer(self.payload, dtype=np.uint8))
+        return (SIZE_HEADER.pack(len(self._legacy_data)), self._legacy_data)
+
+
+def parse_frame_header(header):
+    # Returns (codec, width, height, seq, timestamp, flags, payload length)
+    magic, version, *fields = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != PROTO_BINARY:
+        raise ProtocolError("bad frame header")
+    return fields
+
+
+def read_screen_frame(reader):
+    # Reads one version 2 frame; returns None on a clean EOF between frames
+    if not reader.peek():
+        return None
+
+    codec, width, height, seq, timestamp, flags, length = parse_frame_header(
+        reader.read_exact(FRAME_HEADER.size))
+    if length > reader.max_frame_size:
+        raise FrameTooLarge(f"frame of {length} bytes exceeds limit of {reader.max_frame_size}")
+    payload = reader.read_exact(length)
+    return ScreenFrame(codec, width, height, seq, timestamp, flags, payload)
+
+
+def pack_feedback(last_seq, frames, nbytes, interval, hold):
+    return FEEDBACK.pack(FEEDBACK_MAGIC, last_seq & 0xFFFFFFFF, frames, nbytes, interval, hold)
+
+
+def parse_feedback(data):
+    # Returns (last_seq, frames, bytes, interval, hold)
+    magic, *fields = FEEDBACK.unpack(data)
+    if magic != FEEDBACK_MAGIC:
+        raise ProtocolError("bad feedback record")
+    return fields
+
+
+def pack_datagram_ready():
+    return DATAGRAM_READY.pack(DATAGRAM_READY_MAGIC)
+
+
+def receiver_control_size(magic):
+    # Size of the receiver record that starts with `magic`
+    sizes = {
+        FEEDBACK_MAGIC: FEEDBACK.size,
+        KEYFRAME_REQUEST_MAGIC: KEYFRAME_REQUEST.size,
+        DATAGRAM_READY_MAGIC: DATAGRAM_READY.size,
+    }
+    if magic not in sizes:
+        raise ProtocolError("bad receiver record")
+    return sizes[magic]
+
+
+def parse_receiver_control(data):
+    # ('feedback', fields as from parse_feedback), ('keyframe', None) or
+    # ('datagrams', None)
+    magic = bytes(data[:4])
+    if magic == KEYFRAME_REQUEST_MAGIC:
+        return 'keyframe', None
+    if magic == DATAGRAM_READY_MAGIC:
+        return 'datagrams', None
+    return 'feedback', parse_feedback(data)
+
+
+def read_receiver_control(reader):
+    # One record from a version 2 receiver, or None on EOF
+    magic = reader.peek(4)
+    if not magic:
+        return None
+    return parse_receiver_control(reader.read_exact(receiver_control_size(bytes(magic[:4]))))
+
+
+def pack_report(acked_seq, hold, receivers, frames, dropped, min_rate):
+    return REPORT.pack(REPORT_MAGIC, acked_seq & 0xFFFFFFFF, hold, receivers, frames, dropped, int(min_rate))
+
+
+def read_report(reader):
+    # Returns (acked_seq, hold, receivers, frames, dropped, min_rate), or
+    # None on EOF
+    if not reader.peek():
+        return None
+    magic, *fields = REPORT.unpack(reader.read_exact(REPORT.size))
+    if magic != REPORT_MAGIC:
+        raise ProtocolError("bad report record")
+    return fields
+
+
+def pack_keyframe_request():
+    return KEYFRAME_REQUEST.pack(KEYFRAME_REQUEST_MAGIC)
+
+
+def read_control(reader):
+    # What the server sends a sender that negotiated a codec: ('report',
+    # fields as from read_report) or ('keyframe', None); None on EOF
+    magic = reader.peek(len(KEYFRAME_REQUEST_MAGIC))
+    if not magic:
+        return None
+    if magic.startswith(KEYFRAME_REQUEST_MAGIC):
+        reader.read_exact(KEYFRAME_REQUEST.size)
+        return 'keyframe', None
+    report = read_report(reader)
+    return None if report is None else ('report', report)
+
+
+def format_codecs(names):
+    return ",".join(names)
+
+
+def parse_codecs(value):
+    # Known codec names from a handshake list, in the peer's order
+    names = [name for name in (value or "").split(',') if name in CODEC_FAMILIES]
+    return names or [DEFAULT_CODEC]
+
+
+def codec_ids(names):
+    return frozenset(codec for name in names for codec in CODEC_FAMILIES[name])
+
+
+def negotiate_codec(offered, allowed, receivers):
+    # The sender's most preferred codec that the server allows and that
+    # every receiver already watching can decode, falling back to JPEG.
+    # `receivers` holds one set of codec names per receiver.
+    for name in offered:
+        if name in allowed and all(name in codecs for codecs in receivers):
+            return name
+    return DEFAULT_CODEC
+
+
+def parse_options(data):
+    options = {}
+    for item in data.split():
+        key, _, value = item.partition('=')
+        options[key] = unquote(value)
+    return options
+
+
+def format_options(options):
+    # Values are percent-encoded so room and user names may contain spaces
+    return " ".join(f"{key}={quote(str(value), safe='')}" for key, value in options.items())
+
+
+def file_name_part(name, limit=MAX_FILE_NAME):
+    # A client-chosen name as (part of) a file name: percent-encoded, never
+    # "." or "..", and at most `limit` characters. Longer names are cut and
+    # tagged with a hash of the whole name, so they still differ.
+    part = quote(name, safe='')
+    if part in (".", ".."):
+        return part.replace(".", "%2E")
+    if len(part) > limit:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]
+        part = f"{part[:limit - len(digest) - 1]}~{digest}"
+    return part
+
+
+def chat_hello(username, **options):
+    # Newer chat clients send their username and options on one line, e.g.
+    # "alice proto=2 room=design\n"; legacy clients send only the bare
+    # username
+    options = {'proto': PROTOCOL_VERSION, **options}
+    return f"{quote(username, safe='')} {format_options(options)}\n".encode('utf-8')
+
+
+def parse_chat_hello(data):
+    # Returns (username, options, bytes consumed), or None for a legacy
+    # hello without a newline
+    end = data.find(b"\n")
+    if end < 0:
+        return None
+    name, _, rest = bytes(data[:end]).decode('utf-8', errors='replace').partition(' ')
+    return unquote(name), parse_options(rest), end + 1
+
+
+def read_chat_hello(reader):
+    # Returns (username, options), or (None, {}) on EOF
+    data = reader.peek()
+    if not data:
+        return None, {}
+
+    hello = parse_chat_hello(data)
+    if hello is None:
+        return reader.read_text(), {}
+    username, options, consumed = hello
+    reader.skip(consumed)
+    return username, options
+
+
+def parse_screen_hello(data):
+    # Parses the handshake at the start of a screen connection. Legacy
+    # clients send a bare "SENDER"/"RECEIVER"; newer ones send the role
+    # followed by options and a newline, e.g. "RECEIVER proto=2\n".
+    # Returns (role, options, bytes consumed), or None if more data is needed.
+    for role in ROLES:
+        name = role.encode('ascii')
+        if data.startswith(name):
+            rest = data[len(name):]
+            if rest.startswith(b" proto="):
+                end = data.find(b"\n", len(name))
+                if end < 0:
+                    return None
+                options = parse_options(data[len(name):end].decode('utf-8'))
+                return role, options, end + 1
+            if rest and b" proto=".startswith(rest):
+                return None
+            return role, {}, len(name)
+        if name.startswith(data):
+            return None
+
+    # Anything else was always treated as a receiver
+    return "RECEIVER", {}, len(data)
+
+
+def read_screen_hello(reader, max_bytes=1024):
+    # Returns (role, options) with any bytes after the handshake left in
+    # the reader
+    size = 1
+    while True:
+        data = reader.peek(size)
+        hello = parse_screen_hello(data)
+        if hello is not None:
+            role, options, consumed = hello
+            reader.skip(consumed)
+            return role, options
+        if len(data) < size or len(data) >= max_bytes:
+            raise ProtocolError("incomplete screen handshake")
+        size = len(data) + 1
+
+
+def negotiate_proto(options):
+    # The highest version both sides speak; clients that sent no options
+    # are legacy
+    try:
+        requested = int(options.get('proto', PROTO_LEGACY))
+    except ValueError:
+        requested = PROTO_LEGACY
+    return max(PROTO_LEGACY, min(requested, PROTOCOL_VERSION))
+
+
+def screen_hello(role, **options):
+    return f"{role} {format_options({'proto': PROTOCOL_VERSION, **options})}\n".encode('utf-8')
+
+
+def hello_reply(proto, **options):
+    return f"OK {format_options({'proto': proto, **options})}\n".encode('utf-8')
+
+
+def read_hello_reply(reader):
+    line = reader.read_line()
+    status, _, rest = line.partition(' ')
+    if status != "OK":
+        raise ProtocolError(f"handshake rejected: {line}")
+    return parse_options(rest)
+
+
+def format_chat_record(record):
+    # The text a chat record is shown as; legacy clients receive exactly this
+    kind = record.get('type')
+    user = record.get('user')
+    if user is None:
+        return record.get('text', '')
+    if kind == 'join':
+        return f"🟢 {user} joined the chat"
+    if kind == 'leave':
+        return f"🔴 {user} left the chat"
+    timestamp = datetime.fromtimestamp(record.get('time', 0)).strftime("%H:%M:%S")
+    return f"[{timestamp}] {user}: {record.get('text', '')}"
+
+
+def dump_chat_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def pack_chat_record(record):
+    data = dump_chat_record(record)
+    return CHAT_HEADER.pack(len(data)) + data
+
+
+def pack_missed(records):
+    # Logged messages (their JSON, oldest first) that a resumed client
+    # missed, as the records they were first broadcast as
+    return b"".join(CHAT_HEADER.pack(len(data)) + data for data in records)
+
+
+def pack_history(records, proto):
+    # One reply carrying logged messages (their JSON, oldest first) for a
+    # client that joined or asked for older history. The oldest messages
+    # are left out if the reply would exceed MAX_CHAT_RECORD.
+    if proto == PROTO_LEGACY:
+        return "\n".join(format_chat_record(parse_chat_record(data)) for data in records).encode('utf-8')
+
+    prefix, suffix = b'{"type":"history","messages":[', b']}'
+    size = len(prefix) + len(suffix)
+    first = len(records)
+    while first > 0 and size + len(records[first - 1]) + 1 <= MAX_CHAT_RECORD:
+        first -= 1
+        size += len(records[first]) + 1
+    data = prefix + b",".join(records[first:]) + suffix
+    return CHAT_HEADER.pack(len(data)) + data
+
+
+def parse_chat_record(data):
+    try:
+        record = json.loads(bytes(data).decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f"bad chat record: {e}")
+    if not isinstance(record, dict):
+        raise ProtocolError("chat record is not an object")
+    return record
+
+
+def check_chat_record_size(size):
+    if size > MAX_CHAT_RECORD:
+        raise FrameTooLarge(f"chat record of {size} bytes exceeds limit of {MAX_CHAT_RECORD}")
+    return size
+
+
+def read_chat_record(reader, proto):
+    # Returns the next record as a dict, or None on EOF. Text from legacy
+    # clients is wrapped as a message record.
+    if proto == PROTO_LEGACY:
+        text = reader.read_text()
+        return {'type': 'message', 'text': text} if text else None
+
+    if not reader.peek():
+        return None
+    size = check_chat_record_size(CHAT_HEADER.unpack(reader.read_exact(CHAT_HEADER.size))[0])
+    return parse_chat_record(reader.read_exact(size))
+
+
+class ChatMessage:
+    # One chat event sent to a room. Like ScreenFrame, each wire encoding is
+    # built at most once however many clients receive it.
+    def __init__(self, kind, user, text=None, timestamp=None):
+        self.record = {'type': kind, 'user': user}
+        if text is not None:
+            self.record['text'] = text
+        if timestamp is not None:
+            self.record['time'] = timestamp
+        self._data = None
+        self._encoded = {}
+
+    @property
+    def text(self):
+        return format_chat_record(self.record)
+
+    @property
+    def data(self):
+        # The record as JSON; fixed once first used
+        if self._data is None:
+            self._data = dump_chat_record(self.record)
+        return self._data
+
+    def encode(self, proto):
+        data = self._encoded.get(proto)
+        if data is None:
+            if proto >= PROTO_BINARY:
+                data = CHAT_HEADER.pack(len(self.data)) + self.data
+            else:
+                data = self.text.encode('utf-8')
+            self._encoded[proto] = data
+        return data
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+
+from Protocol import pack_report
+
+# Receivers send feedback this often, and the server sends each sender at
+# most one report per interval.
+FEEDBACK_INTERVAL = 1.0
+
+# Target for the time from sending a frame to hearing that the slowest
+# receiver got it, in seconds.
+LATENCY_BUDGET = 0.3
+
+# Settings from best to most conservative: JPEG quality, scale applied to
+# the capture output size, and fraction of the target frame rate.
+LADDER = [
+    (80, 1.0, 1.0),
+    (70, 1.0, 1.0),
+    (60, 1.0, 1.0),
+    (50, 1.0, 1.0),
+    (40, 1.0, 0.75),
+    (35, 0.75, 0.75),
+    (30, 0.75, 0.5),
+    (30, 0.5, 0.5),
+    (25, 0.5, 0.25),
+]
+START_LEVEL = 3
+
+# Consecutive uncongested intervals before stepping back up the ladder
+UPGRADE_AFTER = 3
+
+# Send times remembered for latency measurement
+SENT_HISTORY = 1024
+
+
+class FeedbackAggregator:
+    # Server side: collects receiver feedback for one stream and folds it
+    # into a single report for the sender once per interval.
+    def __init__(self, interval=FEEDBACK_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_report = time.monotonic()
+
+    def add(self, receiver, feedback, dropped):
+        # feedback is (last_seq, frames, bytes, interval, hold); dropped is
+        # the frames the server dropped for this receiver since its last
+        # feedback. Returns a packed report when one is due, else None.
+        now = time.monotonic()
+        with self.lock:
+            previous = self.pending.get(receiver)
+            if previous is not None:
+                dropped += previous[1]
+            self.pending[receiver] = (feedback, dropped, now)
+
+            if now - self.last_report < self.interval:
+                return None
+            pending, self.pending = list(self.pending.values()), {}
+            self.last_report = now
+
+        # The slowest receiver's feedback may have waited here for a while;
+        # that time counts towards how long it has held its last frame
+        slowest, _, received_at = min(pending, key=lambda item: item[0][0])
+        acked_seq, _, _, _, hold = slowest
+        hold += now - received_at
+        frames = min(feedback[1] for feedback, _, _ in pending)
+        total_dropped = sum(dropped for _, dropped, _ in pending)
+        min_rate = min(feedback[2] / max(feedback[3], 1e-3) for feedback, _, _ in pending)
+        return pack_report(acked_seq, hold, len(pending), frames, total_dropped, min_rate)
+
+
+class AdaptiveController:
+    # Sender side: moves along LADDER from the server's reports. Any dropped
+    # frames or latency over budget step down (two steps when latency is
+    # over twice the budget); UPGRADE_AFTER intervals well under budget step
+    # back up. on_change(quality, scale, fps) is called when settings change.
+    def __init__(self, target_fps, latency_budget=LATENCY_BUDGET, on_change=None):
+        self.target_fps = target_fps
+        self.latency_budget = latency_budget
+        self.on_change = on_change
+        self.level = START_LEVEL
+        self.good_intervals = 0
+        self.sent = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def settings(self):
+        quality, scale, fps_factor = LADDER[self.level]
+        return quality, scale, max(1.0, self.target_fps * fps_factor)
+
+    def on_frame_sent(self, seq):
+        with self.lock:
+            self.sent[seq & 0xFFFFFFFF] = time.monotonic()
+            while len(self.sent) > SENT_HISTORY:
+                self.sent.popitem(last=False)
+
+    def on_report(self, report):
+        acked_seq, hold, receivers, frames, dropped, min_rate = report
+        with self.lock:
+            sent_at = self.sent.get(acked_seq)
+        latency = None if sent_at is None else max(0.0, time.monotonic() - sent_at - hold)
+
+        previous = self.level
+        if dropped or (latency is not None and latency > self.latency_budget):
+            severe = latency is not None and latency > 2 * self.latency_budget
+            self.level = min(self.level + (2 if severe else 1), len(LADDER) - 1)
+            self.good_intervals = 0
+        elif latency is None or latency < self.latency_budget / 2:
+            self.good_intervals += 1
+            if self.good_intervals >= UPGRADE_AFTER:
+                self.level = max(self.level - 1, 0)
+                self.good_intervals = 0
+        else:
+            self.good_intervals = 0
+
+        quality, scale, fps = self.settings
+        latency_text = "?" if latency is None else f"{latency * 1000:.0f}"
+        print(f"📶 Screen share: latency {latency_text} ms, {dropped} dropped, "
+              f"{receivers} viewer(s) at >= {min_rate / 1000:.0f} kB/s -> "
+              f"quality {quality}, scale {scale:.2f}, {fps:.1f} fps")
+
+        if self.level != previous and self.on_change:
+            self.on_change(quality, scale, fps)
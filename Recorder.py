@@ -0,0 +1,291 @@
+import argparse
+import bisect
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+from Framing import FrameReader, send_buffers
+from Protocol import (CODEC_FAMILIES, DEFAULT_CODEC, FLAG_KEYFRAME, FRAME_HEADER, PROTO_BINARY, ProtocolError,
+                      ScreenFrame, file_name_part, parse_frame_header, read_control, read_hello_reply, screen_hello)
+from Relay import FrameCache
+
+# A recording is a short file header followed by version 2 screen frames
+# (FRAME_HEADER + payload) exactly as the presenter sent them, so recording
+# never re-encodes anything.
+RECORDING_HEADER = struct.Struct("!4sB")
+RECORDING_MAGIC = b"CSSR"
+RECORDING_VERSION = 1
+
+# Sidecar index, one entry per frame: capture timestamp, offset of the
+# frame header in the recording and frame flags. Timestamps only grow, so
+# a time is found by binary search over the memory-mapped index.
+INDEX_ENTRY = struct.Struct("!dQH")
+INDEX_SUFFIX = ".idx"
+
+# The writer flushes at least this often, in seconds
+FLUSH_INTERVAL = 1.0
+
+# Longest room or presenter part of a recording's file name, leaving room
+# for the time stamp and suffixes within MAX_FILE_NAME
+MAX_NAME_PART = 100
+
+
+def recording_path(directory, room, presenter):
+    # Room and presenter come from the client; each gets at most
+    # MAX_NAME_PART characters of the file name
+    room, presenter = file_name_part(room, MAX_NAME_PART), file_name_part(presenter, MAX_NAME_PART)
+    name = f"{room}-{presenter}-{time.strftime('%Y%m%d-%H%M%S')}.cssr"
+    return os.path.join(directory, name)
+
+
+class StreamRecorder:
+    # Appends the frames of one stream to a recording. write() only queues
+    # the frame object the receivers already share; a writer thread does
+    # the file I/O, so recording adds no copies or syscalls to the sender.
+    def __init__(self, path):
+        self.path = path
+        self.frames = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.data_file = open(path, 'wb')
+        self.index_file = open(path + INDEX_SUFFIX, 'wb')
+        self.data_file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+        self.offset = RECORDING_HEADER.size
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, frame):
+        with self.condition:
+            if not self.closed:
+                self.frames.append(frame)
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    if not self.frames and not self.closed:
+                        self.condition.wait(FLUSH_INTERVAL)
+                    frames, self.frames = self.frames, []
+                    closed = self.closed
+
+                # Frames are stored as version 2 whatever the presenter spoke
+                for frame in frames:
+                    header, payload = frame.buffers(PROTO_BINARY)
+                    self.data_file.write(header)
+                    self.data_file.write(payload)
+                    self.index_file.write(INDEX_ENTRY.pack(frame.timestamp, self.offset, frame.flags))
+                    self.offset += len(header) + memoryview(payload).nbytes
+
+                # Frames reach the disk before the index entries that point
+                # at them
+                self.data_file.flush()
+                self.index_file.flush()
+                if closed and not self.frames:
+                    break
+        except Exception as e:
+            print(f"Error recording to {self.path}: {e}")
+        finally:
+            for file in (self.data_file, self.index_file):
+                try:
+                    file.flush()
+                    os.fsync(file.fileno())
+                except OSError:
+                    pass
+                file.close()
+
+
+class Recording:
+    # Read side of a recording. Both files are memory-mapped: seeking reads
+    # only the O(log n) index entries the binary search touches, and frame
+    # payloads are views into the mapping rather than copies.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as data_file, open(path + INDEX_SUFFIX, 'rb') as index_file:
+            self.data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.fstat(index_file.fileno()).st_size < INDEX_ENTRY.size:
+                raise ProtocolError(f"{path} contains no frames")
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = RECORDING_HEADER.unpack_from(self.data)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ProtocolError(f"{path} is not a screen recording")
+        # A partly written last entry is ignored
+        self.count = len(self.index) // INDEX_ENTRY.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # Timestamp of frame i, which lets bisect search the index directly
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)[0]
+
+    @property
+    def start(self):
+        return self[0]
+
+    @property
+    def duration(self):
+        return self[self.count - 1] - self.start
+
+    @property
+    def codec(self):
+        # Name of the codec the presenter negotiated, from the first frame
+        codec = self.frame(0).codec
+        return next((name for name, ids in CODEC_FAMILIES.items() if codec in ids), DEFAULT_CODEC)
+
+    def find(self, seconds):
+        # Index of the frame on screen `seconds` into the recording
+        return max(bisect.bisect_right(self, self.start + seconds) - 1, 0)
+
+    def keyframe_before(self, i):
+        # Keyframes come at least every KEYFRAME_INTERVAL frames (video
+        # every VIDEO_KEYFRAME_INTERVAL), so this walks back a few hundred
+        # index entries at most
+        while i > 0:
+            _, _, flags = INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+            if flags & FLAG_KEYFRAME:
+                break
+            i -= 1
+        return i
+
+    def keyframe_after(self, i):
+        # Index of the first keyframe from i on, or None if there is none
+        while i < self.count:
+            _, _, flags = INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+            if flags & FLAG_KEYFRAME:
+                return i
+            i += 1
+        return None
+
+    def frame(self, i):
+        _, offset, _ = INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+        header = self.data[offset:offset + FRAME_HEADER.size]
+        codec, width, height, seq, timestamp, flags, length = parse_frame_header(header)
+        start = offset + FRAME_HEADER.size
+        payload = memoryview(self.data)[start:start + length]
+        return ScreenFrame(codec, width, height, seq, timestamp, flags, payload)
+
+    def close(self):
+        self.index.close()
+        try:
+            self.data.close()
+        except BufferError:
+            # Frame payloads still reference the mapping; it is released
+            # once they are gone
+            pass
+
+
+def play(recording, send, start=0.0, speed=1.0, should_continue=lambda: True, keyframe_wanted=None):
+    # Sends the recording through send(frame) in real time (scaled by
+    # speed) from `start` seconds in. The frames from the preceding
+    # keyframe up to the start are merged into at most two frames and sent
+    # at once, so the picture is complete immediately without a burst that
+    # would overflow the receivers' queues. When the keyframe_wanted event
+    # is set, playback skips ahead to the next keyframe, as a live video
+    # presenter would send one right away.
+    target = recording.find(start)
+    keyframe = recording.keyframe_before(target)
+    cache = FrameCache()
+    for i in range(keyframe, target + 1):
+        cache.add(recording.frame(i))
+    frames = cache.replay()
+    if not frames:
+        # Video deltas cannot be merged, so playback starts at the keyframe
+        target = keyframe
+        frames = [recording.frame(target)]
+    for frame in frames:
+        send(frame)
+
+    base_time = recording[target]
+    began = time.monotonic()
+    i = target + 1
+    while i < len(recording):
+        if not should_continue():
+            return
+        if keyframe_wanted is not None and keyframe_wanted.is_set():
+            keyframe_wanted.clear()
+            keyframe = recording.keyframe_after(i)
+            if keyframe is not None:
+                # Carries on from the keyframe as if it were due now
+                i = keyframe
+                base_time = recording[i]
+                began = time.monotonic()
+        delay = (recording[i] - base_time) / speed - (time.monotonic() - began)
+        if delay > 0:
+            time.sleep(delay)
+        send(recording.frame(i))
+        i += 1
+
+
+def drain_reports(reader, keyframe_wanted=None):
+    # The server sends feedback reports to every sender, and keyframe
+    # requests to video senders. Playback has no quality to adapt, so
+    # reports are read and discarded; keyframe requests set the
+    # keyframe_wanted event if there is one.
+    try:
+        while True:
+            control = read_control(reader)
+            if control is None:
+                break
+            if control[0] == 'keyframe' and keyframe_wanted is not None:
+                keyframe_wanted.set()
+    except (ProtocolError, OSError):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a screen recording into a room as a presenter")
+    parser.add_argument('recording')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--screen-port', type=int, default=9998)
+    parser.add_argument('--room', default='lobby')
+    parser.add_argument('--name', help="presenter name (default: the recording's file name)")
+    parser.add_argument('--start', type=float, default=0.0, help="seconds into the recording")
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--loop', action='store_true')
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    name = args.name or os.path.splitext(os.path.basename(args.recording))[0]
+    print(f"⏯️  {args.recording}: {len(recording)} frames, {recording.duration:.1f} s")
+
+    sock = socket.create_connection((args.host, args.screen_port))
+    sock.sendall(screen_hello("SENDER", room=args.room, name=name, codecs=recording.codec))
+    reader = FrameReader(sock)
+    reply = read_hello_reply(reader)
+    proto = int(reply['proto'])
+    if reply.get('codec', DEFAULT_CODEC) != recording.codec:
+        # Recorded frames cannot be re-encoded for the room
+        print(f"❌ The server does not accept {recording.codec} frames in #{args.room} now")
+        sock.close()
+        raise SystemExit(1)
+    keyframe_wanted = threading.Event()
+    report_thread = threading.Thread(target=drain_reports, args=(reader, keyframe_wanted))
+    report_thread.daemon = True
+    report_thread.start()
+
+    try:
+        start = args.start
+        while True:
+            play(recording, lambda frame: send_buffers(sock, frame.buffers(proto)), start, args.speed,
+                 keyframe_wanted=keyframe_wanted)
+            if not args.loop:
+                break
+            start = 0.0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
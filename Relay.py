@@ -0,0 +1,352 @@
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from Protocol import (CODEC_JPEG, CODEC_JPEG_TILES, DEFAULT_CODEC, PROTO_LEGACY, TILE_HEADER, TILES_HEADER,
+                      VIDEO_CODECS, ScreenFrame, codec_ids)
+
+# Frames a receiver may have waiting before the oldest one is dropped. Screen
+# frames go stale quickly, so a short queue keeps slow viewers close to live.
+DEFAULT_QUEUE_SIZE = 3
+
+# Upper bound on the cached keyframe plus merged tiles of one stream. A
+# stream that outgrows it is not cached until its next keyframe.
+MAX_CACHE_BYTES = 8 * 1024 * 1024
+
+# Cached frames of a stream that sent nothing for this many seconds are
+# dropped
+CACHE_IDLE_TIMEOUT = 30.0
+
+# Chat output a client may have waiting before it is disconnected as too
+# slow to keep up
+MAX_OUTBOX_BYTES = 1024 * 1024
+
+# Not available on Windows, where sends from the flusher may block
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class ReceiverChannel:
+    # Bounded outbound queue for one screen receiver. Entries are ScreenFrame
+    # objects shared by every receiver, so fanning a frame out never copies
+    # it. When the receiver falls behind, the oldest queued frame is dropped
+    # instead of blocking the sender. codecs are the names the receiver can
+    # decode; frames in any other codec are skipped.
+    def __init__(self, addr, proto, maxsize=DEFAULT_QUEUE_SIZE, on_ready=None, on_drop=None, codecs=None):
+        self.addr = addr
+        self.proto = proto
+        self.codecs = frozenset(codecs or (DEFAULT_CODEC,))
+        self.codec_ids = codec_ids(self.codecs)
+        self.awaiting_keyframe = False
+        self.maxsize = maxsize
+        self.on_ready = on_ready
+        self.on_drop = on_drop
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.reported_drops = 0
+
+    def accepts(self, frame):
+        # Legacy receivers only understand whole JPEG frames, so they skip
+        # tile deltas and catch up on the next keyframe
+        if self.proto == PROTO_LEGACY:
+            return frame.codec == CODEC_JPEG
+        return frame.codec in self.codec_ids
+
+    def await_keyframe(self):
+        # Skips frames until the next keyframe, for a receiver that has
+        # nothing to apply deltas to
+        with self.condition:
+            self.awaiting_keyframe = True
+
+    def put(self, frame):
+        # False if the frame is not queued; awaiting_keyframe then tells
+        # whether the receiver is stuck until the next keyframe
+        if not self.accepts(frame):
+            return False
+
+        with self.condition:
+            if self.closed:
+                return False
+            if self.awaiting_keyframe:
+                if not frame.is_keyframe:
+                    return False
+                self.awaiting_keyframe = False
+            if len(self.frames) >= self.maxsize:
+                if frame.codec not in VIDEO_CODECS:
+                    self.drop(self.frames.popleft())
+                elif frame.is_keyframe:
+                    # Nothing before a keyframe is needed any more
+                    while self.frames:
+                        self.drop(self.frames.popleft())
+                else:
+                    # A video delta depends on every frame before it, so
+                    # dropping one breaks the stream until the next
+                    # keyframe. The queued frames still decode; this one
+                    # and those after it are dropped.
+                    self.drop(frame)
+                    self.awaiting_keyframe = True
+                    return False
+            self.frames.append(frame)
+            self.condition.notify()
+
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def drop(self, frame):
+        self.dropped += 1
+        if self.on_drop:
+            self.on_drop()
+
+    def get(self):
+        # Blocks until a frame is queued; returns None once the channel closes
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            return self.frames.popleft()
+
+    def get_nowait(self):
+        with self.condition:
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify_all()
+
+        if self.on_ready:
+            self.on_ready()
+
+    def take_drops(self):
+        # Frames dropped since the previous call, for feedback reports
+        dropped = self.dropped - self.reported_drops
+        self.reported_drops = self.dropped
+        return dropped
+
+    def stats(self):
+        return {
+            'addr': self.addr,
+            'queued': len(self.frames),
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+
+class FrameCache:
+    # The latest keyframe of one stream plus every tile that changed since,
+    # merged by position so a newer tile replaces an older one. A new
+    # subscriber is replayed at most two frames that rebuild the current
+    # picture, without waiting for (or asking the presenter for) the next
+    # keyframe. Video deltas cannot be merged, so a video stream is only
+    # cached up to its first delta after a keyframe.
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.keyframe = None
+        self.latest = None
+        self.tiles = {}
+        self.tiles_bytes = 0
+        self.merged = None
+        self.last_update = time.monotonic()
+
+    @property
+    def nbytes(self):
+        if self.keyframe is None:
+            return 0
+        return self.keyframe.size + self.tiles_bytes
+
+    def clear(self):
+        self.keyframe = None
+        self.latest = None
+        self.tiles = {}
+        self.tiles_bytes = 0
+        self.merged = None
+
+    def add(self, frame):
+        self.last_update = time.monotonic()
+        if frame.is_keyframe:
+            self.clear()
+            if frame.size <= self.max_bytes:
+                self.keyframe = frame
+            return
+
+        if frame.codec in VIDEO_CODECS:
+            self.clear()
+            return
+
+        if self.keyframe is None or frame.codec != CODEC_JPEG_TILES:
+            return
+
+        data = memoryview(frame.payload)
+        width, height, count = TILES_HEADER.unpack_from(data)
+        if (width, height) != (self.keyframe.width, self.keyframe.height):
+            self.clear()
+            return
+
+        # Tiles are copied out with their headers so the cache does not pin
+        # whole delta payloads
+        offset = TILES_HEADER.size
+        for _ in range(count):
+            x, y, length = TILE_HEADER.unpack_from(data, offset)
+            end = offset + TILE_HEADER.size + length
+            tile = bytes(data[offset:end])
+            previous = self.tiles.get((x, y))
+            if previous is not None:
+                self.tiles_bytes -= len(previous)
+            self.tiles[(x, y)] = tile
+            self.tiles_bytes += len(tile)
+            offset = end
+        self.latest = frame
+        self.merged = None
+
+        if self.nbytes > self.max_bytes:
+            self.clear()
+
+    def replay(self):
+        # Frames that bring a new subscriber up to date, oldest first
+        if self.keyframe is None:
+            return []
+        if not self.tiles:
+            return [self.keyframe]
+
+        if self.merged is None:
+            latest = self.latest
+            payload = b"".join([TILES_HEADER.pack(latest.width, latest.height, len(self.tiles)),
+                                *self.tiles.values()])
+            self.merged = ScreenFrame(CODEC_JPEG_TILES, latest.width, latest.height,
+                                      latest.seq, latest.timestamp, 0, payload)
+        return [self.keyframe, self.merged]
+
+    def evict_idle(self, now, timeout=CACHE_IDLE_TIMEOUT):
+        if self.keyframe is not None and now - self.last_update > timeout:
+            self.clear()
+
+
+class ChatOutbox:
+    # Chat output waiting for one client. Broadcasts only append encoded
+    # messages here; a flusher later writes everything queued in one send,
+    # so a burst of messages costs one syscall per client, not one per
+    # message. conn is a socket or an asyncio StreamWriter.
+    def __init__(self, conn, proto):
+        self.conn = conn
+        self.proto = proto
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.registered = False
+
+    def append(self, data):
+        # Returns True when the outbox was idle and needs a flush scheduled
+        with self.lock:
+            if self.closed:
+                return False
+            idle = not self.buffer
+            self.buffer += data
+            if len(self.buffer) > MAX_OUTBOX_BYTES:
+                self.closed = True
+                self.buffer.clear()
+                return True
+            return idle
+
+    def take(self):
+        with self.lock:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            return data
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.buffer.clear()
+
+
+class ChatFlusher:
+    # Writes chat outboxes of the thread engine from a single thread with
+    # non-blocking sends. A client whose socket buffer is full waits in a
+    # selector until it drains, so broadcasts never block on a slow client
+    # and it never holds up the others.
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.woken = False
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, outbox):
+        with self.lock:
+            self.pending.append(outbox)
+            if self.woken:
+                return
+            self.woken = True
+        self.wake_send.send(b"\0")
+
+    def write(self, outbox, data):
+        if outbox.append(data):
+            self.schedule(outbox)
+
+    def close(self, outbox):
+        # The socket is closed by the flusher thread once it is no longer
+        # registered with the selector
+        outbox.close()
+        self.schedule(outbox)
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wake_recv:
+                    try:
+                        self.wake_recv.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.flush(key.data)
+
+            with self.lock:
+                pending, self.pending = self.pending, []
+                self.woken = False
+            for outbox in pending:
+                self.flush(outbox)
+
+    def flush(self, outbox):
+        sock = outbox.conn
+        with outbox.lock:
+            if not outbox.closed:
+                try:
+                    sent = sock.send(outbox.buffer, SEND_FLAGS)
+                    del outbox.buffer[:sent]
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    outbox.closed = True
+                    outbox.buffer.clear()
+            closed = outbox.closed
+            waiting = bool(outbox.buffer)
+
+        if closed or not waiting:
+            if outbox.registered:
+                self.selector.unregister(sock)
+                outbox.registered = False
+        elif not outbox.registered:
+            self.selector.register(sock, selectors.EVENT_WRITE, outbox)
+            outbox.registered = True
+
+        if closed:
+            # Also wakes the client's reader thread if it is still running
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
@@ -0,0 +1,221 @@
+import threading
+import time
+
+from Protocol import DEFAULT_CODEC, DEFAULT_ROOM, negotiate_codec, pack_keyframe_request
+from RateControl import FeedbackAggregator
+from Relay import CACHE_IDLE_TIMEOUT, FrameCache
+
+# A video presenter is asked for a keyframe at most this often, however
+# many receivers are waiting for one
+KEYFRAME_REQUEST_INTERVAL = 0.5
+
+
+class ScreenStream:
+    # One presenter sharing their screen in a room. send_report is set by
+    # the server engine to deliver feedback reports to the presenter, or
+    # left as None for legacy senders. codec is the name negotiated in the
+    # presenter's handshake.
+    def __init__(self, room, presenter):
+        self.room = room
+        self.presenter = presenter
+        self.feedback = FeedbackAggregator()
+        self.cache = FrameCache()
+        self.send_report = None
+        self.codec = DEFAULT_CODEC
+        self.last_keyframe_request = 0.0
+
+    def request_keyframe(self):
+        # Only presenters that negotiated video understand the request; JPEG
+        # keyframes come every few frames anyway
+        if self.codec == DEFAULT_CODEC or self.send_report is None:
+            return
+        now = time.monotonic()
+        if now - self.last_keyframe_request < KEYFRAME_REQUEST_INTERVAL:
+            return
+        self.last_keyframe_request = now
+        self.send_report(pack_keyframe_request())
+
+
+class Room:
+    # Chat members and screen streams of one meeting. Each room has its own
+    # lock, so a busy room never holds up lookups or fan-out in another.
+    # Receivers either follow the room's active presenter (the earliest one
+    # still sharing) or subscribe to one presenter by name.
+    def __init__(self, name):
+        self.name = name
+        self.users = 0
+        self.lock = threading.Lock()
+        self.chat_members = {}
+        self.streams = {}
+        self.followers = set()
+        self.subscribers = {}
+
+    def active_stream(self):
+        return next(iter(self.streams.values()), None)
+
+    def add_stream(self, presenter):
+        # Presenter names are unique within a room; a second "alice" becomes
+        # "alice#2"
+        with self.lock:
+            name, count = presenter, 1
+            while name in self.streams:
+                count += 1
+                name = f"{presenter}#{count}"
+            stream = ScreenStream(self, name)
+            self.streams[name] = stream
+            return stream
+
+    def choose_codec(self, stream, offered, allowed):
+        # The first codec the presenter offered that the server allows and
+        # every receiver in the room that may watch it can decode. Receivers
+        # joining later that cannot decode it see nothing until the
+        # presenter restarts.
+        with self.lock:
+            receivers = set(self.followers)
+            receivers.update(self.subscribers.get(stream.presenter, ()))
+            stream.codec = negotiate_codec(offered, allowed, [channel.codecs for channel in receivers])
+            return stream.codec
+
+    def remove_stream(self, stream):
+        # When the active presenter stops, followers switch to the next one
+        # and are brought up to date from its cache
+        with self.lock:
+            if self.streams.get(stream.presenter) is not stream:
+                return
+            was_active = self.active_stream() is stream
+            del self.streams[stream.presenter]
+            active = self.active_stream()
+            if was_active and active is not None:
+                self.replay(active, self.followers)
+
+    def subscribe(self, channel, presenter=None):
+        # The cached picture is queued while the lock is held, so it always
+        # reaches the channel before any newer frame from publish()
+        with self.lock:
+            if presenter:
+                self.subscribers.setdefault(presenter, set()).add(channel)
+                stream = self.streams.get(presenter)
+            else:
+                self.followers.add(channel)
+                stream = self.active_stream()
+            if stream is not None:
+                self.replay(stream, [channel])
+
+    def replay(self, stream, channels):
+        # Without a cached picture the receivers wait for the next keyframe,
+        # which a video presenter is asked for right away
+        frames = stream.cache.replay()
+        if not frames and channels:
+            for channel in channels:
+                channel.await_keyframe()
+            stream.request_keyframe()
+        for channel in channels:
+            for frame in frames:
+                channel.put(frame)
+
+    def resync(self, channel, presenter=None):
+        # Brings a receiver that lost frames on the way up to date again,
+        # as on joining
+        with self.lock:
+            stream = self.streams.get(presenter) if presenter else self.active_stream()
+            if stream is not None:
+                self.replay(stream, [channel])
+
+    def unsubscribe(self, channel, presenter=None):
+        with self.lock:
+            if presenter:
+                channels = self.subscribers.get(presenter)
+                if channels is not None:
+                    channels.discard(channel)
+                    if not channels:
+                        del self.subscribers[presenter]
+            else:
+                self.followers.discard(channel)
+
+    def publish(self, stream, frame):
+        # Caches the frame for late joiners and returns the receivers it
+        # goes to
+        with self.lock:
+            stream.cache.add(frame)
+            channels = list(self.subscribers.get(stream.presenter, ()))
+            if self.active_stream() is stream:
+                channels.extend(self.followers)
+            return channels
+
+    def stream_for(self, presenter=None):
+        # The stream a receiver currently watches
+        with self.lock:
+            if presenter:
+                return self.streams.get(presenter)
+            return self.active_stream()
+
+    def evict_idle_caches(self, now, timeout=CACHE_IDLE_TIMEOUT):
+        with self.lock:
+            for stream in self.streams.values():
+                stream.cache.evict_idle(now, timeout)
+
+    def add_member(self, username, conn):
+        with self.lock:
+            self.chat_members[username] = conn
+
+    def remove_member(self, username, conn):
+        # False if the username has since been taken over by a newer
+        # connection
+        with self.lock:
+            if self.chat_members.get(username) is conn:
+                del self.chat_members[username]
+                return True
+            return False
+
+    def chat_recipients(self, sender=None):
+        with self.lock:
+            return [(username, conn) for username, conn in self.chat_members.items() if username != sender]
+
+
+class RoomRegistry:
+    # Room name -> Room. Every connection acquires its room on join and
+    # releases it when it leaves; a room is dropped once nobody holds it.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+
+    def acquire(self, name=None):
+        name = name or DEFAULT_ROOM
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name)
+            room.users += 1
+            return room
+
+    def release(self, room):
+        with self.lock:
+            room.users -= 1
+            if room.users == 0 and self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+
+    def evict_idle_caches(self, timeout=CACHE_IDLE_TIMEOUT):
+        # Frees the cached frames of streams that stopped sending
+        with self.lock:
+            rooms = list(self.rooms.values())
+        now = time.monotonic()
+        for room in rooms:
+            room.evict_idle_caches(now, timeout)
+
+    def stats(self):
+        # Counts for the server's metrics
+        with self.lock:
+            rooms = list(self.rooms.values())
+        return {
+            'rooms': len(rooms),
+            'chat_users': sum(len(room.chat_members) for room in rooms),
+            'presenters': sum(len(room.streams) for room in rooms),
+        }
+
+    def get(self, name):
+        with self.lock:
+            return self.rooms.get(name)
+
+    def names(self):
+        with self.lock:
+            return list(self.rooms)
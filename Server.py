@@ -1,195 +1,522 @@
-import socket
-import threading
-import cv2
-import pickle
-import struct
-import time
-from datetime import datetime
-
-class ChatScreenServer:
-    def __init__(self, host='localhost', chat_port=9999, screen_port=9998):
-        self.host = host
-        self.chat_port = chat_port
-        self.screen_port = screen_port
-        self.clients = {}
-        self.screen_clients = []
-        self.running = True
-        
-    def start_server(self):
-        # Start chat server
-        chat_thread = threading.Thread(target=self.start_chat_server)
-        chat_thread.daemon = True
-        chat_thread.start()
-        
-        # Start screen sharing server
-        screen_thread = threading.Thread(target=self.start_screen_server)
-        screen_thread.daemon = True
-        screen_thread.start()
-        
-        print(f"🚀 Server started!")
-        print(f"📱 Chat server: {self.host}:{self.chat_port}")
-        print(f"🖥️  Screen server: {self.host}:{self.screen_port}")
-        print("Press Ctrl+C to stop the server")
-        
-        try:
-            while self.running:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\n🛑 Shutting down server...")
-            self.running = False
-    
-    def start_chat_server(self):
-        chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        chat_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        chat_socket.bind((self.host, self.chat_port))
-        chat_socket.listen(5)
-        
-        while self.running:
-            try:
-                client_socket, addr = chat_socket.accept()
-                print(f"💬 Chat client connected: {addr}")
-                
-                client_thread = threading.Thread(
-                    target=self.handle_chat_client, 
-                    args=(client_socket, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-            except:
-                break
-    
-    def handle_chat_client(self, client_socket, addr):
-        try:
-            # Get username
-            username = client_socket.recv(1024).decode('utf-8')
-            self.clients[username] = client_socket
-            
-            # Broadcast user joined
-            join_msg = f"🟢 {username} joined the chat"
-            self.broadcast_message(join_msg, username)
-            
-            while self.running:
-                message = client_socket.recv(1024).decode('utf-8')
-                if not message:
-                    break
-                
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                formatted_msg = f"[{timestamp}] {username}: {message}"
-                print(formatted_msg)
-                self.broadcast_message(formatted_msg, username)
-                
-        except Exception as e:
-            print(f"Error handling chat client {addr}: {e}")
-        finally:
-            if username in self.clients:
-                del self.clients[username]
-                leave_msg = f"🔴 {username} left the chat"
-                self.broadcast_message(leave_msg, username)
-            client_socket.close()
-    
-    def broadcast_message(self, message, sender=None):
-        disconnected = []
-        for username, client_socket in self.clients.items():
-            if username != sender:
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                except:
-                    disconnected.append(username)
-        
-        # Clean up disconnected clients
-        for username in disconnected:
-            if username in self.clients:
-                del self.clients[username]
-    
-    def start_screen_server(self):
-        screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        screen_socket.bind((self.host, self.screen_port))
-        screen_socket.listen(5)
-        
-        while self.running:
-            try:
-                client_socket, addr = screen_socket.accept()
-                print(f"🖥️  Screen client connected: {addr}")
-                
-                # Determine if client is sender or receiver
-                role = client_socket.recv(1024).decode('utf-8')
-                
-                if role == "SENDER":
-                    screen_thread = threading.Thread(
-                        target=self.handle_screen_sender, 
-                        args=(client_socket, addr)
-                    )
-                else:  # RECEIVER
-                    screen_thread = threading.Thread(
-                        target=self.handle_screen_receiver, 
-                        args=(client_socket, addr)
-                    )
-                
-                screen_thread.daemon = True
-                screen_thread.start()
-                
-            except:
-                break
-    
-    def handle_screen_sender(self, client_socket, addr):
-        try:
-            while self.running:
-                # Receive frame size
-                data = b""
-                payload_size = struct.calcsize("Q")
-                
-                while len(data) < payload_size:
-                    packet = client_socket.recv(4*1024)
-                    if not packet:
-                        return
-                    data += packet
-                
-                packed_msg_size = data[:payload_size]
-                data = data[payload_size:]
-                msg_size = struct.unpack("Q", packed_msg_size)[0]
-                
-                # Receive frame data
-                while len(data) < msg_size:
-                    data += client_socket.recv(4*1024)
-                
-                frame_data = data[:msg_size]
-                
-                # Broadcast frame to all receivers
-                self.broadcast_screen_frame(frame_data, msg_size)
-                
-        except Exception as e:
-            print(f"Error handling screen sender {addr}: {e}")
-        finally:
-            client_socket.close()
-    
-    def handle_screen_receiver(self, client_socket, addr):
-        self.screen_clients.append(client_socket)
-        try:
-            while self.running:
-                time.sleep(0.1)  # Keep connection alive
-        except:
-            pass
-        finally:
-            if client_socket in self.screen_clients:
-                self.screen_clients.remove(client_socket)
-            client_socket.close()
-    
-    def broadcast_screen_frame(self, frame_data, msg_size):
-        disconnected = []
-        packed_msg_size = struct.pack("Q", msg_size)
-        
-        for client in self.screen_clients[:]:
-            try:
-                client.sendall(packed_msg_size + frame_data)
-            except:
-                disconnected.append(client)
-        
-        # Clean up disconnected clients
-        for client in disconnected:
-            if client in self.screen_clients:
-                self.screen_clients.remove(client)
-
-if __name__ == "__main__":
-    server = ChatScreenServer()
+import argparse
+import os
+import socket
+import threading
+import time
+
+from ChatLog import ChatLog
+from Datagram import DatagramRegistry
+from Framing import FrameReader, send_buffers
+from Protocol import (CODEC_FAMILIES, MAX_CHAT_TEXT, PROTO_LEGACY, ChatMessage, ScreenFrame, format_codecs,
+                      hello_reply, negotiate_proto, pack_history, pack_missed, parse_codecs, read_chat_hello,
+                      read_chat_record, read_receiver_control, read_screen_frame, read_screen_hello)
+from Metrics import LOG_INTERVAL, METRICS_PORT, ServerMetrics
+from Recorder import StreamRecorder, recording_path
+from Relay import ChatFlusher, ChatOutbox, ReceiverChannel
+from Rooms import RoomRegistry
+from Sessions import SessionTable
+
+class ChatScreenServer:
+    def __init__(self, host='localhost', chat_port=9999, screen_port=9998, history_dir=None, record_dir=None,
+                 metrics_port=METRICS_PORT, metrics_interval=LOG_INTERVAL, codecs=None, datagrams=False):
+        self.host = host
+        self.chat_port = chat_port
+        self.screen_port = screen_port
+        self.rooms = RoomRegistry()
+        self.chat_flusher = ChatFlusher()
+        # Without a history directory recent messages are only kept in memory
+        self.chat_log = ChatLog(history_dir)
+        self.sessions = SessionTable()
+        self.record_dir = record_dir
+        # Codecs presenters may send in; receivers have to decode them
+        self.codecs = codecs or list(CODEC_FAMILIES)
+        self.screen_clients = {}
+        self.screen_lock = threading.Lock()
+        # Receivers that asked for frames as UDP datagrams, sent from the
+        # screen port
+        self.datagrams = DatagramRegistry() if datagrams else None
+        self.datagram_socket = None
+        self.metrics = ServerMetrics()
+        self.metrics.watch(self.rooms, self.get_receiver_stats)
+        self.metrics.gauge('chatscreen_detached_sessions', "Clients waiting to reconnect", self.sessions.detached)
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.running = True
+        
+    def start_server(self):
+        # Start chat server
+        chat_thread = threading.Thread(target=self.start_chat_server)
+        chat_thread.daemon = True
+        chat_thread.start()
+        
+        # Start screen sharing server
+        screen_thread = threading.Thread(target=self.start_screen_server)
+        screen_thread.daemon = True
+        screen_thread.start()
+        
+        if self.datagrams:
+            self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagram_socket.bind((self.host, self.screen_port))
+            datagram_thread = threading.Thread(target=self.receive_datagrams)
+            datagram_thread.daemon = True
+            datagram_thread.start()
+        
+        print(f"🚀 Server started!")
+        print(f"📱 Chat server: {self.host}:{self.chat_port}")
+        print(f"🖥️  Screen server: {self.host}:{self.screen_port}")
+        if self.datagrams:
+            print(f"📡 Screen datagrams: {self.host}:{self.screen_port}/udp")
+        self.metrics.start(port=self.metrics_port, log_interval=self.metrics_interval)
+        print("Press Ctrl+C to stop the server")
+        
+        try:
+            while self.running:
+                time.sleep(1)
+                self.rooms.evict_idle_caches()
+                self.expire_sessions()
+        except KeyboardInterrupt:
+            print("\n🛑 Shutting down server...")
+            self.running = False
+    
+    def start_chat_server(self):
+        chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        chat_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        chat_socket.bind((self.host, self.chat_port))
+        chat_socket.listen(5)
+        
+        while self.running:
+            try:
+                client_socket, addr = chat_socket.accept()
+                print(f"💬 Chat client connected: {addr}")
+                
+                client_thread = threading.Thread(
+                    target=self.handle_chat_client, 
+                    args=(client_socket, addr)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+            except:
+                break
+    
+    def handle_chat_client(self, client_socket, addr):
+        username = None
+        room = None
+        outbox = None
+        session = None
+        resumable = False
+        reader = FrameReader(client_socket)
+        try:
+            # Get username, the room newer clients ask to join and whether
+            # they speak framed chat records
+            username, options = read_chat_hello(reader)
+            if not username:
+                return
+            proto = negotiate_proto(options)
+            
+            # From here on everything sent to this client goes through its
+            # outbox and the flusher thread. A version 2 client coming back
+            # with its session token keeps its name and room.
+            outbox = ChatOutbox(client_socket, proto)
+            resumed = False
+            if proto != PROTO_LEGACY:
+                session, previous = self.sessions.resume(options.get('resume'), 'chat', outbox)
+                resumed = session is not None
+                if previous is not None:
+                    self.chat_flusher.close(previous)
+            if resumed:
+                room, username = session.room, session.name
+            else:
+                room = self.rooms.acquire(options.get('room'))
+                if proto != PROTO_LEGACY:
+                    session = self.sessions.create('chat', room, username, outbox)
+            if 'proto' in options:
+                reply = {'session': session.token, 'resumed': int(resumed)} if session else {}
+                client_socket.sendall(hello_reply(proto, **reply))
+            room.add_member(username, outbox)
+            
+            if resumed:
+                # Nobody saw this user leave; they only need what they missed
+                self.send_missed(outbox, room, options.get('since'))
+            else:
+                # Broadcast user joined, and catch the new user up on the room
+                self.broadcast_message(room, ChatMessage('join', username), username)
+                self.send_history(outbox, room)
+            
+            while self.running:
+                record = read_chat_record(reader, proto)
+                if record is None:
+                    break
+                if record.get('type') == 'history':
+                    self.send_history(outbox, room, record.get('before'), always=True)
+                    continue
+                if record.get('type') != 'message' or not record.get('text'):
+                    continue
+                
+                message = ChatMessage('message', username, str(record['text'])[:MAX_CHAT_TEXT], time.time())
+                self.metrics.chat_in.inc()
+                self.chat_log.append(room.name, message)
+                print(f"#{room.name} {message.text}")
+                self.broadcast_message(room, message, username)
+                
+        except Exception as e:
+            # A broken connection, unlike a clean close, can be resumed
+            resumable = True
+            print(f"Error handling chat client {addr}: {e}")
+        finally:
+            if room is not None and (session is None or self.sessions.detach(session, outbox, resumable)):
+                self.leave_chat(room, username, outbox)
+            if outbox is not None:
+                self.chat_flusher.close(outbox)
+            else:
+                client_socket.close()
+    
+    def leave_chat(self, room, username, outbox):
+        if room.remove_member(username, outbox):
+            self.broadcast_message(room, ChatMessage('leave', username), username)
+        self.rooms.release(room)
+    
+    def send_history(self, outbox, room, before=None, always=False):
+        # Logged messages older than `before`, or the latest ones on join.
+        # A page request always gets a reply, empty once history runs out.
+        if before is not None and not isinstance(before, int):
+            records = []
+        else:
+            records = self.chat_log.history(room.name, before)
+        if records or always:
+            self.chat_flusher.write(outbox, pack_history(records, outbox.proto))
+    
+    def send_missed(self, outbox, room, since):
+        # Messages logged after the last one a resumed client saw
+        try:
+            records = self.chat_log.after(room.name, int(since or 0))
+        except ValueError:
+            records = []
+        if records:
+            self.chat_flusher.write(outbox, pack_missed(records))
+    
+    def broadcast_message(self, room, message, sender=None):
+        # The message is encoded once per wire format and appended to each
+        # recipient's outbox; nothing is sent on this thread. Clients that
+        # disconnect or fall too far behind are cleaned up by their own
+        # thread.
+        recipients = room.chat_recipients(sender)
+        for username, outbox in recipients:
+            self.chat_flusher.write(outbox, message.encode(outbox.proto))
+        self.metrics.chat_out.inc(len(recipients))
+    
+    def start_screen_server(self):
+        screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        screen_socket.bind((self.host, self.screen_port))
+        screen_socket.listen(5)
+        
+        while self.running:
+            try:
+                client_socket, addr = screen_socket.accept()
+                print(f"🖥️  Screen client connected: {addr}")
+                
+                screen_thread = threading.Thread(
+                    target=self.handle_screen_client, 
+                    args=(client_socket, addr)
+                )
+                screen_thread.daemon = True
+                screen_thread.start()
+                
+            except:
+                break
+    
+    def receive_datagrams(self):
+        # Only hellos of receivers asking for datagrams come in here
+        while self.running:
+            try:
+                data, addr = self.datagram_socket.recvfrom(2048)
+            except OSError:
+                continue
+            ack = self.datagrams.hello(data, addr)
+            if ack:
+                try:
+                    self.datagram_socket.sendto(ack, addr)
+                except OSError:
+                    pass
+    
+    def handle_screen_client(self, client_socket, addr):
+        reader = FrameReader(client_socket)
+        link = None
+        try:
+            # Determine if client is sender or receiver, and which framing it
+            # speaks. Legacy clients send a bare role and get no reply.
+            role, options = read_screen_hello(reader)
+            proto = negotiate_proto(options)
+            # Senders are answered once their codec is chosen. Receivers that
+            # ask for datagrams get the token to register their UDP address.
+            if options and role != "SENDER":
+                reply = {}
+                if self.datagrams and proto != PROTO_LEGACY and options.get('transport') == 'udp':
+                    link = self.datagrams.create()
+                    reply['udp'] = link.token
+                client_socket.sendall(hello_reply(proto, **reply))
+        except Exception as e:
+            if link is not None:
+                self.datagrams.remove(link)
+            print(f"Error in screen handshake with {addr}: {e}")
+            client_socket.close()
+            return
+        
+        if role == "SENDER":
+            self.handle_screen_sender(client_socket, addr, reader, proto, options)
+            return
+        
+        # Legacy clients always join the default room
+        room = self.rooms.acquire(options.get('room'))
+        try:
+            self.handle_screen_receiver(client_socket, addr, reader, proto, room, options, link)
+        finally:
+            if link is not None:
+                self.datagrams.remove(link)
+            self.rooms.release(room)
+    
+    def handle_screen_sender(self, client_socket, addr, reader, proto, options):
+        # A version 2 presenter whose connection broke keeps its stream,
+        # receivers and recording for RESUME_TIMEOUT seconds and picks up
+        # where it left off when it reconnects with its session token
+        session, previous = None, None
+        if proto != PROTO_LEGACY:
+            session, previous = self.sessions.resume(options.get('resume'), 'screen', client_socket)
+        resumed = session is not None
+        if resumed:
+            stream, recorder = session.stream, session.recorder
+            if previous is not None:
+                # Wakes the thread still reading the old connection
+                try:
+                    previous.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            print(f"🖥️  {stream.presenter} resumed presenting in #{stream.room.name}")
+        else:
+            room = self.rooms.acquire(options.get('room'))
+            stream = room.add_stream(options.get('name') or f"{addr[0]}:{addr[1]}")
+            print(f"🖥️  {stream.presenter} is presenting in #{room.name}")
+            # A sender that offers codecs is told which one to send; the
+            # others send JPEG
+            room.choose_codec(stream, parse_codecs(options.get('codecs')), self.codecs)
+            recorder = self.start_recording(stream)
+            if proto != PROTO_LEGACY:
+                session = self.sessions.create('screen', room, stream.presenter, client_socket)
+                session.stream, session.recorder = stream, recorder
+        resumable = False
+        seq = 0
+        try:
+            if options:
+                reply = {'codec': stream.codec} if 'codecs' in options else {}
+                if session is not None:
+                    reply.update(session=session.token, resumed=int(resumed))
+                client_socket.sendall(hello_reply(proto, **reply))
+            # Version 2 senders also get feedback reports written to their socket
+            if proto != PROTO_LEGACY:
+                stream.send_report = self.report_sender(client_socket)
+            while self.running:
+                # Bytes past the end of this frame stay buffered in the reader
+                # for the next one
+                if proto == PROTO_LEGACY:
+                    frame_data = reader.read_frame()
+                    if frame_data is None:
+                        return
+                    frame = ScreenFrame.from_legacy(frame_data, seq, time.time())
+                else:
+                    frame = read_screen_frame(reader)
+                    if frame is None:
+                        return
+                seq += 1
+                
+                # Broadcast frame to the stream's receivers
+                self.broadcast_screen_frame(frame, stream)
+                if recorder:
+                    recorder.write(frame)
+                
+        except Exception as e:
+            resumable = True
+            print(f"Error handling screen sender {addr}: {e}")
+        finally:
+            client_socket.close()
+            if session is None or self.sessions.detach(session, client_socket, resumable):
+                self.end_stream(stream, recorder)
+    
+    def end_stream(self, stream, recorder):
+        stream.room.remove_stream(stream)
+        if recorder:
+            recorder.close()
+        self.rooms.release(stream.room)
+    
+    def expire_sessions(self):
+        # Clients that did not come back in time leave for good
+        for session in self.sessions.expire():
+            print(f"⌛ {session.name} did not reconnect to #{session.room.name}")
+            if session.kind == 'chat':
+                self.leave_chat(session.room, session.name, session.conn)
+            else:
+                self.end_stream(session.stream, session.recorder)
+    
+    def start_recording(self, stream):
+        if not self.record_dir:
+            return None
+        path = recording_path(self.record_dir, stream.room.name, stream.presenter)
+        try:
+            recorder = StreamRecorder(path)
+        except OSError as e:
+            # The presenter still shares, just without a recording
+            print(f"⚠️  Cannot record {stream.presenter} to {path}: {e}")
+            return None
+        print(f"⏺️  Recording {stream.presenter} to {path}")
+        return recorder
+    
+    def handle_screen_receiver(self, client_socket, addr, reader, proto, room, options, link=None):
+        # This thread only writes: it sleeps on the receiver's queue until the
+        # sender pushes a frame, so a slow receiver never stalls the sender.
+        # A second thread reads the receiver's feedback and notices when it
+        # disconnects. Without a presenter option the receiver follows
+        # whoever is presenting in the room. Once the receiver confirmed its
+        # datagram link, frames go out as datagrams instead of on its socket.
+        presenter = options.get('presenter') or None
+        channel = ReceiverChannel(addr, proto, on_drop=self.metrics.frames_dropped.inc,
+                                  codecs=parse_codecs(options.get('codecs')))
+        with self.screen_lock:
+            self.screen_clients[client_socket] = channel
+        room.subscribe(channel, presenter)
+        feedback_thread = threading.Thread(
+            target=self.receive_screen_feedback, 
+            args=(reader, channel, room, presenter, link)
+        )
+        feedback_thread.daemon = True
+        feedback_thread.start()
+        try:
+            while self.running:
+                frame = channel.get()
+                if frame is None:
+                    break
+                start = time.perf_counter()
+                if link is not None and link.active:
+                    buffers = self.send_datagrams(link, frame, channel)
+                    if buffers is None:
+                        continue
+                else:
+                    buffers = frame.buffers(channel.proto)
+                    send_buffers(client_socket, buffers)
+                self.metrics.frame_sent(buffers, time.perf_counter() - start)
+                channel.sent += 1
+        except:
+            pass
+        finally:
+            room.unsubscribe(channel, presenter)
+            with self.screen_lock:
+                self.screen_clients.pop(client_socket, None)
+            channel.close()
+            client_socket.close()
+            print(f"🖥️  Screen receiver disconnected: {addr} ({channel.dropped} frames dropped)")
+    
+    def send_datagrams(self, link, frame, channel):
+        # The packets sent, or None: a frame the socket has no room for is
+        # dropped, like one a slow receiver's queue has no room for
+        packets = link.packets(frame)
+        try:
+            for packet in packets:
+                self.datagram_socket.sendto(packet, link.addr)
+        except OSError:
+            channel.drop(frame)
+            return None
+        return packets
+    
+    def receive_screen_feedback(self, reader, channel, room, presenter, link):
+        try:
+            while self.running:
+                control = read_receiver_control(reader)
+                if control is None:
+                    break
+                kind, feedback = control
+                if kind == 'datagrams':
+                    # Datagrams start from a full picture
+                    if link is not None and link.activate():
+                        room.resync(channel, presenter)
+                    continue
+                if kind == 'keyframe':
+                    room.resync(channel, presenter)
+                    continue
+                dropped = channel.take_drops()
+                stream = room.stream_for(presenter)
+                if stream is None:
+                    continue
+                report = stream.feedback.add(channel, feedback, dropped)
+                if report and stream.send_report:
+                    stream.send_report(report)
+        except:
+            pass
+        finally:
+            channel.close()
+    
+    def report_sender(self, client_socket):
+        # Feedback threads of several receivers may report at once
+        lock = threading.Lock()
+        
+        def send_report(report):
+            try:
+                with lock:
+                    client_socket.sendall(report)
+            except:
+                pass
+        
+        return send_report
+    
+    def broadcast_screen_frame(self, frame, stream):
+        # Every receiver queues the same frame object; nothing is copied or
+        # sent here, so the sender thread returns immediately. Only the
+        # stream's room is locked, and just long enough to cache the frame
+        # and list receivers.
+        start = time.perf_counter()
+        for channel in stream.room.publish(stream, frame):
+            if not channel.put(frame) and channel.awaiting_keyframe:
+                stream.request_keyframe()
+        self.metrics.fanout.observe(time.perf_counter() - start)
+        self.metrics.frame_received(frame)
+    
+    def get_receiver_stats(self):
+        with self.screen_lock:
+            return [channel.stats() for channel in self.screen_clients.values()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat & screen sharing server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--chat-port', type=int, default=9999)
+    parser.add_argument('--screen-port', type=int, default=9998)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="threads: one thread per connection; asyncio: single event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="asyncio worker processes sharing the ports via SO_REUSEPORT")
+    parser.add_argument('--history-dir', default='chat_history',
+                        help="directory for the persistent chat log; empty to keep recent messages in "
+                             "memory only")
+    parser.add_argument('--record', metavar='DIR',
+                        help="record every presenter's screen to DIR (play back with Recorder.py)")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="port of the local Prometheus metrics and profiler endpoint; 0 to disable "
+                             "(asyncio workers use consecutive ports)")
+    parser.add_argument('--metrics-interval', type=float, default=LOG_INTERVAL,
+                        help="seconds between metrics log lines; 0 to disable")
+    parser.add_argument('--codecs', default=format_codecs(CODEC_FAMILIES),
+                        help="comma-separated codecs presenters may send in (viewers need PyAV for h264 and vp8)")
+    parser.add_argument('--udp', action='store_true',
+                        help="send screen frames as UDP datagrams, from the screen port, to viewers that ask "
+                             "for them (asyncio engine: single worker only)")
+    args = parser.parse_args()
+
+    history_dir = args.history_dir or None
+    codecs = parse_codecs(args.codecs)
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+    if args.engine == 'asyncio':
+        from AsyncServer import AsyncChatScreenServer
+        server = AsyncChatScreenServer(args.host, args.chat_port, args.screen_port, args.workers,
+                                       history_dir, args.record, args.metrics_port, args.metrics_interval,
+                                       codecs, args.udp)
+    else:
+        server = ChatScreenServer(args.host, args.chat_port, args.screen_port, history_dir, args.record,
+                                  args.metrics_port, args.metrics_interval, codecs, args.udp)
     server.start_server()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import secrets
+import threading
+import time
+
+# How long the server keeps the room membership, presenter stream and
+# recording of a client whose connection broke, waiting for it to come back
+# with its session token
+RESUME_TIMEOUT = 30.0
+
+
+class Session:
+    # What a version 2 chat client or presenter keeps across reconnects.
+    # conn is the connection serving it (the chat outbox, or the presenter's
+    # socket or StreamWriter); a detached session keeps its last one until
+    # it is resumed or expires. Presenters also keep their stream and
+    # recorder.
+    def __init__(self, kind, room, name, conn):
+        self.token = secrets.token_urlsafe(16)
+        self.kind = kind
+        self.room = room
+        self.name = name
+        self.conn = conn
+        self.detached_at = None
+        self.stream = None
+        self.recorder = None
+
+
+class SessionTable:
+    # Token -> Session. A connection that ends cleanly ends its session;
+    # one that breaks detaches it, and a reconnect presenting the token
+    # within the timeout takes it over.
+    def __init__(self, timeout=RESUME_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def create(self, kind, room, name, conn):
+        session = Session(kind, room, name, conn)
+        with self.lock:
+            self.sessions[session.token] = session
+        return session
+
+    def resume(self, token, kind, conn):
+        # Moves a session to a new connection. Returns (session, previous
+        # connection), where the previous connection is None unless the
+        # server had not noticed it broke yet, in which case the caller
+        # closes it; (None, None) for an unknown or expired token.
+        with self.lock:
+            session = self.sessions.get(token or "")
+            if session is None or session.kind != kind:
+                return None, None
+            previous = session.conn if session.detached_at is None else None
+            session.conn = conn
+            session.detached_at = None
+            return session, previous
+
+    def detach(self, session, conn, resumable):
+        # Called when a connection ends; True if its session ends with it and
+        # must be cleaned up now. A session already taken over by a newer
+        # connection is left alone.
+        with self.lock:
+            if session.conn is not conn or session.detached_at is not None:
+                return False
+            if resumable:
+                session.detached_at = time.monotonic()
+                return False
+            self.sessions.pop(session.token, None)
+            return True
+
+    def expire(self):
+        # Removes and returns the sessions nobody resumed in time, for the
+        # server to clean up
+        now = time.monotonic()
+        with self.lock:
+            expired = [session for session in self.sessions.values()
+                       if session.detached_at is not None and now - session.detached_at > self.timeout]
+            for session in expired:
+                del self.sessions[session.token]
+        return expired
+
+    def detached(self):
+        with self.lock:
+            return sum(1 for session in self.sessions.values() if session.detached_at is not None)
@@ -0,0 +1,128 @@
+import cv2
+import numpy as np
+
+from Protocol import CODEC_JPEG, CODEC_JPEG_TILES, FLAG_KEYFRAME, TILE_HEADER, TILES_HEADER
+
+TILE_SIZE = 64
+
+# A full keyframe is sent at least this often so receivers that missed a
+# delta, or joined late, resynchronise.
+KEYFRAME_INTERVAL = 30
+
+# When more than this fraction of tiles changed, one full JPEG is smaller
+# than the tiles and is sent as a keyframe instead.
+FULL_FRAME_THRESHOLD = 0.5
+
+
+def changed_tiles(previous, frame, tile_size=TILE_SIZE):
+    # Boolean grid with one entry per tile, True where any pixel differs.
+    # The per-pixel difference is reduced over rows of tiles and then over
+    # columns (3 bytes per pixel) with reduceat, so edge tiles may be
+    # smaller than tile_size.
+    height, width = frame.shape[:2]
+    diff = cv2.absdiff(previous, frame).reshape(height, -1)
+    diff = np.maximum.reduceat(diff, np.arange(0, height, tile_size), axis=0)
+    diff = np.maximum.reduceat(diff, np.arange(0, width * 3, tile_size * 3), axis=1)
+    return diff > 0
+
+
+class TileEncoder:
+    # Encodes frames as a JPEG keyframe followed by deltas that carry only
+    # the tiles that changed since the previous frame.
+    def __init__(self, quality=50, tile_size=TILE_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+        self.quality = quality
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.frames_since_keyframe = 0
+
+    def request_keyframe(self):
+        self.frames_since_keyframe = self.keyframe_interval
+
+    def encode_jpeg(self, image):
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        result, encoded = cv2.imencode('.jpg', image, encode_param)
+        return encoded
+
+    def encode(self, frame):
+        # Returns (codec, flags, payload) for the next frame
+        codec, flags, images, assemble = self.prepare(frame)
+        return codec, flags, assemble([self.encode_jpeg(image) for image in images])
+
+    def prepare(self, frame):
+        # Decides between keyframe and delta and updates the reference frame.
+        # This part must run in frame order; it returns (codec, flags,
+        # images, assemble) where the images can then be JPEG-encoded in any
+        # order or in parallel, and assemble(encoded) builds the payload.
+        keyframe = (
+            self.previous is None
+            or self.previous.shape != frame.shape
+            or self.frames_since_keyframe >= self.keyframe_interval
+        )
+
+        if not keyframe:
+            grid = changed_tiles(self.previous, frame, self.tile_size)
+            if grid.mean() > FULL_FRAME_THRESHOLD:
+                keyframe = True
+
+        if self.previous is None or self.previous.shape != frame.shape:
+            self.previous = frame.copy()
+        else:
+            np.copyto(self.previous, frame)
+
+        if keyframe:
+            self.frames_since_keyframe = 0
+            return CODEC_JPEG, FLAG_KEYFRAME, [frame], self.assemble_keyframe
+
+        self.frames_since_keyframe += 1
+        height, width = frame.shape[:2]
+        positions = [(int(col) * self.tile_size, int(row) * self.tile_size) for row, col in zip(*np.nonzero(grid))]
+        tiles = [frame[y:y + self.tile_size, x:x + self.tile_size] for x, y in positions]
+
+        def assemble(encoded):
+            return self.assemble_tiles(width, height, positions, encoded)
+
+        return CODEC_JPEG_TILES, 0, tiles, assemble
+
+    def assemble_keyframe(self, encoded):
+        return memoryview(encoded[0]).cast('B')
+
+    def assemble_tiles(self, width, height, positions, encoded):
+        parts = [TILES_HEADER.pack(width, height, len(positions))]
+        for (x, y), tile in zip(positions, encoded):
+            parts.append(TILE_HEADER.pack(x, y, tile.size))
+            parts.append(tile.tobytes())
+        return b"".join(parts)
+
+
+class TileDecoder:
+    # Keeps a persistent framebuffer: keyframes replace it and deltas paste
+    # their tiles into it.
+    def __init__(self):
+        self.framebuffer = None
+
+    def decode(self, frame):
+        # Returns the current picture, or None while waiting for a keyframe
+        data = np.frombuffer(frame.payload, dtype=np.uint8)
+
+        if frame.codec == CODEC_JPEG:
+            self.framebuffer = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            return self.framebuffer
+
+        if frame.codec != CODEC_JPEG_TILES or self.framebuffer is None:
+            return None
+
+        width, height, count = TILES_HEADER.unpack_from(data)
+        if self.framebuffer.shape[:2] != (height, width):
+            self.framebuffer = None
+            return None
+
+        offset = TILES_HEADER.size
+        for _ in range(count):
+            x, y, length = TILE_HEADER.unpack_from(data, offset)
+            offset += TILE_HEADER.size
+            tile = cv2.imdecode(data[offset:offset + length], cv2.IMREAD_COLOR)
+            offset += length
+            tile_height, tile_width = tile.shape[:2]
+            self.framebuffer[y:y + tile_height, x:x + tile_width] = tile
+        return self.framebuffer
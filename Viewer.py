@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from Codecs import FrameDecoder
+
+# Display frame rate and latency are averaged over this many seconds
+STATS_INTERVAL = 1.0
+
+
+class FrameMailbox:
+    # Single-slot handoff between threads: put() replaces whatever has not
+    # been taken yet and returns it, so the reader only ever sees the newest
+    # item.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.item = None
+
+    def put(self, item):
+        with self.lock:
+            previous, self.item = self.item, item
+            return previous
+
+    def take(self):
+        with self.lock:
+            item, self.item = self.item, None
+            return item
+
+
+class ScreenViewer:
+    # Receiver side: network thread -> decode worker -> Tk main loop. The
+    # network thread only hands frames over with receive(), and a keyframe
+    # supersedes everything still queued before it, so a decoder that falls
+    # behind skips straight to the newest keyframe. Deltas after it must all
+    # be applied, but they are cheap: only their tiles are decoded, into the
+    # TileDecoder's persistent framebuffer (video deltas go through PyAV,
+    # see Codecs.py). The picture is converted to RGB
+    # in a recycled buffer and posted to a single-slot mailbox that the Tk
+    # loop polls, so frames the display cannot keep up with are never
+    # painted.
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.display = FrameMailbox()
+        self.recycled = deque()
+        self.running = True
+        self.shown_frames = 0
+        self.latency_total = 0.0
+        self.stats_start = time.monotonic()
+        self.fps = 0.0
+        self.latency = None
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def receive(self, frame):
+        with self.condition:
+            if frame.is_keyframe:
+                self.pending.clear()
+            self.pending.append(frame)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                frames = list(self.pending)
+                self.pending.clear()
+
+            try:
+                for frame in frames:
+                    image = self.decoder.decode(frame)
+            except Exception as e:
+                print(f"Error decoding screen: {e}")
+                continue
+            if image is None:
+                continue
+
+            rgb = self.buffer(image.shape)
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=rgb)
+            stale = self.display.put((rgb, frames[-1].timestamp))
+            if stale is not None:
+                self.recycled.append(stale[0])
+
+    def buffer(self, shape):
+        while self.recycled:
+            buffer = self.recycled.popleft()
+            if buffer.shape == shape:
+                return buffer
+        return np.empty(shape, dtype=np.uint8)
+
+    def take(self):
+        # Tk thread: the newest (rgb, capture timestamp) not yet shown, or
+        # None. The buffer must be handed back with shown() once painted.
+        return self.display.take()
+
+    def shown(self, rgb, timestamp):
+        # Tk thread: recycles the buffer and updates the statistics; returns
+        # True when fps and latency were refreshed
+        self.recycled.append(rgb)
+        self.shown_frames += 1
+        self.latency_total += max(0.0, time.time() - timestamp)
+
+        now = time.monotonic()
+        elapsed = now - self.stats_start
+        if elapsed < STATS_INTERVAL:
+            return False
+        self.fps = self.shown_frames / elapsed
+        self.latency = self.latency_total / self.shown_frames
+        self.shown_frames = 0
+        self.latency_total = 0.0
+        self.stats_start = now
+        return True
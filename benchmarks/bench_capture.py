@@ -0,0 +1,40 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Capture import BACKENDS, create_backend
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure screen grab rate of a capture backend")
+    parser.add_argument('--backend', default='synthetic', choices=['auto', *BACKENDS])
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--max-size', type=parse_size, default=None,
+                        help="scale to fit WIDTHxHEIGHT (default: native resolution)")
+    args = parser.parse_args()
+
+    backend = create_backend(args.backend, output_size=args.max_size)
+    try:
+        frame = backend.grab()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            frame = backend.grab()
+        elapsed = time.perf_counter() - start
+    finally:
+        backend.close()
+
+    height, width = frame.shape[:2]
+    print(f"{backend.name}: {width}x{height}, {args.frames / elapsed:.1f} grabs/s, "
+          f"{elapsed / args.frames * 1000:.2f} ms/grab")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Capture import SyntheticBackend
+from Codecs import FrameDecoder, create_encoder, encodable_codecs
+from Protocol import ScreenFrame
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def scrolling(size, frames, step=6):
+    # A page of text-like noise scrolled by a few rows every frame, the
+    # case where tile deltas resend nearly everything
+    width, height = size
+    rng = np.random.default_rng(0)
+    page = np.full((height + frames * step, width, 3), 255, dtype=np.uint8)
+    for y in range(0, page.shape[0] - 12, 16):
+        line = rng.integers(0, 2, size=(8, width, 1), dtype=np.uint8) * 200
+        page[y:y + 8] -= line
+    return [page[i * step:i * step + height].copy() for i in range(frames)]
+
+
+def moving_box(size, frames):
+    backend = SyntheticBackend(output_size=size)
+    return [backend.grab() for _ in range(frames)]
+
+
+CONTENT = {
+    'box': moving_box,
+    'scroll': scrolling,
+}
+
+
+def run(codec, clip, quality, fps):
+    # Encodes the clip, then decodes it again to measure the quality of the
+    # picture a viewer gets
+    encoder = create_encoder(codec, quality=quality, target_fps=fps)
+    frames = []
+    encode_time = 0.0
+    for seq, image in enumerate(clip):
+        start = time.perf_counter()
+        codec_id, flags, payload = encoder.encode(image)
+        encode_time += time.perf_counter() - start
+        height, width = image.shape[:2]
+        frames.append(ScreenFrame(codec_id, width, height, seq, time.time(), flags, payload))
+        # Paced like a live stream, which the VP8 rate control depends on
+        time.sleep(max(0.0, 1 / fps - (time.perf_counter() - start)))
+
+    decoder = FrameDecoder()
+    psnr = []
+    for frame, image in zip(frames, clip):
+        picture = decoder.decode(frame)
+        height, width = picture.shape[:2]
+        psnr.append(cv2.PSNR(np.ascontiguousarray(image[:height, :width]), picture))
+
+    sizes = [len(frame.payload) for frame in frames]
+    return {
+        'keyframe': sizes[0],
+        'delta': sum(sizes[1:]) / (len(sizes) - 1),
+        'encode_ms': encode_time / len(clip) * 1000,
+        'psnr': sum(psnr) / len(psnr),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JPEG tiles with inter-frame video codecs")
+    parser.add_argument('--codecs', nargs='+', default=encodable_codecs('auto'))
+    parser.add_argument('--content', nargs='+', default=list(CONTENT), choices=list(CONTENT))
+    parser.add_argument('--size', type=parse_size, default=(1280, 720))
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--quality', type=int, default=50)
+    parser.add_argument('--fps', type=float, default=15)
+    args = parser.parse_args()
+
+    print(f"{'content':<8}{'codec':<6}{'keyframe kB':>13}{'delta kB':>10}{'kB/s':>9}{'encode ms':>11}"
+          f"{'PSNR dB':>9}")
+    for content in args.content:
+        clip = CONTENT[content](args.size, args.frames)
+        for codec in args.codecs:
+            result = run(codec, clip, args.quality, args.fps)
+            print(f"{content:<8}{codec:<6}{result['keyframe'] / 1000:>13.1f}{result['delta'] / 1000:>10.2f}"
+                  f"{result['delta'] * args.fps / 1000:>9.1f}{result['encode_ms']:>11.2f}{result['psnr']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
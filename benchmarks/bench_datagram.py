@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Capture import SyntheticBackend
+from Datagram import DATAGRAM_SIZE, FEC_GROUP, JITTER_DELAY, FrameAssembler, LossInjector, packetize
+from Protocol import PROTO_BINARY, ScreenFrame
+from TileCodec import TileEncoder
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def encode_clip(size, frames, quality):
+    # A JPEG keyframe followed by tile deltas of the synthetic moving box
+    backend = SyntheticBackend(output_size=size)
+    encoder = TileEncoder(quality=quality)
+    clip = []
+    for seq in range(frames):
+        image = backend.grab()
+        codec, flags, payload = encoder.encode(image)
+        height, width = image.shape[:2]
+        clip.append(ScreenFrame(codec, width, height, seq, 0.0, flags, payload))
+    return clip
+
+
+def run(clip, group, loss, burst, delay, jitter, fps, seed):
+    # Sends the clip through the injector on a simulated clock, so runs are
+    # repeatable and take no real time apart from the packet handling.
+    # Packets repaired from parity include some that jitter only delayed.
+    injector = LossInjector(loss, delay, jitter, burst, seed=seed)
+    assembler = FrameAssembler(group=group or FEC_GROUP, delay=JITTER_DELAY)
+    packets = sent_bytes = 0
+    cpu = 0.0
+    now = 0.0
+    received = []
+
+    def deliver(until):
+        for datagram in injector.pop(until):
+            received.extend(assembler.add(datagram, until))
+        received.extend(assembler.flush(until))
+
+    for number, frame in enumerate(clip):
+        start = time.perf_counter()
+        datagrams = packetize(number, frame.buffers(PROTO_BINARY), group=group)
+        for datagram in datagrams:
+            injector.push(datagram, now)
+        packets += len(datagrams)
+        sent_bytes += sum(len(datagram) for datagram in datagrams)
+        # Every 5 ms, like a receiver polling its socket
+        for step in range(1, 1 + int(1000 / fps) // 5):
+            deliver(now + step * 0.005)
+        cpu += time.perf_counter() - start
+        now += 1 / fps
+    deliver(now + delay + jitter + JITTER_DELAY + 1)
+
+    frame_bytes = sum(len(frame.payload) for frame in clip)
+    return {
+        'delivered': assembler.delivered / len(clip) * 100,
+        'recovered': assembler.recovered,
+        'overhead': (sent_bytes / frame_bytes - 1) * 100,
+        'packets': packets / len(clip),
+        'us_per_frame': cpu / len(clip) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame delivery over lossy datagrams with XOR FEC")
+    parser.add_argument('--size', type=parse_size, default=(1280, 720))
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--quality', type=int, default=50)
+    parser.add_argument('--fps', type=float, default=15)
+    parser.add_argument('--loss', type=float, nargs='+', default=[0, 1, 2, 5], help="packet loss in percent")
+    parser.add_argument('--burst', type=float, default=1.0, help="mean length of loss bursts in packets")
+    parser.add_argument('--delay', type=float, default=20, help="one-way delay in ms")
+    parser.add_argument('--jitter', type=float, default=10, help="extra random delay in ms")
+    parser.add_argument('--groups', type=int, nargs='+', default=[4, FEC_GROUP, 0],
+                        help="data packets per parity packet; 0 for no FEC")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    clip = encode_clip(args.size, args.frames, args.quality)
+    average = sum(len(frame.payload) for frame in clip) / len(clip)
+    print(f"{len(clip)} frames, {average / 1000:.1f} kB on average, {DATAGRAM_SIZE}-byte packets")
+    print(f"{'loss %':>7}{'FEC group':>11}{'delivered %':>13}{'repaired':>10}{'overhead %':>12}"
+          f"{'packets':>9}{'us/frame':>10}")
+    for loss in args.loss:
+        for group in args.groups:
+            result = run(clip, group, loss / 100, args.burst, args.delay / 1000, args.jitter / 1000,
+                         args.fps, args.seed)
+            print(f"{loss:>7g}{group or '-':>11}{result['delivered']:>13.1f}{result['recovered']:>10}"
+                  f"{result['overhead']:>12.1f}{result['packets']:>9.1f}{result['us_per_frame']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
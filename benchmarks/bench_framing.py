@@ -0,0 +1,93 @@
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Framing import FrameReader
+
+# Raw BGR frame sizes; JPEG frames are smaller but the read loop is the same
+FRAME_SIZES = {
+    '1080p': 1920 * 1080 * 3,
+    '4k': 3840 * 2160 * 3,
+}
+
+
+def legacy_read_frame(sock, data):
+    # The loop previously used by Server.py and Client.py, except that it
+    # returns the over-read bytes so the stream stays intact for the benchmark
+    payload_size = struct.calcsize("Q")
+    while len(data) < payload_size:
+        packet = sock.recv(4*1024)
+        if not packet:
+            return None, b""
+        data += packet
+
+    packed_msg_size = data[:payload_size]
+    data = data[payload_size:]
+    msg_size = struct.unpack("Q", packed_msg_size)[0]
+
+    while len(data) < msg_size:
+        data += sock.recv(4*1024)
+
+    return data[:msg_size], data[msg_size:]
+
+
+def send_frames(sock, frame_size, count):
+    frame = os.urandom(frame_size)
+    header = struct.pack("Q", frame_size)
+    for _ in range(count):
+        sock.sendall(header)
+        sock.sendall(frame)
+    sock.close()
+
+
+def run(mode, frame_size, count):
+    server_sock, client_sock = socket.socketpair()
+    sender = threading.Thread(target=send_frames, args=(client_sock, frame_size, count))
+    sender.daemon = True
+
+    start = time.perf_counter()
+    sender.start()
+    frames = 0
+    if mode == 'legacy':
+        data = b""
+        while True:
+            frame, data = legacy_read_frame(server_sock, data)
+            if frame is None:
+                break
+            frames += 1
+            if frames == count:
+                break
+    else:
+        reader = FrameReader(server_sock)
+        while reader.read_frame() is not None:
+            frames += 1
+    elapsed = time.perf_counter() - start
+
+    sender.join()
+    server_sock.close()
+    assert frames == count, f"{mode}: expected {count} frames, got {frames}"
+    return frame_size * count / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare legacy and buffered frame reading")
+    parser.add_argument('--frames', type=int, default=5, help="frames per run")
+    parser.add_argument('--sizes', nargs='+', default=list(FRAME_SIZES), choices=list(FRAME_SIZES))
+    args = parser.parse_args()
+
+    print(f"{'size':<8}{'legacy MB/s':>14}{'FrameReader MB/s':>20}{'speedup':>10}")
+    for name in args.sizes:
+        frame_size = FRAME_SIZES[name]
+        legacy = run('legacy', frame_size, args.frames)
+        buffered = run('buffered', frame_size, args.frames)
+        print(f"{name:<8}{legacy:>14.1f}{buffered:>20.1f}{buffered / legacy:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Protocol import CODEC_JPEG_TILES, FLAG_KEYFRAME, PROTO_BINARY, ScreenFrame
+from Relay import ReceiverChannel
+from Server import ChatScreenServer
+
+
+def plain_broadcast(frame, stream):
+    # broadcast_screen_frame() without its metrics
+    for channel in stream.room.publish(stream, frame):
+        channel.put(frame)
+
+
+def plain_sent(buffers, seconds):
+    pass
+
+
+def run(server, broadcast, sent, stream, channels, frames):
+    # Fans frames out to every receiver and takes them off the queues again
+    # as the receiver threads would, minus the socket writes
+    frame = ScreenFrame(CODEC_JPEG_TILES, 1280, 720, 0, time.time(), FLAG_KEYFRAME, os.urandom(50000))
+    start = time.perf_counter()
+    for _ in range(frames):
+        broadcast(frame, stream)
+        for channel in channels:
+            queued = channel.get_nowait()
+            buffers = queued.buffers(channel.proto)
+            begin = time.perf_counter()
+            sent(buffers, time.perf_counter() - begin)
+            channel.sent += 1
+    return (time.perf_counter() - start) / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cost of server metrics on the frame path")
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--receivers', type=int, default=20)
+    args = parser.parse_args()
+
+    server = ChatScreenServer(metrics_port=0, metrics_interval=0)
+    room = server.rooms.acquire('bench')
+    stream = room.add_stream('presenter')
+    channels = []
+    for i in range(args.receivers):
+        channel = ReceiverChannel(('bench', i), PROTO_BINARY, on_drop=server.metrics.frames_dropped.inc)
+        room.subscribe(channel)
+        channels.append(channel)
+
+    plain = instrumented = float('inf')
+    for _ in range(3):
+        plain = min(plain, run(server, plain_broadcast, plain_sent, stream, channels, args.frames))
+        instrumented = min(instrumented, run(server, server.broadcast_screen_frame, server.metrics.frame_sent,
+                                             stream, channels, args.frames))
+
+    overhead = instrumented - plain
+    print(f"{args.receivers} receivers: {plain * 1e6:.1f} us/frame without metrics, "
+          f"{instrumented * 1e6:.1f} us/frame with metrics")
+    print(f"overhead {overhead * 1e6:.1f} us/frame, {overhead * 30 * 100:.3f}% of one core at 30 fps")
+
+
+if __name__ == "__main__":
+    main()
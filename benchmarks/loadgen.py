@@ -0,0 +1,486 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Capture import SyntheticBackend
+from Framing import FrameReader, send_buffers
+from Protocol import (PROTO_BINARY, ScreenFrame, chat_hello, pack_chat_record, read_chat_record,
+                      read_hello_reply, read_screen_frame, screen_hello)
+from Recorder import drain_reports
+from TileCodec import TileDecoder, TileEncoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Chat messages from the load generator read "loadgen <client> <n> <send time>"
+CHAT_TAG = "loadgen"
+
+# Frames encoded up front and replayed by every sender in a loop, so the
+# load generator spends no CPU on capture or encoding while measuring
+CLIP_FRAMES = 60
+
+# Results compared by --compare, and whether a larger value is better
+COMPARED = {
+    'screen.frames_per_s': True,
+    'screen.mb_per_s': True,
+    'screen.loss_percent': False,
+    'screen.latency_ms.p50': False,
+    'screen.latency_ms.p99': False,
+    'chat.deliveries_per_s': True,
+    'chat.latency_ms.p50': False,
+    'chat.latency_ms.p99': False,
+    'server.cpu_percent': False,
+    'server.peak_rss_mb': False,
+}
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1] * 1000, 3)}
+
+
+def encode_clip(size, frames, quality):
+    # Deterministic screen content: a keyframe followed by tile deltas, as
+    # (codec, flags, payload). The clip starts with a keyframe, so replaying
+    # it in a loop keeps every receiver's picture consistent.
+    backend = SyntheticBackend(output_size=size, size=size)
+    encoder = TileEncoder(quality=quality)
+    return [encoder.encode(backend.grab()) for _ in range(frames)]
+
+
+class Window:
+    # The measured interval. Samples count when their embedded send time
+    # falls inside it, so warm-up traffic and whatever is still in flight
+    # when it closes are left out on both ends.
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def __contains__(self, timestamp):
+        return self.start <= timestamp < self.stop
+
+
+class ScreenPair:
+    # One synthetic presenter and its receivers in a room of their own
+    def __init__(self, index, args, clip, window):
+        self.room = f"loadgen-{index}"
+        self.args = args
+        self.clip = clip
+        self.window = window
+        self.width, self.height = args.resolution
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.latencies = []
+        self.sockets = []
+
+    def connect(self, host, port, role, **options):
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(screen_hello(role, room=self.room, **options))
+        reader = FrameReader(sock)
+        read_hello_reply(reader)
+        self.sockets.append(sock)
+        return sock, reader
+
+    def start(self, host, port):
+        for _ in range(self.args.receivers):
+            sock, reader = self.connect(host, port, 'RECEIVER')
+            start_thread(self.receive, reader)
+        sock, reader = self.connect(host, port, 'SENDER', name='loadgen')
+        start_thread(drain_reports, reader)
+        start_thread(self.send, sock)
+
+    def send(self, sock):
+        interval = 1.0 / self.args.fps
+        deadline = time.monotonic()
+        seq = 0
+        try:
+            while True:
+                codec, flags, payload = self.clip[seq % len(self.clip)]
+                timestamp = time.time()
+                frame = ScreenFrame(codec, self.width, self.height, seq, timestamp, flags, payload)
+                send_buffers(sock, frame.buffers(PROTO_BINARY))
+                if timestamp in self.window:
+                    self.sent += 1
+                seq += 1
+
+                deadline += interval
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Too slow for the frame rate: skip ahead instead of
+                    # sending a burst
+                    deadline = time.monotonic()
+        except OSError:
+            pass
+
+    def receive(self, reader):
+        decoder = TileDecoder() if self.args.decode else None
+        try:
+            while True:
+                frame = read_screen_frame(reader)
+                if frame is None:
+                    return
+                if decoder:
+                    decoder.decode(frame)
+                if frame.timestamp in self.window:
+                    self.latencies.append(time.time() - frame.timestamp)
+                    self.received += 1
+                    self.received_bytes += frame.size
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+class ChatClient:
+    def __init__(self, name, room, window):
+        self.name = name
+        self.room = room
+        self.window = window
+        self.latencies = []
+        self.sock = None
+
+    def start(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(chat_hello(self.name, room=self.room))
+        reader = FrameReader(self.sock)
+        proto = int(read_hello_reply(reader)['proto'])
+        start_thread(self.receive, reader, proto)
+
+    def send(self, n):
+        timestamp = time.time()
+        text = f"{CHAT_TAG} {self.name} {n} {timestamp:.6f}"
+        self.sock.sendall(pack_chat_record({'type': 'message', 'text': text}))
+        return timestamp
+
+    def receive(self, reader, proto):
+        try:
+            while True:
+                record = read_chat_record(reader, proto)
+                if record is None:
+                    return
+                parts = str(record.get('text', '')).split()
+                if record.get('type') != 'message' or len(parts) != 4 or parts[0] != CHAT_TAG:
+                    continue
+                timestamp = float(parts[3])
+                if timestamp in self.window:
+                    self.latencies.append(time.time() - timestamp)
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+
+
+def send_chat(clients, rate, window, counts):
+    # One thread paces every chat client: messages go out round-robin at
+    # `rate` per client per second in total
+    if not clients or rate <= 0:
+        return
+    interval = 1.0 / (rate * len(clients))
+    deadline = time.monotonic()
+    n = 0
+    try:
+        while True:
+            client = clients[n % len(clients)]
+            if client.send(n) in window:
+                counts[client.room] = counts.get(client.room, 0) + 1
+            n += 1
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    except OSError:
+        pass
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class ProcessStats:
+    # CPU time and resident memory of the server process and any worker
+    # processes it forked, read from /proc (Linux)
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.rss_samples = []
+
+    @staticmethod
+    def available(pid):
+        return pid is not None and os.path.exists(f"/proc/{pid}/stat")
+
+    def pids(self):
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # Fields after the parenthesised command name
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except (OSError, IndexError):
+                pass
+        return total / os.sysconf('SC_CLK_TCK')
+
+    def rss(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+    def sample(self):
+        rss = self.rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.rss_samples.append(rss)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(args):
+    # A local server with nothing but the relay paths switched on: no chat
+    # history on disk, no recording and no metrics endpoint
+    args.chat_port, args.screen_port = free_port(), free_port()
+    command = [sys.executable, os.path.join(ROOT, 'Server.py'), '--engine', args.engine,
+               '--host', args.host, '--chat-port', str(args.chat_port), '--screen-port', str(args.screen_port),
+               '--history-dir', '', '--metrics-port', '0', '--metrics-interval', '0']
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    for port in (args.chat_port, args.screen_port):
+        while True:
+            try:
+                socket.create_connection((args.host, port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError("server did not start")
+                time.sleep(0.1)
+    return process
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def own_usage():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(args):
+    process = spawn_server(args) if args.spawn else None
+    pid = process.pid if process else args.server_pid
+    stats = ProcessStats(pid) if ProcessStats.available(pid) else None
+
+    # Clients connect one at a time, each waiting for its handshake reply,
+    # so the server's listen backlog never overflows
+    begin = time.time() + 3600
+    window = Window(begin, begin)
+    clip = encode_clip(args.resolution, CLIP_FRAMES, args.quality)
+    pairs = [ScreenPair(i, args, clip, window) for i in range(args.pairs)]
+    clients = [ChatClient(f"user{i}", f"loadgen-chat-{i % args.chat_rooms}", window)
+               for i in range(args.chat_clients)]
+    chat_counts = {}
+    try:
+        for item in pairs + clients:
+            item.start(args.host, args.screen_port if isinstance(item, ScreenPair) else args.chat_port)
+        start_thread(send_chat, clients, args.chat_rate, window, chat_counts)
+        print(f"⏱️  {len(pairs)} screen pairs ({args.receivers} receiver(s) each), {len(clients)} chat clients; "
+              f"warming up for {args.warmup:g} s, measuring for {args.duration:g} s")
+
+        window.start = time.time() + args.warmup
+        window.stop = window.start + args.duration
+        time.sleep(args.warmup)
+        cpu_start = stats.cpu_seconds() if stats else None
+        own_start = own_usage()
+        measure_start = time.monotonic()
+        while time.monotonic() - measure_start < args.duration:
+            if stats:
+                stats.sample()
+            time.sleep(0.5)
+        elapsed = time.monotonic() - measure_start
+        cpu = stats.cpu_seconds() - cpu_start if stats else None
+        own = own_usage() - own_start if own_start is not None else None
+
+        # Let frames and messages sent just before the end arrive
+        time.sleep(1.0)
+    finally:
+        for item in pairs + clients:
+            item.close()
+        if process:
+            process.terminate()
+            process.wait()
+
+    frame_latencies = [latency for pair in pairs for latency in pair.latencies]
+    chat_latencies = [latency for client in clients for latency in client.latencies]
+    members = {}
+    for client in clients:
+        members[client.room] = members.get(client.room, 0) + 1
+    expected_deliveries = sum(count * (members[room] - 1) for room, count in chat_counts.items())
+    expected_frames = sum(pair.sent for pair in pairs) * args.receivers
+    received_frames = sum(pair.received for pair in pairs)
+
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'screen': {
+            'frames_sent': sum(pair.sent for pair in pairs),
+            'frames_received': received_frames,
+            'frames_per_s': round(received_frames / args.duration, 1),
+            'mb_per_s': round(sum(pair.received_bytes for pair in pairs) / args.duration / 1e6, 3),
+            'loss_percent': round(100 * (1 - received_frames / expected_frames), 2) if expected_frames else None,
+            'latency_ms': percentiles(frame_latencies),
+        },
+        'chat': {
+            'messages_sent': sum(chat_counts.values()),
+            'deliveries': len(chat_latencies),
+            'expected_deliveries': expected_deliveries,
+            'deliveries_per_s': round(len(chat_latencies) / args.duration, 1),
+            'latency_ms': percentiles(chat_latencies),
+        },
+        'server': {
+            'cpu_percent': round(100 * cpu / elapsed, 1) if cpu is not None else None,
+            'rss_mb': round(sum(stats.rss_samples) / len(stats.rss_samples) / 1e6, 1) if stats and stats.rss_samples else None,
+            'peak_rss_mb': round(stats.peak_rss / 1e6, 1) if stats else None,
+        },
+        'loadgen': {
+            'cpu_percent': round(100 * own / elapsed, 1) if own is not None else None,
+        },
+    }
+
+
+def lookup(results, key):
+    for part in key.split('.'):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(part)
+    return results
+
+
+def print_results(results):
+    screen, chat, server = results['screen'], results['chat'], results['server']
+    latency = screen['latency_ms'] or {}
+    receivers = results['config']['receivers']
+    print(f"🖥️  screen: {screen['frames_sent']} frames sent, {screen['frames_received']}/"
+          f"{screen['frames_sent'] * receivers} received, "
+          f"{screen['frames_per_s']} frames/s, {screen['mb_per_s']} MB/s, {screen['loss_percent']}% lost, "
+          f"latency p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms")
+    latency = chat['latency_ms'] or {}
+    print(f"💬 chat: {chat['deliveries']}/{chat['expected_deliveries']} deliveries, "
+          f"{chat['deliveries_per_s']}/s, latency p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms")
+    print(f"🚀 server: {server['cpu_percent']}% CPU, {server['rss_mb']} MB RSS (peak {server['peak_rss_mb']} MB); "
+          f"load generator: {results['loadgen']['cpu_percent']}% CPU")
+
+
+def print_comparison(baseline, results):
+    print(f"{'metric':<26}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, higher_is_better in COMPARED.items():
+        old, new = lookup(baseline, key), lookup(results, key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        mark = " ⚠️" if worse and abs(change) >= 10 else ""
+        print(f"{key:<26}{old:>12g}{new:>12g}{change:>+9.1f}%{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat and screen server")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="engine of the server started for the run")
+    parser.add_argument('--connect', dest='spawn', action='store_false',
+                        help="load an already running server at --host/--chat-port/--screen-port")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--chat-port', type=int, default=9999)
+    parser.add_argument('--screen-port', type=int, default=9998)
+    parser.add_argument('--server-pid', type=int, help="pid to measure CPU and RSS of with --connect")
+    parser.add_argument('--chat-clients', type=int, default=20)
+    parser.add_argument('--chat-rooms', type=int, default=1)
+    parser.add_argument('--chat-rate', type=float, default=1.0, help="messages per second per chat client")
+    parser.add_argument('--pairs', type=int, default=2, help="synthetic presenters, each in its own room")
+    parser.add_argument('--receivers', type=int, default=1, help="receivers per presenter")
+    parser.add_argument('--resolution', type=parse_size, default=(1280, 720))
+    parser.add_argument('--fps', type=float, default=15)
+    parser.add_argument('--quality', type=int, default=50)
+    parser.add_argument('--decode', action='store_true', help="decode frames on the receivers as a viewer would")
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare with the JSON results of an earlier run")
+    args = parser.parse_args()
+    args.chat_rooms = max(1, args.chat_rooms)
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()